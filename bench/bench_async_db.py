@@ -0,0 +1,117 @@
+# Load test: checkouts concurrentes contra split_create mientras otro proceso retiene
+# el lock de escritura de SQLite. Compara correr la DB inline en el event loop (como
+# antes), las escrituras en el pool de lectura (varios threads compitiendo por el lock)
+# y en el thread writer con group commit (actual); mide throughput, latencia y el lag del
+# loop. Falla si el writer queda por debajo de inline en throughput.
+# Uso (desde la raíz del repo): python bench/bench_async_db.py [--requests 200] [--concurrency 50]
+import argparse
+import asyncio
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import multiprocessing
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="splitpay-async-"), "bench.db")
+
+import db  # noqa: E402
+import main  # noqa: E402
+
+async def _inline(fn, *args, **kwargs):
+    return fn(*args, **kwargs)
+
+def _seed() -> None:
+    db.init_db()
+    with db.get_db() as conn:
+        cur = conn.execute("INSERT INTO stores (tn_store_id, tn_access_token) VALUES (?,?)", ("bench", "x"))
+        conn.execute(
+            "INSERT INTO rules (store_id, scope, reference_id, max_installments, active) VALUES (?,?,?,?,1)",
+            (cur.lastrowid, "global", None, 12),
+        )
+
+def _lock_holder(path: str, stop: Any, hold_ms: float, gap_ms: float) -> None:
+    # Simula escrituras lentas de otro worker: toma el lock de escritura y lo retiene.
+    # Corre en otro proceso, como un worker real: un thread de este proceso competiría
+    # por el GIL y le regalaría tiempo de lock libre al modo inline.
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    while not stop.is_set():
+        conn.execute("BEGIN IMMEDIATE")
+        time.sleep(hold_ms / 1000)
+        conn.execute("COMMIT")
+        time.sleep(gap_ms / 1000)
+    conn.close()
+
+async def _loop_lag(stop: asyncio.Event, out: List[float]) -> None:
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.005)
+        out.append(time.perf_counter() - start - 0.005)
+
+async def _run(mode: str, n_requests: int, concurrency: int) -> Dict[str, Any]:
+    main.run_db_write = {"inline": _inline, "pool": db.run_db, "writer": db.run_db_write}[mode]
+    payload = {"tn_store_id": "bench", "items": [{"product_id": "1", "price": 1000, "quantity": 1}]}
+    sem = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    # Ráfaga: todos los checkouts llegan juntos, la latencia se mide desde la llegada.
+    async def one():
+        async with sem:
+            await main.split_create(payload)
+        latencies.append(time.perf_counter() - start)
+
+    lag: List[float] = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(_loop_lag(stop, lag))
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(n_requests)])
+    wall = time.perf_counter() - start
+    stop.set()
+    await ticker
+
+    latencies.sort()
+    lag.sort()
+    return {
+        "mode": mode,
+        "wall_s": wall,
+        "rps": n_requests / wall,
+        "p50_ms": statistics.median(latencies) * 1e3,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1e3,
+        "p99_loop_lag_ms": lag[int(len(lag) * 0.99) - 1] * 1e3 if lag else 0.0,
+        "max_loop_lag_ms": max(lag, default=0) * 1e3,
+    }
+
+def main_cli() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--hold-ms", type=float, default=50)
+    ap.add_argument("--gap-ms", type=float, default=20)
+    args = ap.parse_args()
+
+    _seed()
+    ctx = multiprocessing.get_context("fork")
+    stop = ctx.Event()
+    holder = ctx.Process(target=_lock_holder, args=(db.DB_PATH, stop, args.hold_ms, args.gap_ms), daemon=True)
+    holder.start()
+    try:
+        print(f"{'modo':>9} {'wall (s)':>9} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'lag p99 (ms)':>13} {'lag máx (ms)':>13}")
+        results = {}
+        for mode in ("inline", "pool", "writer"):
+            r = results[mode] = asyncio.run(_run(mode, args.requests, args.concurrency))
+            print(f"{r['mode']:>9} {r['wall_s']:>9.2f} {r['rps']:>8.0f} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} {r['p99_loop_lag_ms']:>13.1f} {r['max_loop_lag_ms']:>13.1f}")
+    finally:
+        stop.set()
+        holder.join()
+        db.close_db()
+    # Margen por el ruido de una corrida corta.
+    assert results["writer"]["rps"] >= results["inline"]["rps"] * 0.9, "el writer baja el throughput de checkout"
+
+if __name__ == "__main__":
+    main_cli()
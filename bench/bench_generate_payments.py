@@ -0,0 +1,99 @@
+# generate_payments con varios checkouts a la vez contra el stub de MP con latencia:
+# compara crear las preferencias en serie, en un pool compartido de 8 threads para todo
+# el proceso (como estaba) y en un pool propio por request (actual). Con un pool
+# compartido los requests concurrentes se encolan detrás de los demás.
+# Uso (desde la raíz del repo): python bench/bench_generate_payments.py [--concurrency 32] [--latency-ms 200]
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+
+from stubs import StubConfig, start_stubs, stub_env  # noqa: E402
+
+def _seed(main, db, n: int, tn_store_id: str) -> List[str]:
+    # Splits con 3 grupos (12, 6 y 0 cuotas): 3 preferencias por request.
+    with db.get_db() as conn:
+        store_id = conn.execute("INSERT INTO stores (tn_store_id, tn_access_token) VALUES (?, 'x')", (tn_store_id,)).lastrowid
+        rows = []
+        for _ in range(n):
+            groups = {
+                f"group_{t}": {"max_installments": t, "subtotal": 1000, "items": [{"product_id": str(t), "name": "x", "quantity": 1, "price": 1000}]}
+                for t in (12, 6, 0)
+            }
+            rows.append((str(uuid.uuid4()), store_id, None, groups))
+        main._insert_splits(conn, rows)
+    return [r[0] for r in rows]
+
+def main_cli() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=96)
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--latency-ms", type=float, default=200)
+    args = ap.parse_args()
+
+    _, _, mp_server, tn_server = start_stubs(StubConfig(args.latency_ms))
+    os.environ.update(stub_env(mp_server, tn_server))
+    os.environ.update({
+        "DB_PATH": os.path.join(tempfile.mkdtemp(prefix="splitpay-genpay-"), "bench.db"),
+        "MP_ACCESS_TOKEN_DEFAULT": "bench",
+        "HTTP_POOL_MAXSIZE": str(args.concurrency * 3),
+    })
+
+    import db
+    import main
+    from mp_api import create_preference
+
+    db.init_db()
+    per_request = main._create_preferences
+    shared = ThreadPoolExecutor(max_workers=8, thread_name_prefix="mp-pref-shared")
+
+    def shared_pool(mp_token: str, prefs: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        futures = {gk: shared.submit(create_preference, mp_token, pref) for gk, pref in prefs.items()}
+        return {gk: f.result() for gk, f in futures.items()}
+
+    def serial(mp_token: str, prefs: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        return {gk: create_preference(mp_token, pref) for gk, pref in prefs.items()}
+
+    results: Dict[str, Dict[str, float]] = {}
+    for name, fn in (("serie", serial), ("pool compartido (8)", shared_pool), ("pool por request", per_request)):
+        main._create_preferences = fn
+        split_ids = _seed(main, db, args.requests, name)
+        latencies: List[float] = []
+
+        def one(split_id: str) -> None:
+            start = time.perf_counter()
+            main.split_generate_payments(split_id)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
+            list(ex.map(one, split_ids))
+        wall = time.perf_counter() - start
+        latencies.sort()
+        results[name] = {
+            "rps": args.requests / wall,
+            "p50_ms": statistics.median(latencies) * 1e3,
+            "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1e3,
+        }
+        r = results[name]
+        print(f"{name:>20}: {r['rps']:6.1f} req/s, p50 {r['p50_ms']:7.1f}ms, p95 {r['p95_ms']:7.1f}ms")
+
+    shared.shutdown()
+    mp_server.shutdown()
+    tn_server.shutdown()
+    best = results["pool por request"]
+    assert best["p50_ms"] < results["serie"]["p50_ms"], "el pool por request no mejora a la serie"
+    assert best["p50_ms"] <= results["pool compartido (8)"]["p50_ms"], "el pool por request es peor que el compartido"
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,70 @@
+# Throughput de planificación batch (/split/plan_batch) en un core.
+# Uso (desde la raíz del repo): python bench/bench_plan_batch.py [--carts 10000] [--items 5]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="splitpay-batch-"), "bench.db")
+
+import db  # noqa: E402
+import main  # noqa: E402
+
+TARGET_CARTS_PER_S = 10_000
+
+def _seed(n_rules: int) -> None:
+    db.init_db()
+    with db.get_db() as conn:
+        store_id = conn.execute("INSERT INTO stores (tn_store_id, tn_access_token) VALUES (?,?)", ("bench", "x")).lastrowid
+        rows = [(store_id, "product", str(i), (12, 6, 0)[i % 3]) for i in range(n_rules)]
+        rows += [(store_id, "category", f"c{i}", (12, 6, 0)[i % 3]) for i in range(50)]
+        rows.append((store_id, "global", None, 6))
+        conn.executemany("INSERT INTO rules (store_id, scope, reference_id, max_installments, active) VALUES (?,?,?,?,1)", rows)
+
+def _carts(n_carts: int, n_items: int, n_products: int):
+    rnd = random.Random(42)
+    carts = []
+    for i in range(n_carts):
+        items = []
+        for _ in range(rnd.randint(1, n_items * 2 - 1)):
+            pid = rnd.randrange(n_products)
+            items.append({"product_id": str(pid), "category_id": f"c{pid % 80}", "quantity": rnd.randint(1, 3), "price": 500 + pid % 5000})
+        carts.append({"cart_id": str(i), "items": items})
+    return carts
+
+def _rate(fn, n_carts: int, rounds: int) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return n_carts / best
+
+def run(n_carts: int, n_items: int, rounds: int) -> None:
+    _seed(n_rules=5_000)
+    carts = _carts(n_carts, n_items, n_products=10_000)
+    items = [c["items"] for c in carts]
+    index = main.get_rule_index(1)
+
+    results = [
+        ("_build_groups por carrito", _rate(lambda: [main._build_groups(i, index) for i in items], n_carts, rounds)),
+        ("_plan_carts", _rate(lambda: main._plan_carts(carts, index), n_carts, rounds)),
+        ("_plan_batch (sin persistir)", _rate(lambda: main._plan_batch("bench", carts, False), n_carts, rounds)),
+        ("_plan_batch (persist, executemany)", _rate(lambda: main._plan_batch("bench", carts, True), n_carts, 1)),
+    ]
+    print(f"{n_carts} carritos, ~{n_items} líneas c/u, objetivo {TARGET_CARTS_PER_S} carritos/s")
+    for name, rate in results:
+        print(f"{name:>36}: {rate:>10,.0f} carritos/s")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--carts", type=int, default=10_000)
+    ap.add_argument("--items", type=int, default=5)
+    ap.add_argument("--rounds", type=int, default=3)
+    args = ap.parse_args()
+    run(args.carts, args.items, args.rounds)
@@ -0,0 +1,105 @@
+# Sweeper de conciliación contra el stub de MP: splits con links de pago generados y
+# sin webhook, repartidos entre tiendas con token propio y el token default. Mide el
+# tiempo del sweep y verifica que todos los splits queden completos, que cada tienda se
+# consulte con su token y que el ritmo por token no pase RECONCILE_RATE_PER_S.
+# Uso (desde la raíz del repo): python bench/bench_reconcile.py [--splits 200] [--stores 4] [--rate 50]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+
+from stubs import StubConfig, start_stubs, stub_env  # noqa: E402
+
+ADMIN_KEY = "bench-admin"
+DEFAULT_TOKEN = "default-token"
+
+def _ok(r):
+    # httpx trata los 303 del dashboard como error en raise_for_status().
+    assert r.status_code < 400, f"{r.request.url}: {r.status_code} {r.text[:200]}"
+    return r
+
+def main_cli() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--splits", type=int, default=200)
+    ap.add_argument("--stores", type=int, default=4, help="la primera usa el token default, el resto el propio")
+    ap.add_argument("--rate", type=float, default=50, help="RECONCILE_RATE_PER_S")
+    ap.add_argument("--concurrency", type=int, default=4, help="RECONCILE_CONCURRENCY")
+    ap.add_argument("--latency-ms", type=float, default=5)
+    args = ap.parse_args()
+
+    mp, _, mp_server, tn_server = start_stubs(StubConfig(args.latency_ms))
+    os.environ.update(stub_env(mp_server, tn_server))
+    os.environ.update({
+        "DB_PATH": os.path.join(tempfile.mkdtemp(prefix="splitpay-reconcile-"), "bench.db"),
+        "APP_ADMIN_KEY": ADMIN_KEY,
+        "MP_ACCESS_TOKEN_DEFAULT": DEFAULT_TOKEN,
+        "RECONCILE_INTERVAL_S": "0",
+        "RECONCILE_RATE_PER_S": str(args.rate),
+        "RECONCILE_CONCURRENCY": str(args.concurrency),
+        "OUTBOX_WORKERS": "0",
+    })
+
+    from fastapi.testclient import TestClient
+    import db
+    import main
+    import reconcile
+
+    with TestClient(main.app) as client:
+        for i in range(args.stores):
+            data = {"tn_store_id": str(i + 1), "tn_access_token": "stub"}
+            if i:
+                data["mp_access_token"] = f"store-token-{i + 1}"
+            _ok(client.post("/dashboard/store/save", params={"admin_key": ADMIN_KEY}, data=data, follow_redirects=False))
+            _ok(client.post(f"/dashboard/{i + 1}/rules/add", params={"admin_key": ADMIN_KEY},
+                            data={"scope": "category", "reference_id": "100", "max_installments": 12}, follow_redirects=False))
+
+        split_ids = []
+        for n in range(args.splits):
+            items = [
+                {"product_id": str(n), "category_id": "100", "name": "A", "quantity": 1, "price": 1000},
+                {"product_id": str(n + 1), "category_id": "200", "name": "B", "quantity": 1, "price": 500},
+            ]
+            split_id = _ok(client.post("/split/create", json={"tn_store_id": str(n % args.stores + 1), "items": items})).json()["split_id"]
+            _ok(client.get(f"/split/{split_id}/generate_payments", follow_redirects=False))
+            split_ids.append(split_id)
+
+        # Los webhooks nunca llegaron: se envejecen los pagos para que el sweep los tome.
+        with db.get_db() as conn:
+            conn.execute("UPDATE split_payments SET created_at = datetime('now', '-1 hour')")
+            pending = conn.execute("SELECT COUNT(*) FROM split_payments WHERE status='created'").fetchone()[0]
+
+        start = time.perf_counter()
+        result = reconcile.sweep(DEFAULT_TOKEN, limit=pending)
+        wall = time.perf_counter() - start
+
+        with db.get_db() as conn:
+            completed = conn.execute(
+                "SELECT COUNT(*) FROM splits WHERE id IN (SELECT value FROM json_each(?)) AND status='completed'",
+                (json.dumps(split_ids),),
+            ).fetchone()[0]
+            jobs = conn.execute("SELECT COUNT(*) FROM outbox WHERE kind='tn_order'").fetchone()[0]
+        again = reconcile.sweep(DEFAULT_TOKEN, limit=pending)
+
+    mp_server.shutdown()
+    tn_server.shutdown()
+
+    per_token_min = max(mp.searches.values()) / args.rate if args.rate > 0 else 0
+    print(f"{pending} pagos pendientes en {args.splits} splits, {args.stores} tiendas")
+    print(f"sweep: {wall:.2f}s ({pending / wall:.0f} pagos/s) -> {result}")
+    print(f"búsquedas por token: {dict(sorted(mp.searches.items()))}")
+    print(f"splits completos: {completed}/{args.splits}, órdenes TN encoladas: {jobs}, segundo sweep: {again['claimed']} tomados")
+    assert completed == args.splits, "quedaron splits sin completar"
+    assert jobs == pending, "faltan órdenes en el outbox"
+    assert set(mp.searches) == {DEFAULT_TOKEN} | {f"store-token-{i + 1}" for i in range(1, args.stores)}, "token equivocado"
+    assert wall >= per_token_min * 0.9, f"el sweep fue más rápido que el límite por token ({per_token_min:.2f}s)"
+    assert again["claimed"] == 0, "el segundo sweep volvió a tomar pagos ya conciliados"
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,154 @@
+# Retención sobre una base con splits viejos: abandonados, completados (con y sin órdenes
+# de TN pendientes), pagados a medias y con links de pago sin vencer. Mientras corre, otro thread crea splits y se mide
+# cuánto espera cada escritura por el lock. Compara con borrar todo en una sola sentencia
+# y verifica qué se borró, qué se archivó, el lookup y el tamaño de la base.
+# Uso (desde la raíz del repo): python bench/bench_retention.py [--splits 20000]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+TMP = tempfile.mkdtemp(prefix="splitpay-retention-")
+os.environ["RETENTION_ARCHIVE_DIR"] = os.path.join(TMP, "archive")
+os.environ["RETENTION_MAX_BATCHES"] = "100000"
+
+import db  # noqa: E402
+import main  # noqa: E402
+import retention  # noqa: E402
+
+def _groups(rnd: random.Random) -> Dict[str, Any]:
+    items = [{"product_id": str(rnd.randrange(1000)), "name": "x" * 40, "quantity": 1, "price": 1000} for _ in range(rnd.randint(2, 6))]
+    half = len(items) // 2
+    return {
+        "group_12": {"max_installments": 12, "subtotal": 1000 * half, "items": items[:half]},
+        "group_0": {"max_installments": 0, "subtotal": 1000 * (len(items) - half), "items": items[half:]},
+    }
+
+def _seed(path: str, n: int) -> Dict[str, List[str]]:
+    db.close_db()
+    db.DB_PATH = path
+    db.init_db()
+    rnd = random.Random(7)
+    kinds: Dict[str, List[str]] = {"abandoned": [], "completed": [], "partial": [], "tn_pending": [], "open_link": [], "recent": []}
+    with db.get_db() as conn:
+        store_id = conn.execute("INSERT INTO stores (tn_store_id, tn_access_token) VALUES ('bench', 'x')").lastrowid
+        rows, payments, jobs, done_jobs, events = [], [], [], [], []
+        for i in range(n):
+            kind = rnd.choices(list(kinds), weights=(45, 45, 4, 2, 2, 4))[0]
+            split_id = str(uuid.uuid4())
+            kinds[kind].append(split_id)
+            rows.append((split_id, store_id, None, _groups(rnd)))
+            for gk in ("group_12", "group_0"):
+                paid = kind in ("completed", "tn_pending") or (kind == "partial" and gk == "group_12")
+                # Los links de los abandonados ya vencieron; los de open_link no vencen.
+                expires = "-190 days" if kind == "abandoned" else None
+                payments.append((split_id, gk, f"pref-{i}-{gk}", "approved" if paid else "created", f"{i}{gk[-1]}" if paid else None, expires))
+                if paid:
+                    events.append((f"{i}{gk[-1]}", "-1 day" if kind == "recent" else "-200 days"))
+                    if kind == "completed":
+                        done_jobs.append(("tn_order", f"{split_id}:{gk}", "{}"))
+            if kind == "tn_pending":
+                jobs.append(("tn_order", f"{split_id}:group_12", "{}"))
+        main._insert_splits(conn, rows)
+        conn.executemany(
+            "INSERT INTO split_payments (split_id, group_key, mp_preference_id, status, mp_payment_id, preference_expires_at) "
+            "VALUES (?,?,?,?,?,datetime('now', ?))",
+            payments,
+        )
+        conn.executemany("INSERT INTO outbox (kind, dedupe_key, payload_json) VALUES (?,?,?)", jobs)
+        conn.executemany(
+            "INSERT INTO outbox (kind, dedupe_key, payload_json, status, updated_at) VALUES (?,?,?,'done',datetime('now', '-200 days'))", done_jobs
+        )
+        conn.executemany("INSERT INTO processed_events (payment_id, status, processed_at) VALUES (?,'approved',datetime('now', ?))", events)
+        for kind, ids in kinds.items():
+            status = "completed" if kind in ("completed", "tn_pending") else "created"
+            age = "-1 day" if kind == "recent" else "-200 days"
+            conn.executemany(f"UPDATE splits SET status='{status}', created_at=datetime('now', '{age}') WHERE id=?", [(s,) for s in ids])
+    with db.get_db() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return kinds
+
+def _size(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+def _with_writer(fn) -> Dict[str, float]:
+    # Un checkout por ms mientras corre fn(): latencia de cada INSERT (incluye esperar el lock).
+    stop = threading.Event()
+    waits: List[float] = []
+
+    def writer() -> None:
+        rnd = random.Random(1)
+        while not stop.is_set():
+            start = time.perf_counter()
+            with db.get_db() as conn:
+                main._insert_splits(conn, [(str(uuid.uuid4()), 1, None, _groups(rnd))])
+            waits.append(time.perf_counter() - start)
+            time.sleep(0.001)
+
+    t = threading.Thread(target=writer)
+    t.start()
+    start = time.perf_counter()
+    fn()
+    wall = time.perf_counter() - start
+    stop.set()
+    t.join()
+    waits.sort()
+    return {"wall_s": wall, "writes": len(waits), "write_p99_ms": waits[int(len(waits) * 0.99)] * 1e3, "write_max_ms": waits[-1] * 1e3}
+
+def main_cli() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--splits", type=int, default=20000)
+    args = ap.parse_args()
+
+    path = os.path.join(TMP, "single.db")
+    _seed(path, args.splits)
+
+    def single() -> None:
+        with db.get_db() as conn:
+            conn.execute("DELETE FROM splits WHERE created_at < datetime('now', '-30 days') AND status IN ('created','completed')")
+
+    r = _with_writer(single)
+    print(f"una sola sentencia: {r['wall_s']:.2f}s, {r['writes']} escrituras concurrentes, p99 {r['write_p99_ms']:.1f}ms, máx {r['write_max_ms']:.1f}ms")
+
+    path = os.path.join(TMP, "retention.db")
+    kinds = _seed(path, args.splits)
+    with db.get_db() as conn:
+        stats_before = [tuple(x) for x in conn.execute("SELECT splits_completed, gmv FROM store_split_stats WHERE store_id=1")]
+    size_before = _size(path)
+    out: Dict[str, Any] = {}
+    r = _with_writer(lambda: out.update(retention.run_once()))
+    size_after = _size(path)
+    print(f"retention.run_once: {r['wall_s']:.2f}s, {r['writes']} escrituras concurrentes, p99 {r['write_p99_ms']:.1f}ms, máx {r['write_max_ms']:.1f}ms")
+    print(f"resultado {out}; base {size_before / 1e6:.1f}MB -> {size_after / 1e6:.1f}MB; "
+          f"archivo {sum(os.path.getsize(os.path.join(retention.RETENTION_ARCHIVE_DIR, f)) for f in os.listdir(retention.RETENTION_ARCHIVE_DIR)) / 1e6:.1f}MB")
+
+    with db.get_db() as conn:
+        def alive(ids: List[str]) -> int:
+            return sum(conn.execute("SELECT 1 FROM splits WHERE id=?", (s,)).fetchone() is not None for s in ids)
+        counts = {k: alive(v) for k, v in kinds.items()}
+        stats_after = [tuple(x) for x in conn.execute("SELECT splits_completed, gmv FROM store_split_stats WHERE store_id=1")]
+    print(f"siguen en la base: { {k: f'{counts[k]}/{len(v)}' for k, v in kinds.items()} }")
+    assert counts["abandoned"] == 0 and counts["completed"] == 0, "quedaron splits viejos"
+    assert all(counts[k] == len(kinds[k]) for k in ("partial", "tn_pending", "open_link", "recent")), "se borró un split que había que conservar"
+    assert out["archived"] == len(kinds["completed"]) and out["abandoned_deleted"] == len(kinds["abandoned"])
+    assert out["outbox_deleted"] == 2 * len(kinds["completed"]), "quedaron jobs 'done' viejos en el outbox"
+    assert out["events_deleted"] == 2 * (len(kinds["completed"]) + len(kinds["tn_pending"])) + len(kinds["partial"]), "quedaron eventos viejos"
+    assert stats_before == stats_after, "cambiaron los agregados del dashboard"
+
+    start = time.perf_counter()
+    sample = random.Random(3).sample(kinds["completed"], min(200, len(kinds["completed"])))
+    for split_id in sample:
+        record = retention.lookup_archived(split_id)
+        assert record and record["id"] == split_id and len(record["payments"]) == 2 and record["items"], split_id
+    print(f"lookup_archived: {(time.perf_counter() - start) / len(sample) * 1e3:.2f}ms por split")
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,124 @@
+# Microbenchmark: resolución de cuotas con el scan lineal viejo vs. el índice compilado.
+# Uso (desde la raíz del repo): python bench/bench_rules.py [--items 20] [--rounds 200]
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="splitpay-bench-"), "bench.db")
+
+import db  # noqa: E402
+import main  # noqa: E402
+from rules import get_rule_index, invalidate_rule_index  # noqa: E402
+
+RULE_COUNTS = (10, 1_000, 50_000)
+
+# ---- implementación anterior (query por request + hasta 3 scans lineales por item) ----
+def _legacy_get_active_rules(store_id: int) -> List[Dict[str, Any]]:
+    with db.get_db() as conn:
+        rows = conn.execute("SELECT * FROM rules WHERE store_id = ? AND active = 1", (store_id,)).fetchall()
+        return [dict(r) for r in rows]
+
+def _legacy_pick_rule_for_item(active_rules: List[Dict[str, Any]], item: Dict[str, Any]) -> int:
+    product_id = str(item.get("product_id") or "")
+    category_id = str(item.get("category_id") or "")
+    for r in active_rules:
+        if r["scope"] == "product" and (r["reference_id"] or "") == product_id:
+            return int(r["max_installments"])
+    for r in active_rules:
+        if r["scope"] == "category" and (r["reference_id"] or "") == category_id:
+            return int(r["max_installments"])
+    for r in active_rules:
+        if r["scope"] == "global":
+            return int(r["max_installments"])
+    return 6
+
+def _legacy_group_key(max_installments: int) -> str:
+    if max_installments >= 12:
+        return "group_12"
+    if max_installments >= 6:
+        return "group_6"
+    return "group_0"
+
+def _legacy_build_groups(items: List[Dict[str, Any]], rules: List[Dict[str, Any]]) -> Dict[str, Any]:
+    groups = {
+        "group_12": {"max_installments": 12, "items": [], "subtotal": 0},
+        "group_6": {"max_installments": 6, "items": [], "subtotal": 0},
+        "group_0": {"max_installments": 0, "items": [], "subtotal": 0},
+    }
+    for it in items:
+        gk = _legacy_group_key(_legacy_pick_rule_for_item(rules, it))
+        groups[gk]["items"].append(it)
+        groups[gk]["subtotal"] += int(it.get("price", 0)) * int(it.get("quantity", 1))
+    return groups
+
+# ---- datos ----
+def _seed_store(n_rules: int) -> int:
+    with db.get_db() as conn:
+        cur = conn.execute(
+            "INSERT INTO stores (tn_store_id, tn_access_token) VALUES (?,?)",
+            (f"bench-{n_rules}", "x"),
+        )
+        store_id = cur.lastrowid
+        n_categories = max(1, n_rules // 10)
+        n_products = n_rules - n_categories - 1
+        rows = [(store_id, "product", str(i), (12, 6, 0)[i % 3]) for i in range(n_products)]
+        rows += [(store_id, "category", f"c{i}", (12, 6, 0)[i % 3]) for i in range(n_categories)]
+        rows.append((store_id, "global", None, 6))
+        conn.executemany(
+            "INSERT INTO rules (store_id, scope, reference_id, max_installments, active) VALUES (?,?,?,?,1)",
+            rows,
+        )
+    return store_id
+
+def _cart(n_items: int, n_rules: int) -> List[Dict[str, Any]]:
+    # Mezcla de items que matchean por producto, por categoría y por la global (peor caso del scan).
+    items = []
+    for i in range(n_items):
+        kind = i % 3
+        product_id = str((i * 7919) % max(1, n_rules - n_rules // 10 - 1)) if kind == 0 else f"p-miss-{i}"
+        category_id = f"c{i % max(1, n_rules // 10)}" if kind == 1 else "c-miss"
+        items.append({"product_id": product_id, "category_id": category_id, "quantity": 1, "price": 1000 + i})
+    return items
+
+def _timeit(fn, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds
+
+def run(n_items: int, rounds: int) -> None:
+    db.init_db()
+    print(f"items por carrito: {n_items}  rounds: {rounds}")
+    print(f"{'reglas':>8} {'legacy (ms)':>12} {'index hit (ms)':>15} {'index build (ms)':>17} {'speedup':>9}")
+    for n_rules in RULE_COUNTS:
+        store_id = _seed_store(n_rules)
+        items = _cart(n_items, n_rules)
+
+        legacy_rounds = max(1, rounds // max(1, n_rules // 1000))
+        legacy = _timeit(lambda: _legacy_build_groups(items, _legacy_get_active_rules(store_id)), legacy_rounds)
+
+        def _cold():
+            invalidate_rule_index(store_id)
+            get_rule_index(store_id)
+        build = _timeit(_cold, max(1, legacy_rounds // 2))
+
+        get_rule_index(store_id)
+        indexed = _timeit(lambda: main._build_groups(items, get_rule_index(store_id)), rounds)
+
+        # El planner omite los grupos vacíos; con los tramos por defecto el resto coincide.
+        legacy_groups = {k: g for k, g in _legacy_build_groups(items, _legacy_get_active_rules(store_id)).items() if g["items"]}
+        assert legacy_groups == main._build_groups(items, get_rule_index(store_id))
+        print(f"{n_rules:>8} {legacy * 1e3:>12.3f} {indexed * 1e3:>15.4f} {build * 1e3:>17.3f} {legacy / indexed:>8.0f}x")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--items", type=int, default=20)
+    ap.add_argument("--rounds", type=int, default=200)
+    args = ap.parse_args()
+    run(args.items, args.rounds)
@@ -0,0 +1,84 @@
+# Ráfagas de create_order contra el stub de TN con rate limit por tienda. Compara llamar
+# a TN a ciegas (http_client directo, como antes) con el scheduler de tn_api: 429
+# recibidos, órdenes creadas y duración por tienda. Con el scheduler no debería haber
+# 429 y una tienda saturada no debería frenar a las demás.
+# Uso (desde la raíz del repo): python bench/bench_tn_ratelimit.py [--orders 60] [--stores 3] [--limit 10] [--leak 5]
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stubs import StubConfig, start_stubs, stub_env  # noqa: E402
+
+def _run(fn, jobs: List[str], concurrency: int) -> Dict[str, Any]:
+    finished: Dict[str, float] = {}
+    failed = 0
+    start = time.perf_counter()
+
+    def one(store: str) -> None:
+        nonlocal failed
+        try:
+            fn(store)
+        except Exception:
+            failed += 1
+        finished[store] = time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        list(ex.map(one, jobs))
+    return {"wall_s": time.perf_counter() - start, "failed": failed, "last_by_store_s": {k: round(v, 2) for k, v in sorted(finished.items())}}
+
+def main_cli() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--orders", type=int, default=60, help="órdenes para la tienda saturada")
+    ap.add_argument("--stores", type=int, default=3, help="la tienda 1 recibe --orders, el resto 5 cada una")
+    ap.add_argument("--limit", type=int, default=10, help="tamaño del bucket del stub")
+    ap.add_argument("--leak", type=float, default=5, help="vaciado del bucket (req/s)")
+    ap.add_argument("--concurrency", type=int, default=16)
+    args = ap.parse_args()
+
+    _, tn, mp_server, tn_server = start_stubs(StubConfig(), tn_rate_limit=args.limit, tn_leak_per_s=args.leak)
+    os.environ.update(stub_env(mp_server, tn_server))
+    os.environ.update({"TN_RATE_LIMIT": str(args.limit), "TN_RATE_LEAK_PER_S": str(args.leak), "TN_ORDER_MAX_WAIT_S": "3600"})
+
+    import http_client
+    import tn_api
+
+    # Las órdenes de las tiendas chicas llegan en medio de la ráfaga de la tienda 1.
+    head = min(args.orders, args.limit)
+    jobs = ["1"] * head + [str(s) for s in range(2, args.stores + 1) for _ in range(5)] + ["1"] * (args.orders - head)
+
+    def blind(store: str) -> None:
+        r = http_client.request("tn", "POST", f"{tn_api.TN_API_BASE}/{store}/orders", call="tn.create_order",
+                                headers=tn_api.tn_headers("stub"), json={"products": []})
+        r.raise_for_status()
+
+    def scheduled(store: str) -> None:
+        tn_api.create_order(store, "stub", {"products": []})
+
+    results = {}
+    for name, fn in (("a ciegas", blind), ("scheduler", scheduled)):
+        tn.throttled, tn.orders, tn.orders_by_store = 0, 0, {}
+        tn._buckets.clear()
+        res = _run(fn, jobs, args.concurrency)
+        res.update({"throttled": tn.throttled, "orders": tn.orders})
+        results[name] = res
+        print(f"{name:>10}: {res['orders']}/{len(jobs)} órdenes, {res['throttled']} 429, {res['failed']} fallidas, "
+              f"{res['wall_s']:.2f}s, última por tienda {res['last_by_store_s']}")
+    print(f"stats del scheduler: {tn_api.rate_limit_stats()}")
+
+    mp_server.shutdown()
+    tn_server.shutdown()
+    sched = results["scheduler"]
+    assert sched["orders"] == len(jobs) and sched["failed"] == 0, "el scheduler perdió órdenes"
+    assert sched["throttled"] == 0, "el scheduler recibió 429"
+    others = [v for k, v in sched["last_by_store_s"].items() if k != "1"]
+    assert not others or max(others) < sched["last_by_store_s"]["1"], "la tienda saturada frenó a las demás"
+
+if __name__ == "__main__":
+    main_cli()
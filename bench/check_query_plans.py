@@ -0,0 +1,68 @@
+# Imprime EXPLAIN QUERY PLAN de cada query SQL literal de los módulos de la app y
+# falla (exit 1) si alguna con WHERE termina en un full scan de tabla.
+# Uso (desde la raíz del repo): python bench/check_query_plans.py [archivo.py ...]
+import ast
+import glob
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from typing import List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="splitpay-plans-"), "plans.db")
+
+import db  # noqa: E402
+
+SQL_START = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", re.IGNORECASE)
+# json_each(?) es una función tabla sobre el parámetro, no un scan de la base.
+FULL_SCAN = re.compile(r"\bSCAN (\w+)\b(?! USING| VIRTUAL TABLE)")
+
+def _literal(node: ast.AST) -> Optional[str]:
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left, right = _literal(node.left), _literal(node.right)
+        if left is not None and right is not None:
+            return left + right
+    return None
+
+def extract_queries(path: str) -> List[Tuple[int, str]]:
+    tree = ast.parse(open(path, encoding="utf-8").read(), filename=path)
+    found = []
+    for node in ast.walk(tree):
+        if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)):
+            continue
+        if node.func.attr not in ("execute", "executemany") or not node.args:
+            continue
+        sql = _literal(node.args[0])
+        if sql and SQL_START.match(sql):
+            found.append((node.lineno, sql))
+    return sorted(found)
+
+def explain(conn: sqlite3.Connection, sql: str) -> List[str]:
+    params = (None,) * sql.count("?")
+    return [row["detail"] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+
+def main(paths: List[str]) -> int:
+    db.init_db()
+    failures = 0
+    with db.get_db() as conn:
+        for path in paths:
+            for lineno, sql in extract_queries(path):
+                plan = explain(conn, sql)
+                scans = [d for d in plan if FULL_SCAN.search(d)]
+                bad = bool(scans) and re.search(r"\bWHERE\b", sql, re.IGNORECASE) is not None
+                failures += bad
+                print(f"{'FULL SCAN' if bad else 'ok':>9}  {os.path.relpath(path, ROOT)}:{lineno}  {' '.join(sql.split())}")
+                for detail in plan:
+                    print(f"{'':>11}{detail}")
+        conn.rollback()
+    print(f"\n{failures} query(s) con full scan")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    targets = sys.argv[1:] or sorted(glob.glob(os.path.join(ROOT, "*.py")))
+    sys.exit(main(targets))
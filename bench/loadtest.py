@@ -0,0 +1,234 @@
+# Load test end-to-end: levanta la app (uvicorn) apuntando a stubs locales de MP/TN y
+# corre el flujo completo /split/create -> /shipping -> /generate_payments -> /mp/webhook
+# con concurrencia configurable. Reporta p50/p95/p99 y req/s por ruta y guarda JSON.
+# Uso (desde la raíz del repo):
+#   python bench/loadtest.py --flows 500 --concurrency 32 --latency-ms 40 --error-rate 0.01
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stubs import StubConfig, start_stubs, stub_env  # noqa: E402
+
+ADMIN_KEY = "bench-admin"
+TN_STORE_ID = "1"
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _git_rev() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def _percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[k]
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def timed(self, route: str, fn, *args, **kwargs) -> requests.Response:
+        start = time.perf_counter()
+        try:
+            r = fn(*args, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self.errors[route] = self.errors.get(route, 0) + 1
+            raise
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.samples.setdefault(route, []).append(elapsed)
+            if r.status_code >= 400:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return r
+
+    def summary(self, wall_s: float) -> Dict[str, Any]:
+        out = {}
+        for route, values in sorted(self.samples.items()):
+            values = sorted(values)
+            out[route] = {
+                "count": len(values),
+                "errors": self.errors.get(route, 0),
+                "rps": len(values) / wall_s if wall_s else 0.0,
+                "p50_ms": _percentile(values, 50) * 1e3,
+                "p95_ms": _percentile(values, 95) * 1e3,
+                "p99_ms": _percentile(values, 99) * 1e3,
+                "max_ms": values[-1] * 1e3,
+            }
+        return out
+
+def _flow(base: str, mp_base: str, rec: Recorder, session: requests.Session, n: int) -> None:
+    items = [
+        {"product_id": str(n % 50), "category_id": "100", "name": "A", "quantity": 1, "price": 1000},
+        {"product_id": str(50 + n % 50), "category_id": "101", "name": "B", "quantity": 2, "price": 2500},
+        {"product_id": str(100 + n % 50), "category_id": "102", "name": "C", "quantity": 1, "price": 700},
+    ]
+    r = rec.timed("POST /split/create", session.post, f"{base}/split/create", json={"tn_store_id": TN_STORE_ID, "items": items})
+    if r.status_code != 200:
+        return
+    split_id = r.json()["split_id"]
+
+    rec.timed(
+        "POST /split/{id}/shipping", session.post, f"{base}/split/{split_id}/shipping",
+        data={"shipping_method": "estandar", "shipping_paid_in_group": "group_12"}, allow_redirects=False,
+    )
+    r = rec.timed("GET /split/{id}/generate_payments", session.get, f"{base}/split/{split_id}/generate_payments", allow_redirects=False)
+    if r.status_code >= 400:
+        # Tras un 500 uvicorn cierra la conexión: se descarta el pool para no medir el reset.
+        session.close()
+        return
+
+    for payment_id in requests.get(f"{mp_base}/_stub/payments", params={"split_id": split_id}, timeout=10).json():
+        rec.timed("POST /mp/webhook", session.post, f"{base}/mp/webhook", json={"type": "payment", "data": {"id": payment_id}})
+
+def _seed(base: str) -> None:
+    requests.post(f"{base}/dashboard/store/save", params={"admin_key": ADMIN_KEY},
+                  data={"tn_store_id": TN_STORE_ID, "tn_access_token": "stub"}, allow_redirects=False, timeout=10).raise_for_status()
+    for scope, ref, max_inst in (("category", "100", 12), ("category", "101", 6), ("global", "", 0)):
+        requests.post(f"{base}/dashboard/{TN_STORE_ID}/rules/add", params={"admin_key": ADMIN_KEY},
+                      data={"scope": scope, "reference_id": ref, "max_installments": max_inst}, allow_redirects=False, timeout=10).raise_for_status()
+
+def _wait_ready(base: str, proc: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("uvicorn terminó antes de arrancar")
+        try:
+            requests.get(f"{base}/", timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError("uvicorn no respondió a tiempo")
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    mp, tn, mp_server, tn_server = start_stubs(StubConfig(args.latency_ms, args.jitter_ms, args.error_rate))
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    tmp = tempfile.mkdtemp(prefix="splitpay-load-")
+    env = dict(os.environ)
+    env.update(stub_env(mp_server, tn_server))
+    env.update({
+        "DB_PATH": os.path.join(tmp, "load.db"),
+        "APP_BASE_URL": base,
+        "APP_ADMIN_KEY": ADMIN_KEY,
+        "MP_ACCESS_TOKEN_DEFAULT": "stub-token",
+        # El stub de TN no tiene rate limit ni manda los headers: sin esto tn_api se
+        # queda con el ritmo inicial conservador (TN_RATE_LEAK_PER_S) y el outbox no drena.
+        "TN_RATE_LIMIT": "100000",
+        "TN_RATE_LEAK_PER_S": "100000",
+    })
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+           "--workers", str(args.workers), "--log-level", "warning"]
+    log_path = os.path.join(tmp, "uvicorn.log")
+    log = open(log_path, "w")
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    print(f"log de uvicorn: {log_path}")
+    try:
+        _wait_ready(base, proc)
+        _seed(base)
+
+        rec = Recorder()
+        local = threading.local()
+
+        def one(n: int) -> None:
+            session = getattr(local, "session", None)
+            if session is None:
+                session = local.session = requests.Session()
+            try:
+                _flow(base, f"http://127.0.0.1:{mp_server.server_port}", rec, session, n)
+            except requests.RequestException:
+                pass
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as ex:
+            list(ex.map(one, range(args.flows)))
+        wall = time.perf_counter() - start
+
+        # Las órdenes en TN las crea el outbox en background; se espera a que drene.
+        drain_start = time.perf_counter()
+        while True:
+            outbox = requests.get(f"{base}/dashboard/stats", params={"admin_key": ADMIN_KEY}, timeout=10).json()["outbox"]
+            left = outbox.get("pending", 0) + outbox.get("processing", 0)
+            if not left or time.perf_counter() - drain_start >= args.drain_s:
+                break
+            time.sleep(0.2)
+        drain = time.perf_counter() - drain_start
+        return {
+            "rev": _git_rev(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "params": vars(args),
+            "wall_s": wall,
+            "flows_per_s": args.flows / wall if wall else 0.0,
+            "routes": rec.summary(wall),
+            "outbox_drain_s": drain,
+            "outbox_left": left,
+            "outbox_dead": outbox.get("dead", 0),
+            "upstream": {"mp_preferences": len(mp.payments), "tn_orders": tn.orders},
+        }
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+        mp_server.shutdown()
+        tn_server.shutdown()
+
+def _print(result: Dict[str, Any]) -> None:
+    print(f"rev {result['rev']}  {result['params']['flows']} flujos en {result['wall_s']:.2f}s ({result['flows_per_s']:.1f} flujos/s)")
+    print(f"{'ruta':<36} {'n':>6} {'err':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, s in result["routes"].items():
+        print(f"{route:<36} {s['count']:>6} {s['errors']:>5} {s['rps']:>8.1f} {s['p50_ms']:>8.1f} {s['p95_ms']:>8.1f} {s['p99_ms']:>8.1f}")
+    if result["outbox_left"]:
+        print(f"outbox SIN drenar tras {result['outbox_drain_s']:.1f}s: {result['outbox_left']} jobs pendientes — upstream: {result['upstream']}")
+    else:
+        print(f"outbox drenado en {result['outbox_drain_s']:.1f}s — upstream: {result['upstream']}")
+    if result["outbox_dead"]:
+        print(f"outbox: {result['outbox_dead']} jobs en dead")
+
+def main_cli() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--flows", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--workers", type=int, default=1, help="workers de uvicorn")
+    ap.add_argument("--latency-ms", type=float, default=30, help="latencia de los stubs MP/TN")
+    ap.add_argument("--jitter-ms", type=float, default=10)
+    ap.add_argument("--error-rate", type=float, default=0.0, help="proporción de 503 en los stubs")
+    ap.add_argument("--drain-s", type=float, default=60, help="espera máxima a que el outbox quede vacío")
+    ap.add_argument("--out", default=None, help="JSON de salida (default: bench/results/loadtest-<rev>-<ts>.json)")
+    args = ap.parse_args()
+
+    result = run(args)
+    _print(result)
+    out = args.out or os.path.join(ROOT, "bench", "results", f"loadtest-{result['rev']}-{int(time.time())}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"resultado guardado en {out}")
+    if result["outbox_left"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,230 @@
+# Servidores HTTP locales que reemplazan a api.mercadopago.com y api.tiendanube.com
+# para benchmarks, con latencia y tasa de errores configurables.
+# Uso suelto: python bench/stubs.py --mp-port 9001 --tn-port 9002 --latency-ms 50 --error-rate 0.01
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+class StubConfig:
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers y body salen en dos writes: sin esto Nagle + delayed ACK suman ~40ms por
+    # request en keep-alive y el stub pasa a ser el cuello de botella.
+    disable_nagle_algorithm = True
+    config: StubConfig
+    routes: List[Tuple[str, "re.Pattern[str]", Any]]
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code: int, body: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, method: str) -> None:
+        url = urllib.parse.urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        is_control = url.path.startswith("/_stub/")
+
+        if not is_control:
+            cfg = self.config
+            delay = cfg.latency_ms + (random.uniform(-cfg.jitter_ms, cfg.jitter_ms) if cfg.jitter_ms else 0)
+            if delay > 0:
+                time.sleep(delay / 1000)
+            if cfg.error_rate and random.random() < cfg.error_rate:
+                self._send(503, {"message": "stub: error inyectado"})
+                return
+
+        for m, pattern, fn in self.routes:
+            match = pattern.fullmatch(url.path)
+            if m == method and match:
+                body = None
+                if raw:
+                    try:
+                        body = json.loads(raw)
+                    except ValueError:
+                        body = dict(urllib.parse.parse_qsl(raw.decode()))
+                # Los handlers devuelven (code, body) o (code, body, headers).
+                self._send(*fn(match, dict(urllib.parse.parse_qsl(url.query)), body, self.headers))
+                return
+        self._send(404, {"message": "stub: ruta desconocida"})
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+class MercadoPagoStub:
+    def __init__(self, config: StubConfig):
+        self.config = config
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.payments: Dict[str, Dict[str, Any]] = {}
+        self.by_split: Dict[str, List[str]] = {}
+        self.by_ref: Dict[str, List[str]] = {}
+        self.searches: Dict[str, int] = {}
+
+    def _create_preference(self, match, query, body, headers) -> Tuple[int, Any]:
+        ref = (body or {}).get("external_reference") or ""
+        with self._lock:
+            n = next(self._ids)
+            payment_id = str(1_000_000 + n)
+            self.payments[payment_id] = {"id": int(payment_id), "status": "approved", "external_reference": ref}
+            self.by_split.setdefault(ref.split(":", 1)[0], []).append(payment_id)
+            self.by_ref.setdefault(ref, []).append(payment_id)
+        return 201, {"id": f"pref-{n}", "init_point": f"http://stub.local/checkout/{payment_id}"}
+
+    def _get_payment(self, match, query, body, headers) -> Tuple[int, Any]:
+        pay = self.payments.get(match.group(1))
+        return (200, pay) if pay else (404, {"message": "not_found"})
+
+    def _search_payments(self, match, query, body, headers) -> Tuple[int, Any]:
+        token = (headers.get("Authorization") or "").replace("Bearer ", "")
+        with self._lock:
+            self.searches[token] = self.searches.get(token, 0) + 1
+            ids = list(reversed(self.by_ref.get(query.get("external_reference", ""), [])))
+        results = [self.payments[i] for i in ids]
+        return 200, {"results": results, "paging": {"total": len(results), "offset": 0, "limit": 30}}
+
+    def _payments_for_split(self, match, query, body, headers) -> Tuple[int, Any]:
+        return 200, self.by_split.get(query.get("split_id", ""), [])
+
+    def routes(self):
+        return [
+            ("POST", re.compile(r"/checkout/preferences"), self._create_preference),
+            ("GET", re.compile(r"/v1/payments/search"), self._search_payments),
+            ("GET", re.compile(r"/v1/payments/(\w+)"), self._get_payment),
+            ("GET", re.compile(r"/_stub/payments"), self._payments_for_split),
+        ]
+
+class TiendanubeStub:
+    # Con rate_limit > 0 simula el leaky bucket por tienda de TN: headers x-rate-limit-*
+    # en cada respuesta y 429 cuando el bucket está lleno.
+    def __init__(self, config: StubConfig, n_products: int = 1000, rate_limit: int = 0, leak_per_s: float = 2):
+        self.config = config
+        self.orders = 0
+        self.rate_limit = rate_limit
+        self.leak_per_s = leak_per_s
+        self.throttled = 0
+        self.orders_by_store: Dict[str, int] = {}
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self.products = [
+            {"id": i, "categories": [{"id": 100 + i % 20}], "updated_at": "2024-01-01T00:00:00+0000"}
+            for i in range(1, n_products + 1)
+        ]
+
+    def _take(self, store: str) -> Tuple[bool, Dict[str, str]]:
+        if not self.rate_limit:
+            return True, {}
+        with self._lock:
+            now = time.monotonic()
+            level, updated = self._buckets.get(store, (0.0, now))
+            level = max(0.0, level - (now - updated) * self.leak_per_s)
+            ok = level + 1 <= self.rate_limit
+            if ok:
+                level += 1
+            else:
+                self.throttled += 1
+            self._buckets[store] = (level, now)
+        return ok, {
+            "x-rate-limit-limit": str(self.rate_limit),
+            "x-rate-limit-remaining": str(int(self.rate_limit - level)),
+            "x-rate-limit-reset": str(int(level / self.leak_per_s * 1000)),
+        }
+
+    def _create_order(self, match, query, body, headers) -> Tuple[Any, ...]:
+        ok, rl = self._take(match.group(1))
+        if not ok:
+            return 429, {"description": "Too Many Requests"}, rl
+        with self._lock:
+            self.orders += 1
+            self.orders_by_store[match.group(1)] = self.orders_by_store.get(match.group(1), 0) + 1
+            n = self.orders
+        return 201, {"id": n}, rl
+
+    def _products(self, match, query, body, headers) -> Tuple[Any, ...]:
+        ok, rl = self._take(match.group(1))
+        if not ok:
+            return 429, {"description": "Too Many Requests"}, rl
+        page, per_page = int(query.get("page", 1)), int(query.get("per_page", 50))
+        chunk = self.products[(page - 1) * per_page: page * per_page]
+        return (200, chunk, rl) if chunk or page == 1 else (404, {"description": "Last page"}, rl)
+
+    def _token(self, match, query, body, headers) -> Tuple[int, Any]:
+        return 200, {"access_token": "stub-token", "user_id": 1}
+
+    def _stats(self, match, query, body, headers) -> Tuple[int, Any]:
+        return 200, {"orders": self.orders, "throttled": self.throttled}
+
+    def routes(self):
+        return [
+            ("POST", re.compile(r"/v1/(\w+)/orders"), self._create_order),
+            ("GET", re.compile(r"/v1/(\w+)/products"), self._products),
+            ("POST", re.compile(r"/apps/authorize/token"), self._token),
+            ("GET", re.compile(r"/_stub/stats"), self._stats),
+        ]
+
+def serve(stub: Any, port: int = 0) -> ThreadingHTTPServer:
+    handler = type("StubHandler", (_Handler,), {"config": stub.config, "routes": stub.routes()})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def start_stubs(
+    config: StubConfig, mp_port: int = 0, tn_port: int = 0, tn_rate_limit: int = 0, tn_leak_per_s: float = 2,
+) -> Tuple[MercadoPagoStub, TiendanubeStub, ThreadingHTTPServer, ThreadingHTTPServer]:
+    mp, tn = MercadoPagoStub(config), TiendanubeStub(config, rate_limit=tn_rate_limit, leak_per_s=tn_leak_per_s)
+    return mp, tn, serve(mp, mp_port), serve(tn, tn_port)
+
+def stub_env(mp_server: ThreadingHTTPServer, tn_server: ThreadingHTTPServer) -> Dict[str, str]:
+    tn_base = f"http://127.0.0.1:{tn_server.server_port}"
+    return {
+        "MP_API_BASE": f"http://127.0.0.1:{mp_server.server_port}",
+        "TN_API_BASE": f"{tn_base}/v1",
+        "TN_TOKEN_URL": f"{tn_base}/apps/authorize/token",
+    }
+
+def _main(argv: Optional[List[str]] = None) -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mp-port", type=int, default=9001)
+    ap.add_argument("--tn-port", type=int, default=9002)
+    ap.add_argument("--latency-ms", type=float, default=0)
+    ap.add_argument("--jitter-ms", type=float, default=0)
+    ap.add_argument("--error-rate", type=float, default=0)
+    ap.add_argument("--tn-rate-limit", type=int, default=0, help="bucket por tienda de TN (0 = sin límite)")
+    ap.add_argument("--tn-leak-per-s", type=float, default=2)
+    args = ap.parse_args(argv)
+    _, _, mp_server, tn_server = start_stubs(
+        StubConfig(args.latency_ms, args.jitter_ms, args.error_rate), args.mp_port, args.tn_port, args.tn_rate_limit, args.tn_leak_per_s,
+    )
+    for k, v in stub_env(mp_server, tn_server).items():
+        print(f"{k}={v}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional
+
+from db import get_db
+from rules import invalidate_rule_index
+from tn_api import get_products
+
+CATALOG_SYNC_CONCURRENCY = int(os.environ.get("CATALOG_SYNC_CONCURRENCY", "4"))
+CATALOG_PAGE_SIZE = int(os.environ.get("CATALOG_PAGE_SIZE", "200"))  # máximo que acepta TN
+PRODUCT_FIELDS = "id,categories,updated_at"
+
+# Espejo local de producto -> categorías por tienda. El RuleIndex lo usa para resolver
+# reglas de categoría sin confiar en el category_id que manda el storefront.
+_running_lock = threading.Lock()
+_running: Dict[int, bool] = {}
+
+def iter_product_pages(
+    tn_store_id: str,
+    tn_token: str,
+    updated_at_min: Optional[str] = None,
+    concurrency: int = CATALOG_SYNC_CONCURRENCY,
+    per_page: int = CATALOG_PAGE_SIZE,
+) -> Iterator[List[Dict[str, Any]]]:
+    # Ventana deslizante de `concurrency` páginas en vuelo; cada página se entrega apenas
+    # llega (no en orden), así la memoria queda acotada a concurrency * per_page.
+    def fetch(page: int) -> List[Dict[str, Any]]:
+        return get_products(tn_store_id, tn_token, page=page, per_page=per_page, updated_at_min=updated_at_min, fields=PRODUCT_FIELDS)
+
+    ex = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="catalog")
+    try:
+        pending: Dict[Future, int] = {}
+        next_page = 1
+        last_page: Optional[int] = None
+        for _ in range(concurrency):
+            pending[ex.submit(fetch, next_page)] = next_page
+            next_page += 1
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for f in finished:
+                page = pending.pop(f)
+                products = f.result()
+                if len(products) < per_page and (last_page is None or page < last_page):
+                    last_page = page
+                if products:
+                    yield products
+                if last_page is None:
+                    pending[ex.submit(fetch, next_page)] = next_page
+                    next_page += 1
+    finally:
+        ex.shutdown(wait=True, cancel_futures=True)
+
+def _category_ids(product: Dict[str, Any]) -> List[str]:
+    out = []
+    for c in product.get("categories") or []:
+        cid = c.get("id") if isinstance(c, dict) else c
+        if cid is not None:
+            out.append(str(cid))
+    return out
+
+def _write_page(store_id: int, products: List[Dict[str, Any]], synced_at: float) -> Optional[str]:
+    ids = [str(p["id"]) for p in products]
+    links = [(store_id, str(p["id"]), cid) for p in products for cid in _category_ids(p)]
+    with get_db() as db:
+        db.executemany(
+            "INSERT INTO catalog_products (store_id, product_id, updated_at, synced_at) VALUES (?,?,?,?) "
+            "ON CONFLICT(store_id, product_id) DO UPDATE SET updated_at=excluded.updated_at, synced_at=excluded.synced_at",
+            [(store_id, str(p["id"]), p.get("updated_at"), synced_at) for p in products],
+        )
+        db.executemany(
+            "DELETE FROM catalog_product_categories WHERE store_id=? AND product_id=?",
+            [(store_id, pid) for pid in ids],
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO catalog_product_categories (store_id, product_id, category_id) VALUES (?,?,?)",
+            links,
+        )
+    updated = [p.get("updated_at") for p in products if p.get("updated_at")]
+    return max(updated) if updated else None
+
+def sync_store(store: Dict[str, Any], full: bool = False) -> Dict[str, Any]:
+    store_id = int(store["id"])
+    with _running_lock:
+        if _running.get(store_id):
+            return {"status": "already_running"}
+        _running[store_id] = True
+
+    try:
+        with get_db() as db:
+            state = db.execute(
+                "SELECT last_updated_at FROM catalog_sync_state WHERE store_id=?", (store_id,)
+            ).fetchone()
+        since = None if full or not state else state["last_updated_at"]
+
+        started = time.time()
+        watermark = since
+        count = 0
+        for products in iter_product_pages(store["tn_store_id"], store["tn_access_token"], updated_at_min=since):
+            page_max = _write_page(store_id, products, started)
+            if page_max and (watermark is None or page_max > watermark):
+                watermark = page_max
+            count += len(products)
+
+        with get_db() as db:
+            if since is None:
+                # Sync completa: lo que no vino ya no existe en la tienda.
+                db.execute("DELETE FROM catalog_product_categories WHERE store_id=? AND product_id IN "
+                           "(SELECT product_id FROM catalog_products WHERE store_id=? AND synced_at < ?)",
+                           (store_id, store_id, started))
+                db.execute("DELETE FROM catalog_products WHERE store_id=? AND synced_at < ?", (store_id, started))
+            db.execute(
+                "INSERT INTO catalog_sync_state (store_id, last_updated_at, last_synced_at, last_full_sync_at, last_count) "
+                "VALUES (?,?,datetime('now'),CASE WHEN ? THEN datetime('now') END,?) "
+                "ON CONFLICT(store_id) DO UPDATE SET last_updated_at=excluded.last_updated_at, last_synced_at=excluded.last_synced_at, "
+                "last_full_sync_at=COALESCE(excluded.last_full_sync_at, catalog_sync_state.last_full_sync_at), last_count=excluded.last_count",
+                (store_id, watermark, since is None, count),
+            )
+        invalidate_rule_index(store_id)
+        return {"status": "ok", "full": since is None, "products": count, "last_updated_at": watermark}
+    finally:
+        with _running_lock:
+            _running.pop(store_id, None)
+
+def sync_state(store_id: int) -> Optional[Dict[str, Any]]:
+    with get_db() as db:
+        row = db.execute(
+            "SELECT last_updated_at, last_synced_at, last_full_sync_at, last_count FROM catalog_sync_state WHERE store_id=?",
+            (store_id,),
+        ).fetchone()
+        return dict(row) if row else None
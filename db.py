@@ -1,13 +1,41 @@
+import asyncio
+import contextvars
+import functools
 import os
+import queue
 import sqlite3
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Generator
+from typing import Any, Callable, Generator, List, Optional, Tuple, TypeVar
 
 DB_PATH = os.environ.get("DB_PATH", "app.db")
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_SIZE_KB", "16384"))
+DB_STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", "256"))
+DB_EXECUTOR_WORKERS = int(os.environ.get("DB_EXECUTOR_WORKERS", "8"))
+DB_WRITER_BATCH = int(os.environ.get("DB_WRITER_BATCH", "64"))
 
-SCHEMA = """
-PRAGMA foreign_keys = ON;
+T = TypeVar("T")
+
+# Se aplican una sola vez, al abrir cada conexión.
+# auto_vacuum va primero: solo tiene efecto en una base nueva (antes de que WAL escriba
+# el header) y habilita el incremental_vacuum de retention.py. En una base existente no
+# hace nada hasta un VACUUM (ver retention.enable_incremental_vacuum).
+# WAL: los lectores no se bloquean con el writer; synchronous=NORMAL es seguro con WAL.
+CONNECTION_PRAGMAS = (
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}",
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = ON",
+)
 
+SCHEMA = """
 CREATE TABLE IF NOT EXISTS stores (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   tn_store_id TEXT UNIQUE NOT NULL,
@@ -54,16 +82,476 @@ CREATE TABLE IF NOT EXISTS split_payments (
 );
 """
 
+# Índices para las queries del hot path (webhook, rule index, listados por tienda).
+INDEXES_V2 = """
+CREATE INDEX IF NOT EXISTS idx_split_payments_split_group ON split_payments(split_id, group_key);
+CREATE INDEX IF NOT EXISTS idx_rules_store_active ON rules(store_id, active);
+CREATE INDEX IF NOT EXISTS idx_splits_store_status ON splits(store_id, status);
+"""
+
+OUTBOX_V3 = """
+CREATE TABLE IF NOT EXISTS outbox (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,
+  dedupe_key TEXT NOT NULL,
+  payload_json TEXT NOT NULL,
+  status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending','processing','done','dead')),
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_attempt_at REAL NOT NULL DEFAULT 0,
+  last_error TEXT,
+  created_at TEXT DEFAULT (datetime('now')),
+  updated_at TEXT DEFAULT (datetime('now')),
+  UNIQUE(kind, dedupe_key)
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox(status, next_attempt_at);
+"""
+
+PROCESSED_EVENTS_V4 = """
+CREATE TABLE IF NOT EXISTS processed_events (
+  payment_id TEXT NOT NULL,
+  status TEXT NOT NULL,
+  processed_at TEXT DEFAULT (datetime('now')),
+  PRIMARY KEY (payment_id, status)
+) WITHOUT ROWID;
+"""
+
+CATALOG_V5 = """
+CREATE TABLE IF NOT EXISTS catalog_products (
+  store_id INTEGER NOT NULL,
+  product_id TEXT NOT NULL,
+  updated_at TEXT,
+  synced_at REAL NOT NULL,
+  PRIMARY KEY (store_id, product_id),
+  FOREIGN KEY(store_id) REFERENCES stores(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS catalog_product_categories (
+  store_id INTEGER NOT NULL,
+  product_id TEXT NOT NULL,
+  category_id TEXT NOT NULL,
+  PRIMARY KEY (store_id, product_id, category_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_catalog_categories_category ON catalog_product_categories(store_id, category_id);
+CREATE TABLE IF NOT EXISTS catalog_sync_state (
+  store_id INTEGER PRIMARY KEY,
+  last_updated_at TEXT,
+  last_synced_at TEXT,
+  last_full_sync_at TEXT,
+  last_count INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY(store_id) REFERENCES stores(id) ON DELETE CASCADE
+);
+"""
+
+# Splits normalizados: cart_json/groups_json duplicaban cada item y obligaban a parsear
+# el JSON completo en cada lectura. Los grupos guardan el subtotal precalculado; los
+# items existentes se migran con json_each y después se borran las columnas de blobs.
+SPLIT_ITEMS_V6 = """
+CREATE TABLE IF NOT EXISTS split_groups (
+  split_id TEXT NOT NULL,
+  group_key TEXT NOT NULL,
+  max_installments INTEGER NOT NULL,
+  subtotal INTEGER NOT NULL DEFAULT 0,
+  item_count INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (split_id, group_key),
+  FOREIGN KEY(split_id) REFERENCES splits(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS split_items (
+  split_id TEXT NOT NULL,
+  line INTEGER NOT NULL,
+  group_key TEXT NOT NULL,
+  product_id TEXT,
+  variant_id TEXT,
+  name TEXT,
+  quantity INTEGER NOT NULL,
+  price INTEGER NOT NULL,
+  PRIMARY KEY (split_id, line),
+  FOREIGN KEY(split_id) REFERENCES splits(id) ON DELETE CASCADE
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO split_groups (split_id, group_key, max_installments, subtotal, item_count)
+SELECT s.id, g.key,
+       CAST(COALESCE(json_extract(g.value, '$.max_installments'), 0) AS INTEGER),
+       CAST(COALESCE(json_extract(g.value, '$.subtotal'), 0) AS INTEGER),
+       COALESCE(json_array_length(g.value, '$.items'), 0)
+FROM splits s, json_each(s.groups_json) g;
+INSERT OR IGNORE INTO split_items (split_id, line, group_key, product_id, variant_id, name, quantity, price)
+SELECT s.id, ROW_NUMBER() OVER (PARTITION BY s.id ORDER BY g.id, i.id), g.key,
+       json_extract(i.value, '$.product_id'), json_extract(i.value, '$.variant_id'), json_extract(i.value, '$.name'),
+       CAST(COALESCE(json_extract(i.value, '$.quantity'), 1) AS INTEGER),
+       CAST(COALESCE(json_extract(i.value, '$.price'), 0) AS INTEGER)
+FROM splits s, json_each(s.groups_json) g, json_each(g.value, '$.items') i;
+ALTER TABLE splits DROP COLUMN cart_json;
+ALTER TABLE splits DROP COLUMN groups_json;
+"""
+
+# Agregados por tienda para el dashboard, mantenidos al crear y completar splits (ver
+# main._insert_splits y _apply_payment_status). gmv = subtotales + envío de los splits
+# completados. idx_rules_store permite paginar las reglas de una tienda por id.
+DASHBOARD_V7 = """
+CREATE TABLE IF NOT EXISTS store_split_stats (
+  store_id INTEGER PRIMARY KEY,
+  splits_total INTEGER NOT NULL DEFAULT 0,
+  splits_completed INTEGER NOT NULL DEFAULT 0,
+  gmv INTEGER NOT NULL DEFAULT 0,
+  FOREIGN KEY(store_id) REFERENCES stores(id) ON DELETE CASCADE
+);
+INSERT OR REPLACE INTO store_split_stats (store_id, splits_total, splits_completed, gmv)
+SELECT s.store_id, COUNT(*), SUM(s.status = 'completed'),
+       COALESCE(SUM(CASE WHEN s.status = 'completed' THEN
+         s.shipping_cost + (SELECT COALESCE(SUM(g.subtotal), 0) FROM split_groups g WHERE g.split_id = s.id)
+       END), 0)
+FROM splits s GROUP BY s.store_id;
+CREATE INDEX IF NOT EXISTS idx_rules_store ON rules(store_id);
+"""
+
+# Versión por split, incrementada en cada cambio (envío, links de pago, webhook): es el
+# ETag de las vistas del split y la clave del cache de HTML renderizado.
+SPLIT_VERSION_V8 = """
+ALTER TABLE splits ADD COLUMN version INTEGER NOT NULL DEFAULT 1;
+"""
+
+# Configuración por tienda del planner (ver planner.py): tramos de cuotas ("18,12,6,3"),
+# costos de envío por método (JSON) y monto mínimo por cuota. NULL/0 = valores por defecto.
+STORE_SETTINGS_V9 = """
+ALTER TABLE stores ADD COLUMN installment_tiers TEXT;
+ALTER TABLE stores ADD COLUMN shipping_rates_json TEXT;
+ALTER TABLE stores ADD COLUMN min_installment_amount INTEGER NOT NULL DEFAULT 0;
+"""
+
+# Conciliación de pagos (ver reconcile.py): cuándo se consultó por última vez a MP un
+# pago que sigue pendiente, y el índice para encontrar los pendientes viejos sin scan.
+RECONCILE_V10 = """
+ALTER TABLE split_payments ADD COLUMN reconciled_at REAL;
+CREATE INDEX IF NOT EXISTS idx_split_payments_status_created ON split_payments(status, created_at);
+"""
+
+# Retención (ver retention.py): dónde quedó cada split archivado (segmento .jsonl.gz y
+# offset del miembro gzip que lo contiene), un lease para que un solo proceso corra la
+# limpieza a la vez y el índice para encontrar splits viejos por estado.
+RETENTION_V11 = """
+CREATE TABLE IF NOT EXISTS archived_splits (
+  split_id TEXT PRIMARY KEY,
+  store_id INTEGER NOT NULL,
+  segment TEXT NOT NULL,
+  member_offset INTEGER NOT NULL,
+  created_at TEXT,
+  archived_at TEXT DEFAULT (datetime('now'))
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS maintenance_leases (
+  name TEXT PRIMARY KEY,
+  owner TEXT NOT NULL,
+  expires_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_splits_status_created ON splits(status, created_at);
+"""
+
+# Vencimiento de cada link de pago de MP. NULL = sin vencimiento (o generado antes de
+# esta migración): retention nunca borra un split con un link que se puede pagar.
+PREFERENCE_EXPIRY_V12 = """
+ALTER TABLE split_payments ADD COLUMN preference_expires_at TEXT;
+"""
+
+# Retención de processed_events por antigüedad (ver retention.py).
+PROCESSED_EVENTS_TTL_V13 = """
+CREATE INDEX IF NOT EXISTS idx_processed_events_processed_at ON processed_events(processed_at);
+"""
+
+# Versión de las reglas de cada tienda: la incrementa invalidate_rule_index() y cada
+# proceso la compara con la de su RuleIndex en cache (ver rules.py).
+RULES_VERSION_V14 = """
+ALTER TABLE stores ADD COLUMN rules_version INTEGER NOT NULL DEFAULT 0;
+"""
+
+# Migraciones versionadas: se aplican en orden en init_db() y nunca se editan una vez
+# publicadas; para cambiar el schema se agrega una nueva al final.
+MIGRATIONS: List[Tuple[int, str]] = [
+    (1, SCHEMA),
+    (2, INDEXES_V2),
+    (3, OUTBOX_V3),
+    (4, PROCESSED_EVENTS_V4),
+    (5, CATALOG_V5),
+    (6, SPLIT_ITEMS_V6),
+    (7, DASHBOARD_V7),
+    (8, SPLIT_VERSION_V8),
+    (9, STORE_SETTINGS_V9),
+    (10, RECONCILE_V10),
+    (11, RETENTION_V11),
+    (12, PREFERENCE_EXPIRY_V12),
+    (13, PROCESSED_EVENTS_TTL_V13),
+    (14, RULES_VERSION_V14),
+]
+
+# Hook de timing de queries: (sql, elapsed_s, error). Mide execute/executemany (para
+# un SELECT, hasta la primera fila; el fetch posterior no entra).
+QueryHook = Callable[[str, float, Optional[BaseException]], None]
+_query_hooks: List[QueryHook] = []
+
+def add_query_hook(hook: QueryHook) -> None:
+    _query_hooks.append(hook)
+
+def remove_query_hook(hook: QueryHook) -> None:
+    if hook in _query_hooks:
+        _query_hooks.remove(hook)
+
+def _emit_query(sql: str, elapsed: float, error: Optional[BaseException]) -> None:
+    for hook in list(_query_hooks):
+        try:
+            hook(sql, elapsed, error)
+        except Exception:
+            pass
+
+class _Connection(sqlite3.Connection):
+    # Sin hooks registrados el costo es un chequeo de lista vacía por query.
+    def execute(self, sql, parameters=(), /):
+        if not _query_hooks:
+            return super().execute(sql, parameters)
+        start = time.perf_counter()
+        try:
+            cur = super().execute(sql, parameters)
+        except Exception as e:
+            _emit_query(sql, time.perf_counter() - start, e)
+            raise
+        _emit_query(sql, time.perf_counter() - start, None)
+        return cur
+
+    def executemany(self, sql, seq_of_parameters, /):
+        if not _query_hooks:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            cur = super().executemany(sql, seq_of_parameters)
+        except Exception as e:
+            _emit_query(sql, time.perf_counter() - start, e)
+            raise
+        _emit_query(sql, time.perf_counter() - start, None)
+        return cur
+
+# Pool de conexiones: una conexión persistente por thread (el threadpool de FastAPI
+# es acotado, así que el pool también). Cada conexión reusa sus prepared statements
+# vía cached_statements. Los threads de anyio se descartan tras un rato ociosos: la
+# conexión se cierra cuando muere su thread (ver _ThreadToken), no queda en _conns.
+_local = threading.local()
+_conns_lock = threading.Lock()
+_conns: List[sqlite3.Connection] = []
+_epoch = 0  # close_db() lo incrementa para que cada thread reabra su conexión
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False,  # solo para poder cerrarlas desde close_db()
+        factory=_Connection,
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    with _conns_lock:
+        _conns.append(conn)
+    # El token vive solo en el threading.local: al terminar el thread se libera y el
+    # finalizer cierra la conexión.
+    _local.token = _ThreadToken()
+    weakref.finalize(_local.token, _release, conn)
+    return conn
+
+class _ThreadToken:
+    pass
+
+def _release(conn: sqlite3.Connection):
+    with _conns_lock:
+        if conn in _conns:
+            _conns.remove(conn)
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+def _discard(conn: sqlite3.Connection):
+    _local.conn = None
+    _release(conn)
+
 @contextmanager
 def get_db() -> Generator[sqlite3.Connection, None, None]:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.epoch != _epoch:
+        conn = _local.conn = _connect()
+        _local.epoch = _epoch
+        _local.depth = 0
+
+    # Reentrante: un get_db() anidado en el mismo thread comparte la transacción
+    # y solo el más externo hace commit/rollback.
+    depth = _local.depth
+    if depth == 0:
+        _local.after_commit = []
+    _local.depth = depth + 1
     try:
         yield conn
-        conn.commit()
+        if depth == 0:
+            conn.commit()
+    except BaseException:
+        if depth == 0:
+            _local.after_commit = []
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                _discard(conn)
+        raise
     finally:
-        conn.close()
+        _local.depth = depth
+    if depth == 0:
+        callbacks, _local.after_commit = _local.after_commit, []
+        for fn in callbacks:
+            fn()
+
+def after_commit(fn: Callable[[], Any]) -> None:
+    # Efectos que solo tienen sentido con los cambios ya visibles (eventos, caches en
+    # memoria, despertar workers): corren tras el commit del get_db() más externo y se
+    # descartan si hace rollback. Fuera de una transacción corre en el momento.
+    if getattr(_local, "depth", 0) == 0:
+        fn()
+    else:
+        _local.after_commit.append(fn)
+
+# Acceso no bloqueante para endpoints async: el trabajo de DB corre fuera del event loop
+# y el loop queda libre mientras sqlite espera locks o disco. Las lecturas van a un pool
+# de threads (cada uno con su conexión del pool de arriba); las escrituras a un único
+# thread writer: con varios threads escribiendo compiten por el lock y el busy handler
+# de sqlite los duerme, y el throughput cae muy por debajo de escribir inline.
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+    return _executor
+
+async def run_db(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    # Solo lectura. fn abre su propio get_db(); todo lo que haga corre en un único
+    # thread, así que una función = una transacción.
+    # Se copia el contexto (como asyncio.to_thread) para que los contextvars del request,
+    # p.ej. el label de tienda de metrics, lleguen al thread.
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_get_executor(), functools.partial(ctx.run, fn, *args, **kwargs))
+
+# Group commit: el writer toma todas las escrituras encoladas (hasta DB_WRITER_BATCH) y
+# las corre en una sola transacción, cada una en su SAVEPOINT: un job que falla deshace
+# solo lo suyo. Un commit por lote en lugar de uno por request es lo que le gana a
+# escribir inline; los efectos post-commit de cada job van por after_commit().
+_write_queue: "Optional[queue.SimpleQueue[Any]]" = None
+_writer_thread: Optional[threading.Thread] = None
+
+def _get_write_queue() -> "queue.SimpleQueue[Any]":
+    global _write_queue, _writer_thread
+    if _write_queue is None:
+        with _executor_lock:
+            if _write_queue is None:
+                q: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+                _writer_thread = threading.Thread(target=_writer_loop, args=(q,), name="db-writer", daemon=True)
+                _writer_thread.start()
+                _write_queue = q
+    return _write_queue
+
+def _writer_loop(q: "queue.SimpleQueue[Any]") -> None:
+    while True:
+        job = q.get()
+        batch = []
+        while job is not None:
+            batch.append(job)
+            if len(batch) >= DB_WRITER_BATCH:
+                break
+            try:
+                job = q.get_nowait()
+            except queue.Empty:
+                break
+        if batch:
+            _write_batch(batch)
+        if job is None:
+            return
+
+def _write_batch(batch: List[Tuple[Any, ...]]) -> None:
+    done: List[Tuple[Future, Any, Optional[BaseException]]] = []
+    try:
+        with get_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for fut, ctx, fn, args, kwargs in batch:
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT write_job")
+                mark = len(_local.after_commit)
+                try:
+                    result = ctx.run(fn, *args, **kwargs)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write_job")
+                    conn.execute("RELEASE write_job")
+                    del _local.after_commit[mark:]
+                    done.append((fut, None, e))
+                else:
+                    conn.execute("RELEASE write_job")
+                    done.append((fut, result, None))
+    except Exception as e:
+        # Falló el lote entero (lock, disco, commit): nada quedó escrito.
+        for fut, *_ in batch:
+            if fut.running() or fut.set_running_or_notify_cancel():
+                fut.set_exception(e)
+        return
+    for fut, result, exc in done:
+        if exc is None:
+            fut.set_result(result)
+        else:
+            fut.set_exception(exc)
+
+async def run_db_write(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    # Como run_db, para funciones que escriben: corren en el thread writer, dentro de
+    # la transacción de su lote (los get_db() de fn quedan anidados).
+    fut: Future = Future()
+    _get_write_queue().put((fut, contextvars.copy_context(), fn, args, kwargs))
+    return await asyncio.wrap_future(fut)
+
+def close_db():
+    global _epoch, _executor, _write_queue, _writer_thread
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+        if _write_queue is not None:
+            _write_queue.put(None)
+            _writer_thread.join()
+            _write_queue = _writer_thread = None
+    with _conns_lock:
+        _epoch += 1
+        conns = list(_conns)
+        _conns.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    _local.conn = None
+
+def _statements(script: str) -> List[str]:
+    return [stmt.strip() for stmt in script.split(";") if stmt.strip()]
+
+def schema_version(db: sqlite3.Connection) -> int:
+    row = db.execute("SELECT COALESCE(MAX(version), 0) AS v FROM schema_version").fetchone()
+    return int(row["v"])
 
 def init_db():
     with get_db() as db:
-        db.executescript(SCHEMA)
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, applied_at TEXT DEFAULT (datetime('now')))"
+        )
+
+    # BEGIN IMMEDIATE toma el lock de escritura antes de leer la versión, así dos
+    # workers arrancando a la vez no aplican la misma migración dos veces.
+    with get_db() as db:
+        db.execute("BEGIN IMMEDIATE")
+        current = schema_version(db)
+        for version, script in MIGRATIONS:
+            if version <= current:
+                continue
+            for stmt in _statements(script):
+                db.execute(stmt)
+            db.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
@@ -0,0 +1,70 @@
+import os
+import sqlite3
+import threading
+from typing import Dict
+
+from cache import TTLCache
+from db import get_db
+
+DEDUPE_TTL_S = float(os.environ.get("DEDUPE_TTL_S", "900"))
+DEDUPE_CACHE_SIZE = int(os.environ.get("DEDUPE_CACHE_SIZE", "50000"))
+DEDUPE_APPROVED_TTL_S = float(os.environ.get("DEDUPE_APPROVED_TTL_S", "10"))  # 0 = no cortar approved
+
+# Estados de MP después de los cuales no volvemos a consultar el pago: las
+# notificaciones siguientes para ese payment_id se descartan sin llamar a MP.
+# approved no está: después pueden llegar refunded o charged_back.
+SETTLED_STATUSES = frozenset({"rejected", "cancelled", "refunded", "charged_back"})
+
+# Dedupe de notificaciones de MP en dos niveles, por (payment_id, status):
+#  - antes de get_payment: si el pago ya llegó a un estado final (cache TTL y, si no
+#    está, la tabla processed_events) se corta sin tocar la API. Un approved recién
+#    procesado solo se corta en memoria y por DEDUPE_APPROVED_TTL_S, para absorber la
+#    ráfaga de notificaciones repetidas sin perder un reembolso posterior.
+#  - después de get_payment: si ese (payment_id, status) ya se procesó, no se vuelve a
+#    escribir ni a encolar la orden.
+_settled = TTLCache(DEDUPE_TTL_S, DEDUPE_CACHE_SIZE)
+_lock = threading.Lock()
+_suppressed: Dict[str, int] = {"before_fetch": 0, "after_fetch": 0}
+
+def _count(stage: str) -> None:
+    with _lock:
+        _suppressed[stage] += 1
+
+def is_settled(payment_id: str) -> bool:
+    if _settled.get(payment_id) is not None:
+        _count("before_fetch")
+        return True
+    with get_db() as db:
+        rows = db.execute("SELECT status FROM processed_events WHERE payment_id=?", (payment_id,)).fetchall()
+    for r in rows:
+        if r["status"] in SETTLED_STATUSES:
+            _settled.set(payment_id, r["status"])
+            _count("before_fetch")
+            return True
+    return False
+
+def record(db: sqlite3.Connection, payment_id: str, status: str) -> bool:
+    # Devuelve False si el evento ya estaba procesado. Va en la misma transacción que
+    # la actualización del pago, así un rollback no deja el evento marcado.
+    cur = db.execute(
+        "INSERT OR IGNORE INTO processed_events (payment_id, status) VALUES (?,?)",
+        (payment_id, status),
+    )
+    if not cur.rowcount:
+        _count("after_fetch")
+        return False
+    return True
+
+def remember(payment_id: str, status: str) -> None:
+    # Llamar después del commit.
+    if status in SETTLED_STATUSES:
+        _settled.set(payment_id, status)
+    elif status == "approved" and DEDUPE_APPROVED_TTL_S > 0:
+        _settled.set(payment_id, status, ttl=DEDUPE_APPROVED_TTL_S)
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        out = {f"suppressed_{k}": v for k, v in _suppressed.items()}
+    out["suppressed_total"] = out["suppressed_before_fetch"] + out["suppressed_after_fetch"]
+    out.update({f"cache_{k}": v for k, v in _settled.stats().items()})
+    return out
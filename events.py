@@ -0,0 +1,76 @@
+import asyncio
+import os
+import threading
+from typing import Any, Dict, List
+
+EVENTS_QUEUE_SIZE = int(os.environ.get("EVENTS_QUEUE_SIZE", "16"))
+
+# Pub/sub en proceso para los cambios de estado de un split. Los suscriptores son los
+# streams SSE (viven en el event loop); se publica desde cualquier thread (webhook en
+# run_db, generate_payments en el threadpool). Con varios workers cada uno tiene su
+# propio bus: el endpoint SSE compensa releyendo el estado cada tanto.
+
+class Subscription:
+    def __init__(self, split_id: str, loop: asyncio.AbstractEventLoop):
+        self.split_id = split_id
+        self.loop = loop
+        self.queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE)
+
+    def _put(self, event: Dict[str, Any]) -> None:
+        # Corre en el loop del suscriptor. Si el cliente no consume, se descarta el
+        # evento más viejo: cada evento es un snapshot completo, el último alcanza.
+        if self.queue.full():
+            self.queue.get_nowait()
+            _count("dropped")
+        self.queue.put_nowait(event)
+
+    async def get(self) -> Dict[str, Any]:
+        return await self.queue.get()
+
+_lock = threading.Lock()
+_subs: Dict[str, List[Subscription]] = {}
+_counters: Dict[str, int] = {"published": 0, "delivered": 0, "dropped": 0}
+
+def _count(key: str, n: int = 1) -> None:
+    with _lock:
+        _counters[key] += n
+
+def subscribe(split_id: str) -> Subscription:
+    sub = Subscription(split_id, asyncio.get_running_loop())
+    with _lock:
+        _subs.setdefault(split_id, []).append(sub)
+    return sub
+
+def unsubscribe(sub: Subscription) -> None:
+    with _lock:
+        subs = _subs.get(sub.split_id)
+        if subs and sub in subs:
+            subs.remove(sub)
+            if not subs:
+                del _subs[sub.split_id]
+
+def has_subscribers(split_id: str) -> bool:
+    return split_id in _subs
+
+def publish(split_id: str, event: Dict[str, Any]) -> int:
+    with _lock:
+        subs = list(_subs.get(split_id, ()))
+        _counters["published"] += 1
+    delivered = 0
+    for sub in subs:
+        try:
+            sub.loop.call_soon_threadsafe(sub._put, event)
+            delivered += 1
+        except RuntimeError:
+            # Loop cerrado (shutdown): el stream ya no existe.
+            unsubscribe(sub)
+    if delivered:
+        _count("delivered", delivered)
+    return delivered
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        out = dict(_counters)
+        out["splits"] = len(_subs)
+        out["subscribers"] = sum(len(s) for s in _subs.values())
+    return out
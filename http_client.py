@@ -0,0 +1,145 @@
+import asyncio
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AbstractSet, Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", "4"))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "32"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "30"))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_BASE = float(os.environ.get("HTTP_BACKOFF_BASE", "0.25"))
+HTTP_BACKOFF_MAX = float(os.environ.get("HTTP_BACKOFF_MAX", "8"))
+HTTP_ASYNC_WORKERS = int(os.environ.get("HTTP_ASYNC_WORKERS", "32"))
+
+T = TypeVar("T")
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+# Hook de timing: (call, status, elapsed_s, error). status es None si no hubo respuesta.
+# Se llama una vez por intento, incluidos los reintentos.
+TimingHook = Callable[[str, Optional[int], float, Optional[BaseException]], None]
+_hooks: List[TimingHook] = []
+
+# Una Session por servicio (mp, tn, ...): keep-alive y pool de conexiones por host
+# compartido entre threads.
+_sessions_lock = threading.Lock()
+_sessions: Dict[str, requests.Session] = {}
+
+def add_timing_hook(hook: TimingHook) -> None:
+    _hooks.append(hook)
+
+def remove_timing_hook(hook: TimingHook) -> None:
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+def _emit(call: str, status: Optional[int], elapsed: float, error: Optional[BaseException]) -> None:
+    for hook in list(_hooks):
+        try:
+            hook(call, status, elapsed, error)
+        except Exception:
+            pass
+
+def get_session(service: str) -> requests.Session:
+    session = _sessions.get(service)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _sessions.get(service)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[service] = session
+        return session
+
+# Las variantes async de mp_api (las que usan las rutas async) corren el cliente sync en
+# este pool, así comparten sessions, retries y hooks con el resto del código.
+_executor: Optional[ThreadPoolExecutor] = None
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _sessions_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=HTTP_ASYNC_WORKERS, thread_name_prefix="http")
+    return _executor
+
+async def run_io(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_get_executor(), functools.partial(ctx.run, fn, *args, **kwargs))
+
+def close_sessions() -> None:
+    global _executor
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+    for session in sessions:
+        session.close()
+
+def _backoff(attempt: int, retry_after: Optional[str]) -> float:
+    if retry_after:
+        try:
+            return min(HTTP_BACKOFF_MAX, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    # Full jitter: uniforme entre 0 y el techo exponencial.
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+def request(
+    service: str,
+    method: str,
+    url: str,
+    call: Optional[str] = None,
+    idempotent: Optional[bool] = None,
+    timeout: Optional[Tuple[float, float]] = None,
+    retry_statuses: AbstractSet[int] = RETRY_STATUSES,
+    **kwargs,
+) -> requests.Response:
+    # Solo se reintentan llamadas idempotentes (por defecto según el método), ante
+    # errores de conexión/timeout o status 429/5xx. La última respuesta se devuelve
+    # tal cual: el caller decide con raise_for_status(). retry_statuses permite que el
+    # caller maneje algún status por su cuenta (tn_api se queda con los 429).
+    method = method.upper()
+    call = call or f"{service}.{method.lower()}"
+    if idempotent is None:
+        idempotent = method in IDEMPOTENT_METHODS
+    attempts = 1 + (HTTP_MAX_RETRIES if idempotent else 0)
+    timeout = timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    session = get_session(service)
+
+    for attempt in range(attempts):
+        last = attempt + 1 >= attempts
+        start = time.perf_counter()
+        try:
+            r = session.request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            _emit(call, None, time.perf_counter() - start, e)
+            if last:
+                raise
+            time.sleep(_backoff(attempt, None))
+            continue
+
+        _emit(call, r.status_code, time.perf_counter() - start, None)
+        if r.status_code in retry_statuses and not last:
+            delay = _backoff(attempt, r.headers.get("Retry-After"))
+            r.close()
+            time.sleep(delay)
+            continue
+        return r
+
+    raise RuntimeError("unreachable")
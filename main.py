@@ -1,99 +1,216 @@
-import os, json, uuid
-from typing import Any, Dict, List, Optional
+import asyncio, os, json, uuid, zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
-from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, PlainTextResponse
+from fastapi import FastAPI, Request, Form, HTTPException, BackgroundTasks
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, PlainTextResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from dotenv import load_dotenv
-
-from db import init_db, get_db
+from requests import HTTPError
+
+from cache import TTLCache
+from db import init_db, get_db, close_db, run_db, run_db_write, after_commit, add_query_hook
+from http_client import close_sessions, add_timing_hook
+import metrics
+import events
+import outbox
+import dedupe
+import store_cache
+import catalog
+import planner
+import reconcile
+import retention
+import tn_api
 from tn_api import exchange_code_for_token, create_order
-from mp_api import create_preference, get_payment
+from mp_api import create_preference, expiration_fields, get_payment_async, preference_expires_at
+from rules import RuleIndex, get_rule_index, invalidate_rule_index
 
 load_dotenv()
 
 app = FastAPI(title="SplitPay MVP")
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
+app.add_middleware(metrics.MetricsMiddleware)
+add_timing_hook(metrics.observe_upstream)
+add_query_hook(metrics.observe_query)
+tn_api.add_wait_hook(metrics.observe_tn_wait)
 
 APP_BASE_URL = os.environ.get("APP_BASE_URL", "http://localhost:8000")
 TN_CLIENT_ID = os.environ.get("TN_CLIENT_ID", "")
 TN_CLIENT_SECRET = os.environ.get("TN_CLIENT_SECRET", "")
 MP_ACCESS_TOKEN_DEFAULT = os.environ.get("MP_ACCESS_TOKEN_DEFAULT", "")
 APP_ADMIN_KEY = os.environ.get("APP_ADMIN_KEY", "BRKN2026")
+MP_PREFERENCE_WORKERS = int(os.environ.get("MP_PREFERENCE_WORKERS", "8"))  # por request
+PLAN_BATCH_MAX_CARTS = int(os.environ.get("PLAN_BATCH_MAX_CARTS", "20000"))
+DASHBOARD_PAGE_SIZE = int(os.environ.get("DASHBOARD_PAGE_SIZE", "50"))
+SSE_KEEPALIVE_S = float(os.environ.get("SSE_KEEPALIVE_S", "15"))
+SSE_RESYNC_S = float(os.environ.get("SSE_RESYNC_S", "5"))
+SSE_MAX_S = float(os.environ.get("SSE_MAX_S", "600"))
+SPLIT_PAGE_CACHE_SIZE = int(os.environ.get("SPLIT_PAGE_CACHE_SIZE", "2000"))
+SPLIT_PAGE_CACHE_TTL_S = float(os.environ.get("SPLIT_PAGE_CACHE_TTL_S", "600"))
+
+# HTML renderizado de las vistas del split, por (vista, split_id, version).
+_split_pages = TTLCache(SPLIT_PAGE_CACHE_TTL_S, SPLIT_PAGE_CACHE_SIZE)
 
 @app.on_event("startup")
 def _startup():
     init_db()
+    outbox.register_handler("tn_order", _process_tn_order_job)
+    outbox.start_workers()
+    reconcile.set_applier(_apply_payment_statuses)
+    reconcile.start(MP_ACCESS_TOKEN_DEFAULT)
+    retention.start()
+
+@app.on_event("shutdown")
+def _shutdown():
+    outbox.stop_workers()
+    reconcile.stop()
+    retention.stop()
+    close_sessions()
+    close_db()
 
 def _require_admin(admin_key: str):
     if admin_key != APP_ADMIN_KEY:
         raise HTTPException(status_code=401, detail="admin_key inválida")
 
 def _get_store_by_tn_store_id(tn_store_id: str) -> Optional[Dict[str, Any]]:
-    with get_db() as db:
-        row = db.execute("SELECT * FROM stores WHERE tn_store_id = ?", (tn_store_id,)).fetchone()
-        return dict(row) if row else None
+    metrics.tag_store(tn_store_id)
+    return store_cache.get_by_tn_store_id(tn_store_id)
 
 def _get_store_by_internal_id(store_id: int) -> Dict[str, Any]:
-    with get_db() as db:
-        row = db.execute("SELECT * FROM stores WHERE id = ?", (store_id,)).fetchone()
-        if not row:
-            raise HTTPException(404, "store no encontrada")
-        return dict(row)
-
-def _get_active_rules(store_id: int) -> List[Dict[str, Any]]:
-    with get_db() as db:
-        rows = db.execute(
-            "SELECT * FROM rules WHERE store_id = ? AND active = 1",
-            (store_id,),
-        ).fetchall()
-        return [dict(r) for r in rows]
-
-def _pick_rule_for_item(active_rules: List[Dict[str, Any]], item: Dict[str, Any]) -> int:
-    # Prioridad: product > category > global
-    product_id = str(item.get("product_id") or "")
-    category_id = str(item.get("category_id") or "")
-
-    for r in active_rules:
-        if r["scope"] == "product" and (r["reference_id"] or "") == product_id:
-            return int(r["max_installments"])
-
-    for r in active_rules:
-        if r["scope"] == "category" and (r["reference_id"] or "") == category_id:
-            return int(r["max_installments"])
-
-    for r in active_rules:
-        if r["scope"] == "global":
-            return int(r["max_installments"])
-
-    return 6
+    store = store_cache.get_by_id(store_id)
+    if not store:
+        raise HTTPException(404, "store no encontrada")
+    metrics.tag_store(store["tn_store_id"])
+    return store
+
+def _app_stats_metrics():
+    # Contadores que ya llevan outbox/dedupe/store_cache, leídos en cada scrape.
+    yield ("splitpay_outbox_jobs", "gauge", "Jobs del outbox pendientes, en proceso y muertos.",
+           [({"status": k}, v) for k, v in outbox.stats().items()])
+    yield ("splitpay_outbox_results_total", "counter", "Jobs del outbox procesados en este proceso, por resultado.",
+           [({"result": k}, v) for k, v in outbox.result_counts().items()])
+    d = dedupe.stats()
+    yield ("splitpay_webhook_suppressed_total", "counter", "Notificaciones de MP descartadas por dedupe.",
+           [({"stage": "before_fetch"}, d["suppressed_before_fetch"]), ({"stage": "after_fetch"}, d["suppressed_after_fetch"])])
+    caches = {"dedupe": {"hits": d["cache_hits"], "misses": d["cache_misses"], "size": d["cache_size"]}}
+    caches.update({f"store_{k}": v for k, v in store_cache.stats().items()})
+    caches["split_pages"] = _split_pages.stats()
+    e = events.stats()
+    yield ("splitpay_sse_subscribers", "gauge", "Streams SSE abiertos.", [({}, e["subscribers"])])
+    yield ("splitpay_split_events_total", "counter", "Eventos de split publicados / descartados por cola llena.",
+           [({"result": "published"}, e["published"]), ({"result": "dropped"}, e["dropped"])])
+    tn = tn_api.rate_limit_stats()
+    by_store = metrics.METRICS_STORE_LABELS
+    def tn_samples(key):
+        if by_store:
+            return [({"store": sid}, v[key]) for sid, v in tn.items()]
+        return [({}, sum(v[key] for v in tn.values()))]
+    yield ("splitpay_tn_ratelimit_queued", "gauge", "Llamadas a TN esperando lugar en el bucket de la tienda.", tn_samples("queued"))
+    yield ("splitpay_tn_ratelimit_throttled_total", "counter", "Respuestas 429 de TN.", tn_samples("throttled"))
+    yield ("splitpay_tn_ratelimit_deferred_total", "counter", "Órdenes reprogramadas por espera estimada mayor a TN_ORDER_MAX_WAIT_S.", tn_samples("deferred"))
+    r = reconcile.stats()
+    yield ("splitpay_reconcile_payments_total", "counter", "Pagos pendientes consultados a MP por el sweeper de conciliación.",
+           [({"result": k}, r[k]) for k in ("updated", "unchanged", "not_found", "errors", "no_token")])
+    yield ("splitpay_reconcile_last_sweep_seconds", "gauge", "Duración del último sweep de conciliación.", [({}, r["last_sweep_s"])])
+    k = retention.stats()
+    yield ("splitpay_retention_splits_total", "counter", "Splits borrados por retención (abandonados) o archivados.",
+           [({"action": "abandoned_deleted"}, k["abandoned_deleted"]), ({"action": "archived"}, k["archived"])])
+    yield ("splitpay_retention_rows_deleted_total", "counter", "Filas de outbox ('done') y processed_events borradas por retención.",
+           [({"table": "outbox"}, k["outbox_deleted"]), ({"table": "processed_events"}, k["events_deleted"])])
+    yield ("splitpay_retention_vacuumed_pages_total", "counter", "Páginas devueltas al disco por incremental_vacuum.", [({}, k["vacuumed_pages"])])
+    yield ("splitpay_retention_last_run_seconds", "gauge", "Duración de la última corrida de retención.", [({}, k["last_run_s"])])
+    yield ("splitpay_cache_hits_total", "counter", "Hits de caches en memoria.",
+           [({"cache": c}, v["hits"]) for c, v in caches.items()])
+    yield ("splitpay_cache_misses_total", "counter", "Misses de caches en memoria.",
+           [({"cache": c}, v["misses"]) for c, v in caches.items()])
+    yield ("splitpay_cache_entries", "gauge", "Entradas en caches en memoria.",
+           [({"cache": c}, v["size"]) for c, v in caches.items()])
+
+metrics.register_collector(_app_stats_metrics)
+
+def _build_groups(items: List[Dict[str, Any]], index: RuleIndex, store: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    store = store or {}
+    groups, _ = planner.plan(items, index, planner.store_tiers(store), planner.store_min_installment_amount(store))
+    return groups
 
-def _group_key(max_installments: int) -> str:
-    if max_installments >= 12:
-        return "group_12"
-    if max_installments >= 6:
-        return "group_6"
-    return "group_0"
+def _plan_carts(carts: List[Dict[str, Any]], index: RuleIndex, store: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    # Versión batch de _build_groups que no copia items: solo subtotales y cantidad de
+    # líneas por grupo. El tramo de cada (product_id, category_id) queda memoizado en el
+    # RuleIndex, así carritos que repiten productos no vuelven a resolver reglas. Un cart
+    # puede traer shipping_method/shipping_paid_in_group y el envío cuenta para el mínimo por cuota.
+    store = store or {}
+    tiers = planner.store_tiers(store)
+    min_amount = planner.store_min_installment_amount(store)
+    rates = planner.store_shipping_rates(store)
+    plans = []
+    for c in carts:
+        shipping_cost = rates.get(c.get("shipping_method") or "", 0)
+        groups, shipping_group = planner.plan_totals(c["items"], index, tiers, min_amount, shipping_cost, c.get("shipping_paid_in_group"))
+        plan = {"groups": groups}
+        if c.get("shipping_method"):
+            plan["shipping_cost"] = shipping_cost
+            plan["shipping_paid_in_group"] = shipping_group
+        plans.append(plan)
+    return plans
+
+def _invalid_item(items: List[Any]) -> Optional[int]:
+    # Índice del primer item que el planner no puede usar (no es un objeto, o price /
+    # quantity no son números), o None si están todos bien.
+    for i, it in enumerate(items):
+        if not isinstance(it, dict):
+            return i
+        try:
+            int(it.get("price", 0)) * int(it.get("quantity", 1))
+        except (TypeError, ValueError, OverflowError):
+            return i
+    return None
+
+def _opt_str(v: Any) -> Optional[str]:
+    return None if v is None else str(v)
+
+def _insert_splits(db, splits: List[Tuple[str, int, str, Dict[str, Any]]]):
+    # (split_id, store_id, buyer_email, groups) -> filas de splits, split_groups y split_items.
+    # Los items se guardan una sola vez, en su grupo, con el subtotal ya calculado.
+    group_rows, item_rows = [], []
+    for split_id, _, _, groups in splits:
+        line = 0
+        for gk, g in groups.items():
+            group_rows.append((split_id, gk, int(g["max_installments"]), int(g["subtotal"]), len(g["items"])))
+            for it in g["items"]:
+                line += 1
+                item_rows.append((
+                    split_id, line, gk, _opt_str(it.get("product_id")), _opt_str(it.get("variant_id")), it.get("name"),
+                    int(it.get("quantity", 1)), int(it.get("price", 0)),
+                ))
+    db.executemany(
+        "INSERT INTO splits (id, store_id, buyer_email, status) VALUES (?,?,?,'created')",
+        [(split_id, store_id, buyer_email) for split_id, store_id, buyer_email, _ in splits],
+    )
+    db.executemany(
+        "INSERT INTO split_groups (split_id, group_key, max_installments, subtotal, item_count) VALUES (?,?,?,?,?)",
+        group_rows,
+    )
+    db.executemany(
+        "INSERT INTO split_items (split_id, line, group_key, product_id, variant_id, name, quantity, price) VALUES (?,?,?,?,?,?,?,?)",
+        item_rows,
+    )
+    per_store: Dict[int, int] = {}
+    for _, store_id, _, _ in splits:
+        per_store[store_id] = per_store.get(store_id, 0) + 1
+    db.executemany(
+        "INSERT INTO store_split_stats (store_id, splits_total) VALUES (?,?) "
+        "ON CONFLICT(store_id) DO UPDATE SET splits_total = splits_total + excluded.splits_total",
+        list(per_store.items()),
+    )
 
-def _build_groups(items: List[Dict[str, Any]], rules: List[Dict[str, Any]]) -> Dict[str, Any]:
-    groups = {
-        "group_12": {"max_installments": 12, "items": [], "subtotal": 0},
-        "group_6": {"max_installments": 6, "items": [], "subtotal": 0},
-        "group_0": {"max_installments": 0, "items": [], "subtotal": 0},
-    }
-    for it in items:
-        max_inst = _pick_rule_for_item(rules, it)
-        gk = _group_key(max_inst)
-        groups[gk]["items"].append(it)
-        price = int(it.get("price", 0))
-        qty = int(it.get("quantity", 1))
-        groups[gk]["subtotal"] += price * qty
-    return groups
+def _tn_id(v: Optional[str]) -> Any:
+    # product_id/variant_id se guardan como texto; TN los espera numéricos.
+    return int(v) if v is not None and v.isdigit() else v
 
-def _shipping_cost_from_method(method: str) -> int:
-    return 0 if method == "retiro" else 2500 if method == "estandar" else 4500 if method == "express" else 0
+def _shipping_cost(store: Dict[str, Any], method: str) -> Optional[int]:
+    return planner.store_shipping_rates(store).get(method)
 
 @app.get("/", response_class=HTMLResponse)
 def home(request: Request):
@@ -127,15 +244,96 @@ def tn_callback(code: str):
             "ON CONFLICT(tn_store_id) DO UPDATE SET tn_access_token=excluded.tn_access_token",
             (tn_store_id, access_token, None),
         )
+    store_cache.invalidate(tn_store_id)
     return RedirectResponse(f"/dashboard?admin_key={APP_ADMIN_KEY}")
 
 # ----------------- Dashboard -----------------
+# Listados con paginación keyset: `before` es el último id de la página anterior, así
+# cada página es un range scan por id y no un OFFSET que recorre todo lo anterior.
+_KEYSET_START = 2 ** 63 - 1
+
+def _like_prefix(q: str) -> Optional[str]:
+    q = q.strip()
+    if not q:
+        return None
+    return q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def _with_completion_rate(row) -> Dict[str, Any]:
+    out = dict(row)
+    out["completion_rate"] = out["splits_completed"] / out["splits_total"] if out["splits_total"] else 0.0
+    return out
+
+def _page(rows: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    # Se pide un registro de más para saber si hay página siguiente.
+    if len(rows) > DASHBOARD_PAGE_SIZE:
+        rows = rows[:DASHBOARD_PAGE_SIZE]
+        return rows, rows[-1]["id"]
+    return rows, None
+
 @app.get("/dashboard", response_class=HTMLResponse)
-def dashboard(request: Request, admin_key: str):
+def dashboard(request: Request, admin_key: str, before: Optional[int] = None, q: str = ""):
     _require_admin(admin_key)
+    pattern = _like_prefix(q)
     with get_db() as db:
-        stores = [dict(s) for s in db.execute("SELECT * FROM stores ORDER BY id DESC").fetchall()]
-    return templates.TemplateResponse("dashboard.html", {"request": request, "stores": stores, "admin_key": admin_key})
+        rows = db.execute(
+            "SELECT s.id, s.tn_store_id, COALESCE(s.mp_access_token, '') != '' AS has_mp_token, "
+            "COALESCE(st.splits_total, 0) AS splits_total, COALESCE(st.splits_completed, 0) AS splits_completed, COALESCE(st.gmv, 0) AS gmv "
+            "FROM stores s LEFT JOIN store_split_stats st ON st.store_id = s.id "
+            "WHERE s.id < ? AND (? IS NULL OR s.tn_store_id LIKE ? ESCAPE '\\') ORDER BY s.id DESC LIMIT ?",
+            (before or _KEYSET_START, pattern, pattern, DASHBOARD_PAGE_SIZE + 1),
+        ).fetchall()
+        totals = db.execute(
+            "SELECT COALESCE(SUM(splits_total), 0) AS splits_total, COALESCE(SUM(splits_completed), 0) AS splits_completed, "
+            "COALESCE(SUM(gmv), 0) AS gmv FROM store_split_stats"
+        ).fetchone()
+    stores, next_before = _page([_with_completion_rate(r) for r in rows])
+    return templates.TemplateResponse("dashboard.html", {
+        "request": request,
+        "stores": stores,
+        "totals": _with_completion_rate(totals),
+        "q": q,
+        "before": before,
+        "next_before": next_before,
+        "admin_key": admin_key,
+    })
+
+@app.get("/dashboard/stats")
+def dashboard_stats(admin_key: str):
+    _require_admin(admin_key)
+    return {
+        "store_cache": store_cache.stats(),
+        "split_pages": _split_pages.stats(),
+        "webhook_dedupe": dedupe.stats(),
+        "outbox": outbox.stats(),
+        "outbox_results": outbox.result_counts(),
+        "events": events.stats(),
+        "reconcile": reconcile.stats(),
+        "tn_rate_limit": tn_api.rate_limit_stats(),
+        "retention": retention.stats(),
+    }
+
+@app.post("/dashboard/reconcile")
+def dashboard_reconcile(admin_key: str, limit: int = reconcile.RECONCILE_MAX_PER_SWEEP):
+    # Corre un sweep de conciliación ya (el mismo que hace el thread en background).
+    _require_admin(admin_key)
+    return reconcile.sweep(MP_ACCESS_TOKEN_DEFAULT, limit=max(1, limit))
+
+@app.post("/dashboard/retention")
+def dashboard_retention(admin_key: str):
+    _require_admin(admin_key)
+    return retention.run_once()
+
+@app.get("/dashboard/archive/{split_id}")
+def dashboard_archived_split(split_id: str, admin_key: str):
+    _require_admin(admin_key)
+    record = retention.lookup_archived(split_id)
+    if record is None:
+        raise HTTPException(404, "split no archivado")
+    return record
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.post("/dashboard/store/save")
 def dashboard_store_save(
@@ -151,17 +349,90 @@ def dashboard_store_save(
             "ON CONFLICT(tn_store_id) DO UPDATE SET tn_access_token=excluded.tn_access_token, mp_access_token=excluded.mp_access_token",
             (tn_store_id, tn_access_token, mp_access_token),
         )
+    store_cache.invalidate(tn_store_id)
     return RedirectResponse(f"/dashboard?admin_key={admin_key}", status_code=303)
 
 @app.get("/dashboard/{tn_store_id}/rules", response_class=HTMLResponse)
-def dashboard_rules(request: Request, tn_store_id: str, admin_key: str):
+def dashboard_rules(
+    request: Request,
+    tn_store_id: str,
+    admin_key: str,
+    before: Optional[int] = None,
+    scope: str = "",
+    active: str = "",
+    q: str = "",
+):
     _require_admin(admin_key)
     store = _get_store_by_tn_store_id(tn_store_id)
     if not store:
         raise HTTPException(404, "store no encontrada")
+    scope_f = scope if scope in ("product", "category", "global") else None
+    active_f = int(active) if active in ("0", "1") else None
+    pattern = _like_prefix(q)
     with get_db() as db:
-        rules = [dict(r) for r in db.execute("SELECT * FROM rules WHERE store_id=? ORDER BY id DESC", (store["id"],)).fetchall()]
-    return templates.TemplateResponse("rules.html", {"request": request, "tn_store_id": tn_store_id, "rules": rules, "admin_key": admin_key})
+        rows = db.execute(
+            "SELECT id, scope, reference_id, max_installments, active FROM rules "
+            "WHERE store_id=? AND id < ? AND (? IS NULL OR scope=?) AND (? IS NULL OR active=?) "
+            "AND (? IS NULL OR reference_id LIKE ? ESCAPE '\\') ORDER BY id DESC LIMIT ?",
+            (store["id"], before or _KEYSET_START, scope_f, scope_f, active_f, active_f, pattern, pattern, DASHBOARD_PAGE_SIZE + 1),
+        ).fetchall()
+        summary = db.execute(
+            "SELECT splits_total, splits_completed, gmv FROM store_split_stats WHERE store_id=?", (store["id"],)
+        ).fetchone()
+    rules, next_before = _page([dict(r) for r in rows])
+    return templates.TemplateResponse("rules.html", {
+        "request": request,
+        "tn_store_id": tn_store_id,
+        "rules": rules,
+        "summary": _with_completion_rate(summary) if summary else None,
+        "filters": {"scope": scope_f or "", "active": "" if active_f is None else str(active_f), "q": q},
+        "before": before,
+        "next_before": next_before,
+        "catalog_state": catalog.sync_state(store["id"]),
+        "settings": {
+            "installment_tiers": planner.format_tiers(planner.store_tiers(store)),
+            "shipping_rates": planner.format_shipping_rates(planner.store_shipping_rates(store)),
+            "min_installment_amount": int(store.get("min_installment_amount") or 0),
+        },
+        "admin_key": admin_key,
+    })
+
+@app.post("/dashboard/{tn_store_id}/settings")
+def dashboard_settings_save(
+    tn_store_id: str,
+    admin_key: str,
+    installment_tiers: str = Form(...),
+    shipping_rates: str = Form(...),
+    min_installment_amount: int = Form(0),
+):
+    _require_admin(admin_key)
+    store = _get_store_by_tn_store_id(tn_store_id)
+    if not store:
+        raise HTTPException(404, "store no encontrada")
+    try:
+        tiers = planner.parse_tiers(installment_tiers)
+        rates = planner.parse_shipping_rates(shipping_rates)
+    except ValueError as e:
+        raise HTTPException(400, f"Configuración inválida: {e}")
+    if min_installment_amount < 0:
+        raise HTTPException(400, "Configuración inválida: monto mínimo negativo")
+    with get_db() as db:
+        db.execute(
+            "UPDATE stores SET installment_tiers=?, shipping_rates_json=?, min_installment_amount=? WHERE id=?",
+            (planner.format_tiers(tiers), json.dumps(rates, ensure_ascii=False), min_installment_amount, store["id"]),
+        )
+    store_cache.invalidate(tn_store_id)
+    return RedirectResponse(f"/dashboard/{tn_store_id}/rules?admin_key={admin_key}", status_code=303)
+
+@app.post("/dashboard/{tn_store_id}/catalog/sync")
+def dashboard_catalog_sync(tn_store_id: str, admin_key: str, background_tasks: BackgroundTasks, full: int = 0):
+    _require_admin(admin_key)
+    store = _get_store_by_tn_store_id(tn_store_id)
+    if not store:
+        raise HTTPException(404, "store no encontrada")
+    # Corre después de responder; una sync por tienda a la vez (catalog.sync_store lo controla).
+    background_tasks.add_task(catalog.sync_store, store, bool(full))
+    return RedirectResponse(f"/dashboard/{tn_store_id}/rules?admin_key={admin_key}", status_code=303)
 
 @app.post("/dashboard/{tn_store_id}/rules/add")
 def dashboard_rules_add(
@@ -181,6 +452,7 @@ def dashboard_rules_add(
             "INSERT INTO rules (store_id, scope, reference_id, max_installments, active) VALUES (?,?,?,?,1)",
             (store["id"], scope, reference_id, int(max_installments)),
         )
+    invalidate_rule_index(store["id"])
     return RedirectResponse(f"/dashboard/{tn_store_id}/rules?admin_key={admin_key}", status_code=303)
 
 @app.post("/dashboard/{tn_store_id}/rules/toggle/{rule_id}")
@@ -195,6 +467,7 @@ def dashboard_rules_toggle(tn_store_id: str, rule_id: int, admin_key: str):
             raise HTTPException(404, "rule no encontrada")
         new_val = 0 if int(row["active"]) == 1 else 1
         db.execute("UPDATE rules SET active=? WHERE id=? AND store_id=?", (new_val, rule_id, store["id"]))
+    invalidate_rule_index(store["id"])
     return RedirectResponse(f"/dashboard/{tn_store_id}/rules?admin_key={admin_key}", status_code=303)
 
 # ----------------- Split (comprador) -----------------
@@ -206,98 +479,232 @@ async def split_create(payload: Dict[str, Any]):
 
     if not tn_store_id or not isinstance(items, list) or len(items) == 0:
         raise HTTPException(400, "Faltan tn_store_id o items")
+    bad = _invalid_item(items)
+    if bad is not None:
+        raise HTTPException(400, f"Item {bad} inválido")
+
+    split_id = await run_db_write(_create_split, tn_store_id, items, buyer_email)
+    return {"split_id": split_id}
 
+def _create_split(tn_store_id: str, items: List[Dict[str, Any]], buyer_email: str) -> str:
     store = _get_store_by_tn_store_id(tn_store_id)
     if not store:
         raise HTTPException(404, "Store no instalada")
 
-    rules = _get_active_rules(store["id"])
-    groups = _build_groups(items, rules)
+    groups = _build_groups(items, get_rule_index(store["id"]), store)
 
     split_id = str(uuid.uuid4())
     with get_db() as db:
-        db.execute(
-            "INSERT INTO splits (id, store_id, buyer_email, status, shipping_method, shipping_cost, shipping_paid_in_group, cart_json, groups_json) "
-            "VALUES (?,?,?,?,?,?,?,?,?)",
-            (split_id, store["id"], buyer_email, "created", None, 0, None, json.dumps(items, ensure_ascii=False), json.dumps(groups, ensure_ascii=False)),
+        _insert_splits(db, [(split_id, store["id"], buyer_email, groups)])
+    return split_id
+
+@app.post("/split/plan_batch")
+async def split_plan_batch(payload: Dict[str, Any]):
+    tn_store_id = str(payload.get("tn_store_id") or "")
+    carts = payload.get("carts") or []
+    persist = bool(payload.get("persist"))
+
+    if not tn_store_id or not isinstance(carts, list) or len(carts) == 0:
+        raise HTTPException(400, "Faltan tn_store_id o carts")
+    if len(carts) > PLAN_BATCH_MAX_CARTS:
+        raise HTTPException(413, f"Máximo {PLAN_BATCH_MAX_CARTS} carritos por batch")
+    if not all(isinstance(c, dict) and isinstance(c.get("items"), list) for c in carts):
+        raise HTTPException(400, "Cada cart necesita items")
+    for ci, c in enumerate(carts):
+        bad = _invalid_item(c["items"])
+        if bad is not None:
+            raise HTTPException(400, f"Cart {ci}: item {bad} inválido")
+
+    return await (run_db_write if persist else run_db)(_plan_batch, tn_store_id, carts, persist)
+
+def _plan_batch(tn_store_id: str, carts: List[Dict[str, Any]], persist: bool) -> Dict[str, Any]:
+    store = _get_store_by_tn_store_id(tn_store_id)
+    if not store:
+        raise HTTPException(404, "Store no instalada")
+    index = get_rule_index(store["id"])
+    rates = planner.store_shipping_rates(store)
+    if any(c.get("shipping_method") and c["shipping_method"] not in rates for c in carts):
+        raise HTTPException(400, "método de envío inválido")
+
+    plans = _plan_carts(carts, index, store)
+    results = [{"cart_id": c.get("cart_id"), **plan} for c, plan in zip(carts, plans)]
+    if not persist:
+        return {"carts": results}
+
+    # Modo persistente: un split por carrito, todos en una sola transacción. Se guarda el
+    # mismo plan que se devuelve, con el envío incluido (cuenta para el mínimo por cuota).
+    tiers = planner.store_tiers(store)
+    min_amount = planner.store_min_installment_amount(store)
+    rows, shipping = [], []
+    for c, res in zip(carts, results):
+        res["split_id"] = str(uuid.uuid4())
+        groups, shipping_group = planner.plan(
+            c["items"], index, tiers, min_amount, res.get("shipping_cost", 0), c.get("shipping_paid_in_group")
         )
-    return {"split_id": split_id}
+        rows.append((res["split_id"], store["id"], c.get("buyer_email") or "", groups))
+        if c.get("shipping_method"):
+            shipping.append((c["shipping_method"], res["shipping_cost"], shipping_group, res["split_id"]))
+    with get_db() as db:
+        _insert_splits(db, rows)
+        db.executemany("UPDATE splits SET shipping_method=?, shipping_cost=?, shipping_paid_in_group=? WHERE id=?", shipping)
+    return {"carts": results}
 
-@app.get("/split/{split_id}", response_class=HTMLResponse)
-def split_view(request: Request, split_id: str):
+def _load_groups(db, split_id: str) -> Dict[str, Any]:
+    groups = {
+        r["group_key"]: {"max_installments": r["max_installments"], "items": [], "subtotal": r["subtotal"]}
+        for r in db.execute("SELECT group_key, max_installments, subtotal FROM split_groups WHERE split_id=? ORDER BY max_installments DESC", (split_id,)).fetchall()
+    }
+    for r in db.execute("SELECT group_key, name, quantity, price FROM split_items WHERE split_id=? ORDER BY line", (split_id,)).fetchall():
+        groups[r["group_key"]]["items"].append({"name": r["name"], "quantity": r["quantity"], "price": r["price"]})
+    return groups
+
+# GET condicional de las vistas del split: el ETag es la versión del split más un hash
+# de los templates (un deploy que los cambia invalida los ETags viejos). Un hit de
+# If-None-Match cuesta una lectura por PK; si no, el HTML sale del cache mientras la
+# versión no cambie.
+def _templates_tag(*names: str) -> str:
+    crc = 0
+    for name in names:
+        with open(os.path.join("templates", name), "rb") as f:
+            crc = zlib.crc32(f.read(), crc)
+    return f"{crc:08x}"
+
+_SPLIT_TEMPLATES_TAG = _templates_tag("split_checkout.html", "split_done.html")
+
+def _split_version(split_id: str) -> Optional[Tuple[int, int]]:
     with get_db() as db:
-        s = db.execute("SELECT * FROM splits WHERE id=?", (split_id,)).fetchone()
+        row = db.execute("SELECT version, store_id FROM splits WHERE id=?", (split_id,)).fetchone()
+    return (row["version"], row["store_id"]) if row else None
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+def _cached_split_page(request: Request, view: str, split_id: str, render) -> Response:
+    # La versión se lee antes que los datos: si el split cambia en el medio, el HTML
+    # queda guardado bajo la versión vieja con datos nuevos (nunca al revés).
+    row = _split_version(split_id)
+    if row is None:
+        raise HTTPException(404, "split no encontrado")
+    version, store_id = row
+    # Los métodos de envío de la tienda también salen en la página.
+    store_tag = zlib.crc32((_get_store_by_internal_id(store_id).get("shipping_rates_json") or "").encode())
+    etag = f'"{version}-{_SPLIT_TEMPLATES_TAG}-{store_tag:08x}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    key = (view, split_id, version, store_tag)
+    html = _split_pages.get(key)
+    if html is None:
+        html = render()
+        _split_pages.set(key, html)
+    return HTMLResponse(html, headers=headers)
+
+def _render_split_view(split_id: str) -> str:
+    with get_db() as db:
+        s = db.execute("SELECT store_id, shipping_method, shipping_cost, shipping_paid_in_group FROM splits WHERE id=?", (split_id,)).fetchone()
         if not s:
             raise HTTPException(404, "split no encontrado")
-        payments = [dict(p) for p in db.execute("SELECT * FROM split_payments WHERE split_id=? ORDER BY id ASC", (split_id,)).fetchall()]
+        groups = _load_groups(db, split_id)
+        payments = [dict(p) for p in db.execute("SELECT group_key, status, mp_init_point FROM split_payments WHERE split_id=? ORDER BY id ASC", (split_id,)).fetchall()]
+
+    return templates.get_template("split_checkout.html").render({
+        "split_id": split_id,
+        "groups": groups,
+        "shipping_method": s["shipping_method"],
+        "shipping_cost": s["shipping_cost"],
+        "shipping_paid_in_group": s["shipping_paid_in_group"],
+        "shipping_rates": planner.store_shipping_rates(_get_store_by_internal_id(s["store_id"])),
+        "payments": payments,
+    })
 
-    s = dict(s)
-    groups = json.loads(s["groups_json"])
-    return templates.TemplateResponse(
-        "split_checkout.html",
-        {
-            "request": request,
-            "split_id": split_id,
-            "groups": groups,
-            "shipping_method": s["shipping_method"],
-            "shipping_cost": s["shipping_cost"],
-            "shipping_paid_in_group": s["shipping_paid_in_group"],
-            "payments": payments,
-        },
-    )
+@app.get("/split/{split_id}", response_class=HTMLResponse)
+def split_view(request: Request, split_id: str):
+    return _cached_split_page(request, "view", split_id, lambda: _render_split_view(split_id))
 
 @app.post("/split/{split_id}/shipping")
 def split_set_shipping(split_id: str, shipping_method: str = Form(...), shipping_paid_in_group: str = Form(...)):
-    cost = _shipping_cost_from_method(shipping_method)
     with get_db() as db:
-        s = db.execute("SELECT * FROM splits WHERE id=?", (split_id,)).fetchone()
+        s = db.execute("SELECT store_id FROM splits WHERE id=?", (split_id,)).fetchone()
         if not s:
             raise HTTPException(404, "split no encontrado")
+        cost = _shipping_cost(_get_store_by_internal_id(s["store_id"]), shipping_method)
+        if cost is None:
+            raise HTTPException(400, "método de envío inválido")
+        group = db.execute(
+            "SELECT 1 FROM split_groups WHERE split_id=? AND group_key=? AND item_count > 0", (split_id, shipping_paid_in_group)
+        ).fetchone()
+        if not group:
+            raise HTTPException(400, "grupo inválido para el envío")
         db.execute(
-            "UPDATE splits SET shipping_method=?, shipping_cost=?, shipping_paid_in_group=? WHERE id=?",
+            "UPDATE splits SET shipping_method=?, shipping_cost=?, shipping_paid_in_group=?, version=version+1 WHERE id=?",
             (shipping_method, cost, shipping_paid_in_group, split_id),
         )
     return RedirectResponse(f"/split/{split_id}", status_code=303)
 
+def _create_preferences(mp_token: str, prefs: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    # En paralelo con un pool propio de cada request (hasta MP_PREFERENCE_WORKERS): la
+    # latencia es la del llamado más lento y un pool compartido no encola a los requests
+    # concurrentes detrás de los demás. Con un solo grupo, directo en este thread.
+    workers = min(len(prefs), MP_PREFERENCE_WORKERS)
+    if workers <= 1:
+        return {gk: create_preference(mp_token, pref) for gk, pref in prefs.items()}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mp-pref") as ex:
+        futures = {gk: ex.submit(create_preference, mp_token, pref) for gk, pref in prefs.items()}
+        return {gk: f.result() for gk, f in futures.items()}
+
 @app.get("/split/{split_id}/generate_payments")
 def split_generate_payments(split_id: str):
     with get_db() as db:
-        s = db.execute("SELECT * FROM splits WHERE id=?", (split_id,)).fetchone()
+        s = db.execute("SELECT store_id, shipping_cost, shipping_paid_in_group FROM splits WHERE id=?", (split_id,)).fetchone()
         if not s:
             raise HTTPException(404, "split no encontrado")
-        s = dict(s)
-        store = _get_store_by_internal_id(s["store_id"])
-        groups = json.loads(s["groups_json"])
+        groups = db.execute(
+            "SELECT group_key, max_installments, subtotal FROM split_groups WHERE split_id=? AND item_count > 0 ORDER BY max_installments DESC", (split_id,)
+        ).fetchall()
+    s = dict(s)
+    store = _get_store_by_internal_id(s["store_id"])
 
-        mp_token = store.get("mp_access_token") or MP_ACCESS_TOKEN_DEFAULT
-        if not mp_token:
-            raise HTTPException(500, "Falta MP token")
+    mp_token = store.get("mp_access_token") or MP_ACCESS_TOKEN_DEFAULT
+    if not mp_token:
+        raise HTTPException(500, "Falta MP token")
+
+    expires_at = preference_expires_at()
+    prefs = {}
+    for g in groups:
+        group_key = g["group_key"]
+        max_inst = int(g["max_installments"])
+        subtotal = int(g["subtotal"])
+
+        shipping_cost = int(s["shipping_cost"] or 0)
+        total = subtotal + shipping_cost if (s["shipping_paid_in_group"] == group_key) else subtotal
+
+        # Preferencia MP: máximo de cuotas (installments) :contentReference[oaicite:5]{index=5}
+        prefs[group_key] = {
+            "items": [{"title": f"Compra {group_key} - Split {split_id}", "quantity": 1, "currency_id": "ARS", "unit_price": total}],
+            "external_reference": f"{split_id}:{group_key}",
+            "notification_url": f"{APP_BASE_URL}/mp/webhook?store_id={s['store_id']}",
+            "payment_methods": {"installments": max_inst},
+            **expiration_fields(expires_at),
+        }
+
+    # Las preferencias se crean sin transacción abierta, así el lock de escritura no se
+    # sostiene durante el I/O de red.
+    responses = _create_preferences(mp_token, prefs)
 
+    with get_db() as db:
         db.execute("DELETE FROM split_payments WHERE split_id=?", (split_id,))
-
-        for group_key, g in groups.items():
-            if len(g["items"]) == 0:
-                continue
-
-            max_inst = int(g["max_installments"])
-            subtotal = int(g["subtotal"])
-
-            shipping_cost = int(s["shipping_cost"] or 0)
-            total = subtotal + shipping_cost if (s["shipping_paid_in_group"] == group_key) else subtotal
-
-            # Preferencia MP: máximo de cuotas (installments) :contentReference[oaicite:5]{index=5}
-            pref = {
-                "items": [{"title": f"Compra {group_key} - Split {split_id}", "quantity": 1, "currency_id": "ARS", "unit_price": total}],
-                "external_reference": f"{split_id}:{group_key}",
-                "notification_url": f"{APP_BASE_URL}/mp/webhook",
-                "payment_methods": {"installments": max_inst},
-            }
-
-            mp_resp = create_preference(mp_token, pref)
-            db.execute(
-                "INSERT INTO split_payments (split_id, group_key, mp_preference_id, mp_init_point, status) VALUES (?,?,?,?,?)",
-                (split_id, group_key, mp_resp.get("id"), mp_resp.get("init_point"), "created"),
-            )
+        db.executemany(
+            "INSERT INTO split_payments (split_id, group_key, mp_preference_id, mp_init_point, status, preference_expires_at) "
+            "VALUES (?,?,?,?,?,datetime(?, 'unixepoch'))",
+            [(split_id, gk, r.get("id"), r.get("init_point"), "created", expires_at) for gk, r in responses.items()],
+        )
+        db.execute("UPDATE splits SET version=version+1 WHERE id=?", (split_id,))
+        snapshot = _split_status(db, split_id) if events.has_subscribers(split_id) else None
+    if snapshot:
+        events.publish(split_id, snapshot)
 
     return RedirectResponse(f"/split/{split_id}", status_code=303)
 
@@ -310,42 +717,106 @@ async def mp_webhook(request: Request):
     if not payment_id:
         return PlainTextResponse("ok", status_code=200)
 
+    payment_id = str(payment_id)
+    if await run_db(dedupe.is_settled, payment_id):
+        return PlainTextResponse("ok", status_code=200)
+
+    # Las preferencias llevan store_id en notification_url: el pago se consulta con el
+    # token de MP de la tienda. Las viejas (sin store_id) usan el default.
     mp_token = MP_ACCESS_TOKEN_DEFAULT
+    store_id = qs.get("store_id") or ""
+    if store_id.isdigit():
+        store = await run_db(store_cache.get_by_id, int(store_id))
+        mp_token = (store or {}).get("mp_access_token") or mp_token
     if not mp_token:
         return PlainTextResponse("Missing MP token", status_code=200)
 
-    pay = get_payment(mp_token, str(payment_id))
-    status = pay.get("status")
+    pay = await get_payment_async(mp_token, payment_id)
+    status = pay.get("status") or "unknown"
     external_reference = pay.get("external_reference") or ""
     if ":" not in external_reference:
         return PlainTextResponse("ok", status_code=200)
 
     split_id, group_key = external_reference.split(":", 1)
+    await run_db_write(_apply_payment_status, payment_id, status, split_id, group_key)
+    return PlainTextResponse("ok", status_code=200)
+
+def _split_status(db, split_id: str) -> Optional[Dict[str, Any]]:
+    s = db.execute("SELECT status, version FROM splits WHERE id=?", (split_id,)).fetchone()
+    if not s:
+        return None
+    payments = [dict(p) for p in db.execute("SELECT group_key, status, mp_payment_id, mp_init_point FROM split_payments WHERE split_id=? ORDER BY id ASC", (split_id,)).fetchall()]
+    return {"split_id": split_id, "status": s["status"], "version": s["version"], "payments": payments}
 
+def _read_split_status(split_id: str) -> Optional[Dict[str, Any]]:
     with get_db() as db:
-        db.execute(
-            "UPDATE split_payments SET mp_payment_id=?, status=? WHERE split_id=? AND group_key=?",
-            (str(payment_id), status or "unknown", split_id, group_key),
-        )
+        return _split_status(db, split_id)
 
-        if status == "approved":
-            s = db.execute("SELECT * FROM splits WHERE id=?", (split_id,)).fetchone()
-            if s:
-                s = dict(s)
-                store = _get_store_by_internal_id(s["store_id"])
-                groups = json.loads(s["groups_json"])
-                group = groups.get(group_key)
-                if group and len(group["items"]) > 0:
-                    _create_tn_order_for_group(store, s, group_key, group, str(payment_id))
-
-        rows = db.execute("SELECT status FROM split_payments WHERE split_id=?", (split_id,)).fetchall()
-        statuses = [r["status"] for r in rows]
-        if statuses and all(st == "approved" for st in statuses):
-            db.execute("UPDATE splits SET status='completed' WHERE id=?", (split_id,))
+def _apply_payment_status(payment_id: str, status: str, split_id: str, group_key: str):
+    _apply_payment_statuses([(payment_id, status, split_id, group_key)])
 
-    return PlainTextResponse("ok", status_code=200)
+def _apply_payment_statuses(updates: List[Tuple[str, str, str, str]]) -> int:
+    # (payment_id, status, split_id, group_key), todos en una transacción: el webhook
+    # manda uno, el sweeper de conciliación un lote. Devuelve cuántos se aplicaron.
+    applied = 0
+    touched = []
+    snapshots = []
+    with get_db() as db:
+        for payment_id, status, split_id, group_key in updates:
+            if not dedupe.record(db, payment_id, status):
+                continue
+            applied += 1
+            if split_id not in touched:
+                touched.append(split_id)
 
-def _create_tn_order_for_group(store: Dict[str, Any], split_row: Dict[str, Any], group_key: str, group: Dict[str, Any], mp_payment_id: str):
+            prev = db.execute(
+                "SELECT status, mp_payment_id FROM split_payments WHERE split_id=? AND group_key=?", (split_id, group_key)
+            ).fetchone()
+            db.execute(
+                "UPDATE split_payments SET mp_payment_id=?, status=? WHERE split_id=? AND group_key=?",
+                (payment_id, status, split_id, group_key),
+            )
+            db.execute("UPDATE splits SET version=version+1 WHERE id=?", (split_id,))
+
+            # La orden en Tiendanube la crea el worker del outbox; acá solo se encola en la
+            # misma transacción, así el webhook no depende de la latencia de TN.
+            # Solo en la transición a approved: retention borra los jobs y eventos viejos y
+            # una notificación repetida no tiene que generar una segunda orden.
+            if status == "approved" and prev and (prev["status"] != "approved" or prev["mp_payment_id"] != payment_id):
+                outbox.enqueue(db, "tn_order", f"{split_id}:{group_key}", {
+                    "split_id": split_id,
+                    "group_key": group_key,
+                    "mp_payment_id": payment_id,
+                })
+
+            rows = db.execute("SELECT status FROM split_payments WHERE split_id=?", (split_id,)).fetchall()
+            statuses = [r["status"] for r in rows]
+            if statuses and all(st == "approved" for st in statuses):
+                cur = db.execute("UPDATE splits SET status='completed' WHERE id=? AND status != 'completed'", (split_id,))
+                if cur.rowcount:
+                    db.execute(
+                        "UPDATE store_split_stats SET splits_completed = splits_completed + 1, gmv = gmv + "
+                        "(SELECT s.shipping_cost + (SELECT COALESCE(SUM(g.subtotal), 0) FROM split_groups g WHERE g.split_id = s.id) "
+                        "FROM splits s WHERE s.id = ?) "
+                        "WHERE store_id = (SELECT store_id FROM splits WHERE id = ?)",
+                        (split_id, split_id),
+                    )
+        for split_id in touched:
+            if events.has_subscribers(split_id):
+                snapshots.append(_split_status(db, split_id))
+
+        # Después del commit (en el writer puede ser el de todo el lote): un cliente que
+        # reciba el evento y recargue ya ve el cambio.
+        def _committed():
+            for payment_id, status, _, _ in updates:
+                dedupe.remember(payment_id, status)
+            for snapshot in snapshots:
+                if snapshot:
+                    events.publish(snapshot["split_id"], snapshot)
+        after_commit(_committed)
+    return applied
+
+def _create_tn_order_for_group(store: Dict[str, Any], split_row: Dict[str, Any], group_key: str, group_items: List[Dict[str, Any]], mp_payment_id: str):
     tn_store_id = store["tn_store_id"]
     tn_token = store["tn_access_token"]
 
@@ -354,12 +825,12 @@ def _create_tn_order_for_group(store: Dict[str, Any], split_row: Dict[str, Any],
     this_shipping = shipping_cost if shipping_paid_in_group == group_key else 0
 
     items = []
-    for it in group["items"]:
+    for it in group_items:
         items.append({
-            "product_id": it.get("product_id"),
-            "variant_id": it.get("variant_id"),
-            "quantity": int(it.get("quantity", 1)),
-            "price": int(it.get("price", 0)),
+            "product_id": _tn_id(it["product_id"]),
+            "variant_id": _tn_id(it["variant_id"]),
+            "quantity": it["quantity"],
+            "price": it["price"],
         })
 
     note = f"Split {split_row['id']} - {group_key} - MP payment_id {mp_payment_id}. "
@@ -374,18 +845,102 @@ def _create_tn_order_for_group(store: Dict[str, Any], split_row: Dict[str, Any],
 
     # En algunas tiendas el payload de order puede requerir más campos (cliente/dirección).
     # Para demo/MVP suele alcanzar, y lo ajustamos con tu tienda cuando pruebes.
+    create_order(tn_store_id, tn_token, payload)
+
+def _process_tn_order_job(job: Dict[str, Any]):
+    with get_db() as db:
+        s = db.execute("SELECT id, store_id, shipping_cost, shipping_paid_in_group FROM splits WHERE id=?", (job["split_id"],)).fetchone()
+        items = [dict(r) for r in db.execute(
+            "SELECT product_id, variant_id, quantity, price FROM split_items WHERE split_id=? AND group_key=? ORDER BY line",
+            (job["split_id"], job["group_key"]),
+        ).fetchall()]
+    if not s:
+        raise outbox.PermanentJobError("split no encontrado")
+    s = dict(s)
     try:
-        create_order(tn_store_id, tn_token, payload)
-    except Exception:
+        store = _get_store_by_internal_id(s["store_id"])
+    except HTTPException:
+        raise outbox.PermanentJobError("store no encontrada")
+    if not items:
         return
 
+    try:
+        _create_tn_order_for_group(store, s, job["group_key"], items, job["mp_payment_id"])
+    except tn_api.TNRateLimited as e:
+        # La tienda está saturada: se libera el worker para otras tiendas.
+        raise outbox.RetryLater(e.retry_after, str(e)) from e
+    except HTTPError as e:
+        # 4xx (salvo 429) no se arregla reintentando: va a dead para revisarlo a mano.
+        code = e.response.status_code if e.response is not None else 0
+        if 400 <= code < 500 and code != 429:
+            raise outbox.PermanentJobError(f"TN {code}: {e.response.text[:500]}") from e
+        raise
+
 @app.get("/split/{split_id}/done", response_class=HTMLResponse)
 def split_done(request: Request, split_id: str):
-    with get_db() as db:
-        s = db.execute("SELECT * FROM splits WHERE id=?", (split_id,)).fetchone()
-        if not s:
+    def render() -> str:
+        snapshot = _read_split_status(split_id)
+        if not snapshot:
             raise HTTPException(404, "split no encontrado")
-        payments = [dict(p) for p in db.execute("SELECT * FROM split_payments WHERE split_id=? ORDER BY id ASC", (split_id,)).fetchall()]
-
-    s = dict(s)
-    return templates.TemplateResponse("split_done.html", {"request": request, "split_id": split_id, "status": s["status"], "payments": payments})
+        return templates.get_template("split_done.html").render({"split_id": split_id, "status": snapshot["status"], "payments": snapshot["payments"]})
+    return _cached_split_page(request, "done", split_id, render)
+
+# Push del estado de pagos al checkout: un snapshot al conectar y otro por cada cambio
+# publicado en `events`. Cada SSE_RESYNC_S se relee la DB por si el cambio lo procesó
+# otro worker (el bus es por proceso). El stream se corta al completarse el split o a
+# los SSE_MAX_S; EventSource reconecta solo.
+def _sse(event: Dict[str, Any]) -> str:
+    return f"event: status\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+async def _split_event_stream(request: Request, sub: events.Subscription, snapshot: Dict[str, Any]):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SSE_MAX_S
+    next_resync = loop.time() + SSE_RESYNC_S
+    last = snapshot
+    try:
+        yield "retry: 3000\n" + _sse(snapshot)
+        while last["status"] != "completed":
+            now = loop.time()
+            if now >= deadline:
+                break
+            # Despierta también para el resync: si solo esperara el keepalive, un cambio
+            # hecho en otro worker tardaría max(SSE_KEEPALIVE_S, SSE_RESYNC_S) en llegar.
+            wait = min(SSE_KEEPALIVE_S, deadline - now)
+            if SSE_RESYNC_S > 0:
+                wait = min(wait, max(next_resync - now, 0))
+            try:
+                event = await asyncio.wait_for(sub.get(), wait)
+            except asyncio.TimeoutError:
+                if await request.is_disconnected():
+                    break
+                event = None
+                if SSE_RESYNC_S > 0 and loop.time() >= next_resync:
+                    next_resync = loop.time() + SSE_RESYNC_S
+                    event = await run_db(_read_split_status, sub.split_id)
+                    if event is None:
+                        break
+            if event is None or event == last:
+                yield ": keepalive\n\n"
+                continue
+            last = event
+            yield _sse(event)
+    finally:
+        events.unsubscribe(sub)
+
+@app.get("/split/{split_id}/events")
+async def split_events(request: Request, split_id: str):
+    # Se suscribe antes de leer el snapshot para no perder un cambio entre ambos.
+    sub = events.subscribe(split_id)
+    try:
+        snapshot = await run_db(_read_split_status, split_id)
+    except BaseException:
+        events.unsubscribe(sub)
+        raise
+    if not snapshot:
+        events.unsubscribe(sub)
+        raise HTTPException(404, "split no encontrado")
+    return StreamingResponse(
+        _split_event_stream(request, sub, snapshot),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
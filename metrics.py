@@ -0,0 +1,239 @@
+import contextvars
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+METRICS_STORE_LABELS = os.environ.get("METRICS_STORE_LABELS", "0") == "1"
+
+# Buckets en segundos: de 1ms (queries a SQLite) a 30s (timeout de lectura de MP/TN).
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Métricas en memoria por proceso, expuestas en formato texto de Prometheus en /metrics.
+# Con varios workers de uvicorn cada uno expone las suyas (Prometheus las suma).
+Sample = Tuple[Dict[str, str], float]
+Collector = Callable[[], Iterable[Tuple[str, str, str, List[Sample]]]]
+_registry: List["_Metric"] = []
+_collectors: List[Collector] = []
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in items]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str) -> None:
+        # Conteos por bucket no acumulados: observe() es un bisect y dos sumas bajo lock;
+        # la suma acumulada que pide el formato se arma recién al renderizar.
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(counts), total) for k, (counts, total) in self._values.items()]
+        out = []
+        for k, counts, total in items:
+            acc = 0
+            for le, n in zip(self.buckets + (float("inf"),), counts):
+                acc += n
+                le_label = 'le="%s"' % _fmt_value(le)
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, k, le_label)} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, k)} {total!r}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, k)} {acc}")
+        return out
+
+def register_collector(collector: Collector) -> None:
+    # Para valores que ya viven en otro lado (outbox, caches): se leen al momento del scrape.
+    # El collector devuelve (name, type, help, [(labels, value), ...]).
+    _collectors.append(collector)
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collector in _collectors:
+        try:
+            families = list(collector())
+        except Exception:
+            continue
+        for name, kind, help, samples in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                names = tuple(labels)
+                lines.append(f"{name}{_fmt_labels(names, tuple(str(labels[n]) for n in names))} {_fmt_value(value)}")
+    return "\n".join(lines) + "\n"
+
+# ----------------- Label de tienda -----------------
+# El middleware deja un holder en un contextvar y los handlers lo completan al resolver
+# la tienda. run_db/run_io y el threadpool de Starlette copian el contexto, así que
+# el valor escrito desde un thread es visible al cerrar el request.
+_store_ctx: contextvars.ContextVar[Optional[List[str]]] = contextvars.ContextVar("metrics_store", default=None)
+
+def tag_store(tn_store_id: Any) -> None:
+    holder = _store_ctx.get()
+    if holder is not None:
+        holder[0] = str(tn_store_id)
+
+def _store_label() -> Tuple[str, ...]:
+    if not METRICS_STORE_LABELS:
+        return ()
+    holder = _store_ctx.get()
+    return (holder[0] if holder is not None else "",)
+
+_STORE = ("store",) if METRICS_STORE_LABELS else ()
+
+# ----------------- Requests HTTP entrantes -----------------
+http_request_duration = Histogram(
+    "splitpay_http_request_duration_seconds", "Latencia de requests por ruta.", ("route", "method") + _STORE,
+)
+http_request_errors = Counter(
+    "splitpay_http_request_errors_total", "Requests que terminaron en 5xx o con excepción.", ("route", "method", "status") + _STORE,
+)
+http_requests_in_flight = Gauge("splitpay_http_requests_in_flight", "Requests en curso.")
+
+class MetricsMiddleware:
+    # Middleware ASGI puro (sin BaseHTTPMiddleware): no bufferea el body, así que
+    # tampoco rompe respuestas en streaming. La ruta es el template (/split/{split_id}),
+    # no el path, para que la cardinalidad quede acotada.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        token = _store_ctx.set([""])
+        http_requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_requests_in_flight.dec()
+            route = scope.get("route")
+            labels = (getattr(route, "path", None) or "unmatched", scope["method"]) + _store_label()
+            http_request_duration.observe(elapsed, *labels)
+            if status[0] >= 500:
+                http_request_errors.inc(labels[0], labels[1], str(status[0]), *labels[2:])
+            _store_ctx.reset(token)
+
+# ----------------- Llamadas a MP/TN (hook de http_client) -----------------
+upstream_duration = Histogram(
+    "splitpay_upstream_request_duration_seconds", "Latencia por intento de llamadas a APIs externas.", ("call",) + _STORE,
+)
+upstream_errors = Counter(
+    "splitpay_upstream_errors_total", "Intentos fallidos a APIs externas (status >= 400 o error de conexión).", ("call", "reason") + _STORE,
+)
+
+def observe_upstream(call: str, status: Optional[int], elapsed: float, error: Optional[BaseException]) -> None:
+    store = _store_label()
+    upstream_duration.observe(elapsed, call, *store)
+    if error is not None:
+        upstream_errors.inc(call, type(error).__name__, *store)
+    elif status is not None and status >= 400:
+        upstream_errors.inc(call, str(status), *store)
+
+# ----------------- Queries a SQLite (hook de db) -----------------
+db_query_duration = Histogram(
+    "splitpay_db_query_duration_seconds", "Latencia de execute/executemany por tipo de query.", ("query",),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0),
+)
+db_query_errors = Counter("splitpay_db_query_errors_total", "Queries que levantaron excepción.", ("query", "error"))
+
+_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", re.IGNORECASE)
+_QUERY_LABELS_MAX = 1000
+_query_labels: Dict[str, str] = {}
+
+def query_label(sql: str) -> str:
+    # "SELECT splits", "UPDATE outbox", ... Las queries son literales con parámetros,
+    # así que el cache por texto queda acotado; el tope es por si acaso.
+    label = _query_labels.get(sql)
+    if label is None:
+        words = sql.split(None, 1)
+        verb = words[0].upper() if words else ""
+        m = _TABLE_RE.search(sql)
+        label = f"{verb} {m.group(1)}" if m and verb not in ("PRAGMA", "BEGIN", "COMMIT") else verb
+        if len(_query_labels) < _QUERY_LABELS_MAX:
+            _query_labels[sql] = label
+    return label
+
+def observe_query(sql: str, elapsed: float, error: Optional[BaseException]) -> None:
+    label = query_label(sql)
+    db_query_duration.observe(elapsed, label)
+    if error is not None:
+        db_query_errors.inc(label, type(error).__name__)
+
+# ----------------- Rate limit de TN (hook de tn_api) -----------------
+tn_ratelimit_wait = Histogram(
+    "splitpay_tn_ratelimit_wait_seconds", "Espera por el bucket de la tienda antes de cada llamada a TN.", _STORE,
+    buckets=(0.0, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+
+def observe_tn_wait(tn_store_id: str, waited: float) -> None:
+    tn_ratelimit_wait.observe(waited, *((tn_store_id,) if METRICS_STORE_LABELS else ()))
@@ -1,7 +1,25 @@
-import requests
-from typing import Any, Dict
+import os
+import time
+from typing import Any, Dict, List, Optional
 
-MP_PREF_URL = "https://api.mercadopago.com/checkout/preferences"
+from http_client import request, run_io
+
+MP_API_BASE = os.environ.get("MP_API_BASE", "https://api.mercadopago.com")
+MP_PREF_URL = f"{MP_API_BASE}/checkout/preferences"
+# Vencimiento de los links de pago (expiration_date_to). Se guarda en
+# split_payments.preference_expires_at y retention solo borra splits abandonados cuyos
+# links ya vencieron. 0 = sin vencimiento.
+MP_PREFERENCE_EXPIRATION_DAYS = float(os.environ.get("MP_PREFERENCE_EXPIRATION_DAYS", "7"))
+
+def preference_expires_at() -> Optional[float]:
+    if MP_PREFERENCE_EXPIRATION_DAYS <= 0:
+        return None
+    return time.time() + MP_PREFERENCE_EXPIRATION_DAYS * 86400
+
+def expiration_fields(expires_at: Optional[float]) -> Dict[str, Any]:
+    if expires_at is None:
+        return {}
+    return {"expires": True, "expiration_date_to": time.strftime("%Y-%m-%dT%H:%M:%S.000-00:00", time.gmtime(expires_at))}
 
 def create_preference(access_token: str, preference: Dict[str, Any]) -> Dict[str, Any]:
     headers = {
@@ -9,13 +27,26 @@ def create_preference(access_token: str, preference: Dict[str, Any]) -> Dict[str
         "Content-Type": "application/json",
         "Accept": "application/json",
     }
-    r = requests.post(MP_PREF_URL, headers=headers, json=preference, timeout=30)
+    r = request("mp", "POST", MP_PREF_URL, call="mp.create_preference", headers=headers, json=preference)
     r.raise_for_status()
     return r.json()
 
 def get_payment(access_token: str, payment_id: str) -> Dict[str, Any]:
-    url = f"https://api.mercadopago.com/v1/payments/{payment_id}"
+    url = f"{MP_API_BASE}/v1/payments/{payment_id}"
     headers = {"Authorization": f"Bearer {access_token}"}
-    r = requests.get(url, headers=headers, timeout=30)
+    r = request("mp", "GET", url, call="mp.get_payment", headers=headers)
     r.raise_for_status()
     return r.json()
+
+def search_payments(access_token: str, external_reference: str, limit: int = 30) -> List[Dict[str, Any]]:
+    # Pagos con ese external_reference, más recientes primero. Un split:grupo puede tener
+    # varios (p.ej. uno rechazado y después uno aprobado).
+    url = f"{MP_API_BASE}/v1/payments/search"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    params = {"external_reference": external_reference, "sort": "date_created", "criteria": "desc", "limit": limit}
+    r = request("mp", "GET", url, call="mp.search_payments", headers=headers, params=params)
+    r.raise_for_status()
+    return r.json().get("results") or []
+
+async def get_payment_async(access_token: str, payment_id: str) -> Dict[str, Any]:
+    return await run_io(get_payment, access_token, payment_id)
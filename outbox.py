@@ -0,0 +1,157 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from db import get_db, after_commit
+
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", "1"))
+# Tiene que cubrir el peor caso de un handler: tn_order con los defaults son hasta
+# 4 intentos (TN_RATE_MAX_429_RETRIES + 1) x (10s de espera + 5s connect + 30s read) = 180s.
+OUTBOX_LEASE_S = float(os.environ.get("OUTBOX_LEASE_S", "600"))
+OUTBOX_BACKOFF_BASE = float(os.environ.get("OUTBOX_BACKOFF_BASE", "2"))
+OUTBOX_BACKOFF_MAX = float(os.environ.get("OUTBOX_BACKOFF_MAX", "600"))
+
+# Outbox transaccional: los jobs se encolan en la misma transacción que el cambio de
+# estado que los origina y un pool de workers los procesa en background.
+# Estados: pending -> processing -> done | pending (reintento con backoff) | dead.
+# Cada claim deja (attempts, next_attempt_at) como token: _finish solo escribe si el job
+# sigue siendo de ese claim, así un worker cuyo lease venció no pisa al que lo retomó.
+
+class PermanentJobError(Exception):
+    # El handler la levanta cuando reintentar no tiene sentido (p.ej. un 4xx): va directo a dead.
+    pass
+
+class RetryLater(Exception):
+    # El handler no pudo ni intentar (p.ej. rate limit propio): se reprograma en `delay`
+    # segundos sin contar el intento, así la espera no lo acerca a dead.
+    def __init__(self, delay: float, reason: str = ""):
+        super().__init__(reason or f"reintentar en {delay:.1f}s")
+        self.delay = delay
+
+JobHandler = Callable[[Dict[str, Any]], None]
+_handlers: Dict[str, JobHandler] = {}
+_wakeup = threading.Event()
+_stop = threading.Event()
+_threads: List[threading.Thread] = []
+# Resultados de run_job en este proceso; los 'done' no se cuentan en la tabla (crece sin
+# parar hasta que retention la poda).
+_results_lock = threading.Lock()
+_results: Dict[str, int] = {"done": 0, "retry": 0, "deferred": 0, "dead": 0, "lost": 0}
+
+def register_handler(kind: str, handler: JobHandler) -> None:
+    _handlers[kind] = handler
+
+def enqueue(db: sqlite3.Connection, kind: str, dedupe_key: str, payload: Dict[str, Any]) -> bool:
+    # Idempotente por (kind, dedupe_key): una redelivery no genera un segundo job.
+    cur = db.execute(
+        "INSERT OR IGNORE INTO outbox (kind, dedupe_key, payload_json, next_attempt_at) VALUES (?,?,?,?)",
+        (kind, dedupe_key, json.dumps(payload, ensure_ascii=False), time.time()),
+    )
+    if cur.rowcount:
+        after_commit(_wakeup.set)
+    return bool(cur.rowcount)
+
+def _claim() -> Optional[Dict[str, Any]]:
+    # Un solo UPDATE ... RETURNING: atómico entre workers y procesos. Un job en
+    # processing cuyo lease venció (worker caído) se vuelve a tomar.
+    now = time.time()
+    with get_db() as db:
+        row = db.execute(
+            "UPDATE outbox SET status='processing', attempts=attempts+1, next_attempt_at=?, updated_at=datetime('now') "
+            "WHERE id = (SELECT id FROM outbox WHERE status IN ('pending','processing') AND next_attempt_at <= ? "
+            "ORDER BY next_attempt_at LIMIT 1) "
+            "RETURNING id, kind, dedupe_key, payload_json, attempts, next_attempt_at AS lease_until",
+            (now + OUTBOX_LEASE_S, now),
+        ).fetchone()
+        return dict(row) if row else None
+
+def _finish(job: Dict[str, Any], status: str, next_attempt_at: float = 0, error: Optional[str] = None, refund_attempt: bool = False) -> bool:
+    # Devuelve False si el job ya no es de este claim (lease vencido y retomado).
+    with get_db() as db:
+        cur = db.execute(
+            "UPDATE outbox SET status=?, next_attempt_at=?, last_error=?, attempts=attempts-?, updated_at=datetime('now') "
+            "WHERE id=? AND status='processing' AND attempts=? AND next_attempt_at=?",
+            (status, next_attempt_at, error, 1 if refund_attempt else 0, job["id"], job["attempts"], job["lease_until"]),
+        )
+        return bool(cur.rowcount)
+
+def _backoff(attempts: int) -> float:
+    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+def run_job(job: Dict[str, Any]) -> str:
+    result = _run_job(job)
+    with _results_lock:
+        _results[result] += 1
+    return result
+
+def _run_job(job: Dict[str, Any]) -> str:
+    handler = _handlers.get(job["kind"])
+    try:
+        if handler is None:
+            raise PermanentJobError(f"sin handler para {job['kind']}")
+        handler(json.loads(job["payload_json"]))
+    except PermanentJobError as e:
+        return "dead" if _finish(job, "dead", error=str(e)[:1000]) else "lost"
+    except RetryLater as e:
+        ok = _finish(job, "pending", time.time() + e.delay * random.uniform(1.0, 1.2), str(e)[:1000], refund_attempt=True)
+        return "deferred" if ok else "lost"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"[:1000]
+        if job["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            return "dead" if _finish(job, "dead", error=error) else "lost"
+        return "retry" if _finish(job, "pending", time.time() + _backoff(job["attempts"]), error) else "lost"
+    return "done" if _finish(job, "done") else "lost"
+
+def _worker() -> None:
+    while not _stop.is_set():
+        try:
+            job = _claim()
+        except sqlite3.Error:
+            job = None
+        if job is None:
+            _wakeup.wait(OUTBOX_POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        try:
+            run_job(job)
+        except sqlite3.Error:
+            # No se pudo registrar el resultado: el job se retoma cuando venza el lease.
+            pass
+
+def start_workers(n: int = OUTBOX_WORKERS) -> None:
+    if _threads:
+        return
+    _stop.clear()
+    for i in range(n):
+        t = threading.Thread(target=_worker, name=f"outbox-{i}", daemon=True)
+        t.start()
+        _threads.append(t)
+
+def stop_workers(timeout: float = 5) -> None:
+    _stop.set()
+    _wakeup.set()
+    for t in _threads:
+        t.join(timeout)
+    _threads.clear()
+
+def stats() -> Dict[str, int]:
+    # Solo los estados que no se acumulan, por el índice (status, next_attempt_at): el
+    # costo depende de la cola, no del historial de jobs terminados.
+    out = {"pending": 0, "processing": 0, "dead": 0}
+    with get_db() as db:
+        for r in db.execute(
+            "SELECT status, COUNT(*) AS n FROM outbox WHERE status IN ('pending','processing','dead') GROUP BY status"
+        ).fetchall():
+            out[r["status"]] = int(r["n"])
+    return out
+
+def result_counts() -> Dict[str, int]:
+    with _results_lock:
+        return dict(_results)
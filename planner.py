@@ -0,0 +1,176 @@
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from rules import RuleIndex
+
+# Tramos de cuotas por defecto (los de siempre) y costos de envío por defecto. Cada
+# tienda puede pisarlos desde el dashboard (columnas de stores, ver db.STORE_SETTINGS_V9).
+DEFAULT_INSTALLMENT_TIERS: Tuple[int, ...] = (12, 6, 0)
+DEFAULT_SHIPPING_RATES: Dict[str, int] = {"retiro": 0, "estandar": 2500, "express": 4500}
+PLANNER_MIN_INSTALLMENT_AMOUNT = int(os.environ.get("PLANNER_MIN_INSTALLMENT_AMOUNT", "0"))
+MAX_TIER = 72
+
+def group_key(tier: int) -> str:
+    return f"group_{tier}"
+
+# ----------------- Configuración por tienda -----------------
+def parse_tiers(text: Any) -> Tuple[int, ...]:
+    # "18, 12, 6, 3" -> (18, 12, 6, 3, 0). 1 cuota es lo mismo que sin cuotas (0), y 0
+    # siempre está: es el grupo de los items que no alcanzan ningún tramo.
+    tiers = {0}
+    for part in str(text or "").replace(";", ",").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        n = int(part)
+        if n < 0 or n > MAX_TIER:
+            raise ValueError(f"tramo fuera de rango: {n}")
+        tiers.add(n if n > 1 else 0)
+    return tuple(sorted(tiers, reverse=True))
+
+def format_tiers(tiers: Tuple[int, ...]) -> str:
+    return ", ".join(str(t) for t in tiers)
+
+def parse_shipping_rates(text: str) -> Dict[str, int]:
+    # Una línea por método: "estandar=2500".
+    rates: Dict[str, int] = {}
+    for line in (text or "").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        method, sep, price = line.partition("=")
+        method = method.strip()
+        if not sep or not method:
+            raise ValueError(f"línea inválida: {line}")
+        cost = int(price.strip())
+        if cost < 0:
+            raise ValueError(f"costo negativo: {line}")
+        rates[method] = cost
+    if not rates:
+        raise ValueError("al menos un método de envío")
+    return rates
+
+def format_shipping_rates(rates: Dict[str, int]) -> str:
+    return "\n".join(f"{m}={c}" for m, c in rates.items())
+
+def store_tiers(store: Dict[str, Any]) -> Tuple[int, ...]:
+    text = store.get("installment_tiers")
+    if not text:
+        return DEFAULT_INSTALLMENT_TIERS
+    try:
+        return parse_tiers(text)
+    except ValueError:
+        return DEFAULT_INSTALLMENT_TIERS
+
+def store_shipping_rates(store: Dict[str, Any]) -> Dict[str, int]:
+    raw = store.get("shipping_rates_json")
+    if not raw:
+        return dict(DEFAULT_SHIPPING_RATES)
+    try:
+        return {str(m): int(c) for m, c in json.loads(raw).items()}
+    except (ValueError, TypeError, AttributeError):
+        return dict(DEFAULT_SHIPPING_RATES)
+
+def store_min_installment_amount(store: Dict[str, Any]) -> int:
+    return int(store.get("min_installment_amount") or 0) or PLANNER_MIN_INSTALLMENT_AMOUNT
+
+# ----------------- Planner -----------------
+# Cada item va al tramo más alto que su regla permite (RuleIndex.tier_for, memoizado por
+# versión del índice). Los items quedan agrupados por tramo y se barren de mayor a menor:
+# si un grupo no llega al monto mínimo por cuota se baja entero al tramo siguiente
+# (bajar siempre es válido, subir no). El resultado es un pago por tramo usado, y ninguno
+# con cuotas por debajo del mínimo de la tienda.
+def _sweep(
+    subtotals: Dict[int, int],
+    tiers: Tuple[int, ...],
+    min_installment_amount: int,
+    shipping_cost: int,
+    shipping_tier: Optional[int],
+) -> Tuple[Dict[int, int], Optional[int]]:
+    dest: Dict[int, int] = {}
+    ship_dest = None
+    carry: List[int] = []
+    carry_total = 0
+    carry_ship = False
+    for t in tiers:
+        own = subtotals.get(t)
+        if own is None and not carry:
+            continue
+        sources = carry + ([t] if own is not None else [])
+        total = carry_total + (own or 0)
+        ships = carry_ship or shipping_tier == t
+        amount = total + (shipping_cost if ships else 0)
+        if t > 0 and min_installment_amount > 0 and amount < min_installment_amount * t:
+            carry, carry_total, carry_ship = sources, total, ships
+            continue
+        for s in sources:
+            dest[s] = t
+        if ships:
+            ship_dest = t
+        carry, carry_total, carry_ship = [], 0, False
+    return dest, ship_dest
+
+def _line_total(it: Dict[str, Any]) -> int:
+    return int(it.get("price", 0)) * int(it.get("quantity", 1))
+
+def _tier_of_group(shipping_group: Optional[str]) -> Optional[int]:
+    if shipping_group and shipping_group.startswith("group_"):
+        try:
+            return int(shipping_group[len("group_"):])
+        except ValueError:
+            return None
+    return None
+
+def plan(
+    items: List[Dict[str, Any]],
+    index: RuleIndex,
+    tiers: Tuple[int, ...] = DEFAULT_INSTALLMENT_TIERS,
+    min_installment_amount: int = 0,
+    shipping_cost: int = 0,
+    shipping_group: Optional[str] = None,
+) -> Tuple[Dict[str, Dict[str, Any]], Optional[str]]:
+    # Devuelve ({group_key: {max_installments, items, subtotal}}, grupo que paga el envío),
+    # solo con grupos no vacíos, de más a menos cuotas.
+    buckets: Dict[int, List[Dict[str, Any]]] = {}
+    subtotals: Dict[int, int] = {}
+    for it in items:
+        t = index.tier_for(it, tiers)
+        buckets.setdefault(t, []).append(it)
+        subtotals[t] = subtotals.get(t, 0) + _line_total(it)
+
+    dest, ship_dest = _sweep(subtotals, tiers, min_installment_amount, shipping_cost, _tier_of_group(shipping_group))
+    groups: Dict[str, Dict[str, Any]] = {}
+    for t in tiers:
+        if t not in buckets:
+            continue
+        g = groups.setdefault(group_key(dest[t]), {"max_installments": dest[t], "items": [], "subtotal": 0})
+        g["items"].extend(buckets[t])
+        g["subtotal"] += subtotals[t]
+    return groups, (group_key(ship_dest) if ship_dest is not None else None)
+
+def plan_totals(
+    items: List[Dict[str, Any]],
+    index: RuleIndex,
+    tiers: Tuple[int, ...] = DEFAULT_INSTALLMENT_TIERS,
+    min_installment_amount: int = 0,
+    shipping_cost: int = 0,
+    shipping_group: Optional[str] = None,
+) -> Tuple[Dict[str, Dict[str, Any]], Optional[str]]:
+    # Igual que plan() pero sin copiar items: subtotal y cantidad de líneas por grupo.
+    subtotals: Dict[int, int] = {}
+    lines: Dict[int, int] = {}
+    for it in items:
+        t = index.tier_for(it, tiers)
+        subtotals[t] = subtotals.get(t, 0) + _line_total(it)
+        lines[t] = lines.get(t, 0) + 1
+
+    dest, ship_dest = _sweep(subtotals, tiers, min_installment_amount, shipping_cost, _tier_of_group(shipping_group))
+    groups: Dict[str, Dict[str, Any]] = {}
+    for t in tiers:
+        if t not in subtotals:
+            continue
+        g = groups.setdefault(group_key(dest[t]), {"max_installments": dest[t], "subtotal": 0, "lines": 0})
+        g["subtotal"] += subtotals[t]
+        g["lines"] += lines[t]
+    return groups, (group_key(ship_dest) if ship_dest is not None else None)
@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+
+import store_cache
+from db import get_db
+from mp_api import search_payments
+
+RECONCILE_INTERVAL_S = float(os.environ.get("RECONCILE_INTERVAL_S", "300"))  # 0 = sin sweeper en background
+RECONCILE_STALE_S = int(os.environ.get("RECONCILE_STALE_S", "900"))
+RECONCILE_RECHECK_S = float(os.environ.get("RECONCILE_RECHECK_S", "1800"))
+RECONCILE_MAX_AGE_S = int(os.environ.get("RECONCILE_MAX_AGE_S", str(7 * 24 * 3600)))
+RECONCILE_MAX_PER_SWEEP = int(os.environ.get("RECONCILE_MAX_PER_SWEEP", "500"))
+RECONCILE_BATCH_SIZE = int(os.environ.get("RECONCILE_BATCH_SIZE", "50"))
+RECONCILE_CONCURRENCY = int(os.environ.get("RECONCILE_CONCURRENCY", "4"))
+RECONCILE_RATE_PER_S = float(os.environ.get("RECONCILE_RATE_PER_S", "5"))  # llamadas a MP por token
+
+# Conciliación de pagos que quedaron sin webhook: cada sweep toma los split_payments
+# pendientes con más de RECONCILE_STALE_S, los agrupa por token de MP (el de la tienda o
+# el default), busca cada external_reference en MP con un ritmo máximo por token y
+# aplica los cambios de cada lote en una sola transacción (mismo camino que el webhook).
+# La columna reconciled_at se marca al tomar los pagos, así un pago se consulta a lo
+# sumo una vez cada RECONCILE_RECHECK_S aunque corran varios procesos.
+
+# (payment_id, status, split_id, group_key)
+Update = Tuple[str, str, str, str]
+Applier = Callable[[List[Update]], int]
+_applier: Optional[Applier] = None
+
+_stop = threading.Event()
+_thread: Optional[threading.Thread] = None
+# Un solo pool para todos los sweeps: sus threads (y sus conexiones de db) se reusan.
+_executor: Optional[ThreadPoolExecutor] = None
+_sweep_lock = threading.Lock()
+_lock = threading.Lock()
+_counters: Dict[str, float] = {
+    "sweeps": 0, "checked": 0, "updated": 0, "unchanged": 0, "not_found": 0, "errors": 0, "no_token": 0,
+    "last_sweep_at": 0, "last_sweep_s": 0,
+}
+
+def set_applier(applier: Applier) -> None:
+    # main registra la función que escribe los estados (la misma que usa el webhook).
+    global _applier
+    _applier = applier
+
+class _Pacer:
+    # Espaciado mínimo entre llamadas con el mismo token, compartido entre lotes.
+    def __init__(self, rate_per_s: float):
+        self.interval = 1.0 / rate_per_s if rate_per_s > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+_pacers: Dict[str, _Pacer] = {}
+
+def _pacer(token: str) -> _Pacer:
+    with _lock:
+        pacer = _pacers.get(token)
+        if pacer is None:
+            pacer = _pacers[token] = _Pacer(RECONCILE_RATE_PER_S)
+        return pacer
+
+def _claim(limit: int) -> List[Dict[str, Any]]:
+    # Primero los que nunca se consultaron y después los consultados hace más tiempo:
+    # ordenando por created_at, los links viejos que nadie pagó (siguen en created) se
+    # volvían a tomar primero en cada sweep y los nuevos esperaban detrás.
+    now = time.time()
+    with get_db() as db:
+        rows = db.execute(
+            "UPDATE split_payments SET reconciled_at=? WHERE id IN ("
+            "SELECT id FROM split_payments WHERE status IN ('created','pending','in_process','authorized','in_mediation') "
+            "AND created_at <= datetime('now', ?) AND created_at >= datetime('now', ?) "
+            "AND (reconciled_at IS NULL OR reconciled_at <= ?) ORDER BY reconciled_at NULLS FIRST, created_at LIMIT ?) "
+            "RETURNING split_id, group_key, mp_payment_id, status",
+            (now, f"-{RECONCILE_STALE_S} seconds", f"-{RECONCILE_MAX_AGE_S} seconds", now - RECONCILE_RECHECK_S, limit),
+        ).fetchall()
+        rows = [dict(r) for r in rows]
+        if rows:
+            split_ids = sorted({r["split_id"] for r in rows})
+            stores = {s["id"]: s["store_id"] for s in db.execute(
+                "SELECT id, store_id FROM splits WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(split_ids),)
+            ).fetchall()}
+            for r in rows:
+                r["store_id"] = stores.get(r["split_id"])
+    return rows
+
+def _pick(results: List[Dict[str, Any]]) -> Optional[Tuple[str, str]]:
+    # Si alguno está aprobado gana ese; si no, el más reciente (MP los devuelve así).
+    for p in results:
+        if p.get("status") == "approved":
+            return str(p["id"]), "approved"
+    for p in results:
+        if p.get("id") is not None and p.get("status"):
+            return str(p["id"]), p["status"]
+    return None
+
+def _reconcile_batch(token: str, rows: List[Dict[str, Any]]) -> Dict[str, int]:
+    out = {"checked": 0, "updated": 0, "unchanged": 0, "not_found": 0, "errors": 0}
+    pacer = _pacer(token)
+    updates: List[Update] = []
+    for r in rows:
+        pacer.wait()
+        try:
+            results = search_payments(token, f"{r['split_id']}:{r['group_key']}")
+        except (requests.RequestException, ValueError):
+            out["errors"] += 1
+            continue
+        out["checked"] += 1
+        picked = _pick(results)
+        if picked is None:
+            out["not_found"] += 1
+        elif picked[1] == r["status"] and picked[0] == r["mp_payment_id"]:
+            out["unchanged"] += 1
+        else:
+            updates.append((picked[0], picked[1], r["split_id"], r["group_key"]))
+    if updates and _applier is not None:
+        out["updated"] = _applier(updates)
+        out["unchanged"] += len(updates) - out["updated"]
+    return out
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=max(1, RECONCILE_CONCURRENCY), thread_name_prefix="reconcile")
+        return _executor
+
+def sweep(default_token: str = "", limit: int = RECONCILE_MAX_PER_SWEEP) -> Dict[str, Any]:
+    if not _sweep_lock.acquire(blocking=False):
+        return {"busy": True}
+    start = time.perf_counter()
+    try:
+        rows = _claim(limit)
+        by_token: Dict[str, List[Dict[str, Any]]] = {}
+        no_token = 0
+        for r in rows:
+            store = store_cache.get_by_id(r["store_id"]) if r["store_id"] is not None else None
+            token = (store or {}).get("mp_access_token") or default_token
+            if not token:
+                no_token += 1
+                continue
+            by_token.setdefault(token, []).append(r)
+
+        # Lotes intercalados entre tokens: con RECONCILE_CONCURRENCY workers las tiendas
+        # avanzan en paralelo y cada una a su propio ritmo.
+        per_token = [
+            [(token, rs[i:i + RECONCILE_BATCH_SIZE]) for i in range(0, len(rs), RECONCILE_BATCH_SIZE)]
+            for token, rs in by_token.items()
+        ]
+        batches = [b for group in zip_longest(*per_token) for b in group if b is not None]
+        result = {"claimed": len(rows), "no_token": no_token, "checked": 0, "updated": 0, "unchanged": 0, "not_found": 0, "errors": 0}
+        if batches:
+            for out in _get_executor().map(lambda b: _reconcile_batch(*b), batches):
+                for k, v in out.items():
+                    result[k] += v
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _counters["sweeps"] += 1
+            for k in ("checked", "updated", "unchanged", "not_found", "errors", "no_token"):
+                _counters[k] += result[k]
+            _counters["last_sweep_at"] = time.time()
+            _counters["last_sweep_s"] = elapsed
+        result["elapsed_s"] = round(elapsed, 3)
+        return result
+    finally:
+        _sweep_lock.release()
+
+def _loop(default_token: str) -> None:
+    while not _stop.wait(RECONCILE_INTERVAL_S):
+        try:
+            sweep(default_token)
+        except Exception:
+            # Lo que quedó tomado se reintenta en RECONCILE_RECHECK_S.
+            pass
+
+def start(default_token: str = "") -> None:
+    global _thread
+    if _thread is not None or RECONCILE_INTERVAL_S <= 0:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_loop, args=(default_token,), name="reconcile", daemon=True)
+    _thread.start()
+
+def stop(timeout: float = 5) -> None:
+    global _thread, _executor
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout)
+        _thread = None
+    with _lock:
+        ex, _executor = _executor, None
+    if ex is not None:
+        ex.shutdown(wait=False)
+
+def stats() -> Dict[str, float]:
+    with _lock:
+        return dict(_counters)
@@ -0,0 +1,281 @@
+import argparse
+import gzip
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from db import get_db, init_db
+
+RETENTION_INTERVAL_S = float(os.environ.get("RETENTION_INTERVAL_S", "3600"))  # 0 = sin limpieza en background
+RETENTION_ABANDONED_DAYS = float(os.environ.get("RETENTION_ABANDONED_DAYS", "14"))
+RETENTION_ARCHIVE_DAYS = float(os.environ.get("RETENTION_ARCHIVE_DAYS", "90"))  # 0 = no archivar
+RETENTION_ARCHIVE_DIR = os.environ.get("RETENTION_ARCHIVE_DIR", "archive")
+RETENTION_OUTBOX_DAYS = float(os.environ.get("RETENTION_OUTBOX_DAYS", "7"))  # jobs 'done'; 0 = no borrar
+RETENTION_EVENTS_DAYS = float(os.environ.get("RETENTION_EVENTS_DAYS", "30"))  # processed_events; 0 = no borrar
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", "200"))
+RETENTION_BATCH_PAUSE_S = float(os.environ.get("RETENTION_BATCH_PAUSE_S", "0.05"))
+RETENTION_MAX_BATCHES = int(os.environ.get("RETENTION_MAX_BATCHES", "50"))
+RETENTION_VACUUM_PAGES = int(os.environ.get("RETENTION_VACUUM_PAGES", "1000"))
+RETENTION_VACUUM_MAX_STEPS = int(os.environ.get("RETENTION_VACUUM_MAX_STEPS", "100"))
+RETENTION_LEASE_S = float(os.environ.get("RETENTION_LEASE_S", "900"))
+
+# Retención de splits, en corridas periódicas:
+#  - abandonados: splits 'created' más viejos que RETENTION_ABANDONED_DAYS sin ningún
+#    pago en MP y sin links de pago vigentes se borran (el CASCADE se lleva grupos,
+#    items y links). Un link sin vencimiento (preference_expires_at NULL) nunca vence.
+#  - archivo: los 'completed' más viejos que RETENTION_ARCHIVE_DAYS se escriben a un
+#    segmento diario .jsonl.gz (un miembro gzip por lote) y recién después se borran;
+#    archived_splits guarda segmento y offset para leerlos con lookup_archived().
+#  - outbox y processed_events: los jobs 'done' más viejos que RETENTION_OUTBOX_DAYS y
+#    los eventos más viejos que RETENTION_EVENTS_DAYS se borran. Una notificación tardía
+#    de un pago ya aprobado no vuelve a encolar la orden (ver _apply_payment_statuses),
+#    así que borrarlos no duplica órdenes en TN. Los 'dead' quedan para revisarlos a mano.
+#  - incremental_vacuum devuelve al disco las páginas liberadas.
+# Todo va en lotes de RETENTION_BATCH_SIZE, cada uno en su propia transacción corta y
+# con una pausa entre lotes, así el lock de escritura nunca se sostiene mucho tiempo.
+# store_split_stats no se toca: los agregados del dashboard siguen contando lo borrado.
+
+_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+_stop = threading.Event()
+_thread: Optional[threading.Thread] = None
+_lock = threading.Lock()
+_counters: Dict[str, float] = {
+    "runs": 0, "abandoned_deleted": 0, "archived": 0, "outbox_deleted": 0, "events_deleted": 0, "vacuumed_pages": 0,
+    "last_run_at": 0, "last_run_s": 0,
+}
+
+def _age(days: float) -> str:
+    return f"-{int(days * 86400)} seconds"
+
+def _take_lease() -> bool:
+    # Un solo proceso limpia a la vez; si el dueño se cae, el lease vence solo.
+    now = time.time()
+    with get_db() as db:
+        row = db.execute(
+            "INSERT INTO maintenance_leases (name, owner, expires_at) VALUES ('retention', ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at "
+            "WHERE maintenance_leases.expires_at < ? OR maintenance_leases.owner = excluded.owner "
+            "RETURNING owner",
+            (_OWNER, now + RETENTION_LEASE_S, now),
+        ).fetchone()
+    return row is not None
+
+def _release_lease() -> None:
+    with get_db() as db:
+        db.execute("DELETE FROM maintenance_leases WHERE name='retention' AND owner=?", (_OWNER,))
+
+def _delete_abandoned_batch(limit: int) -> int:
+    # Selección y borrado en la misma sentencia: un pago que llega en el medio no se pierde.
+    with get_db() as db:
+        cur = db.execute(
+            "DELETE FROM splits WHERE id IN (SELECT s.id FROM splits s WHERE s.status='created' "
+            "AND s.created_at < datetime('now', ?) AND NOT EXISTS "
+            "(SELECT 1 FROM split_payments p WHERE p.split_id = s.id AND (p.mp_payment_id IS NOT NULL OR "
+            "(p.mp_preference_id IS NOT NULL AND (p.preference_expires_at IS NULL OR p.preference_expires_at > datetime('now'))))) "
+            "ORDER BY s.created_at LIMIT ?)",
+            (_age(RETENTION_ABANDONED_DAYS), limit),
+        )
+        return cur.rowcount
+
+def _delete_outbox_batch(limit: int) -> int:
+    # Por el índice (status, next_attempt_at): los 'done' tienen next_attempt_at=0 y salen
+    # en orden de id, los más viejos primero.
+    with get_db() as db:
+        cur = db.execute(
+            "DELETE FROM outbox WHERE id IN (SELECT id FROM outbox WHERE status='done' "
+            "AND updated_at < datetime('now', ?) LIMIT ?)",
+            (_age(RETENTION_OUTBOX_DAYS), limit),
+        )
+        return cur.rowcount
+
+def _delete_events_batch(limit: int) -> int:
+    with get_db() as db:
+        cur = db.execute(
+            "DELETE FROM processed_events WHERE (payment_id, status) IN (SELECT payment_id, status FROM processed_events "
+            "WHERE processed_at < datetime('now', ?) ORDER BY processed_at LIMIT ?)",
+            (_age(RETENTION_EVENTS_DAYS), limit),
+        )
+        return cur.rowcount
+
+def _write_segment(records: List[Dict[str, Any]]) -> Tuple[str, int]:
+    # Miembros gzip concatenados: el archivo completo se lee con gzip.open y cada lote
+    # se puede leer solo haciendo seek a su offset.
+    os.makedirs(RETENTION_ARCHIVE_DIR, exist_ok=True)
+    segment = time.strftime("splits-%Y%m%d.jsonl.gz", time.gmtime())
+    data = "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in records)
+    with open(os.path.join(RETENTION_ARCHIVE_DIR, segment), "ab") as f:
+        offset = f.tell()
+        f.write(gzip.compress(data.encode("utf-8")))
+        f.flush()
+        os.fsync(f.fileno())
+    return segment, offset
+
+def _archive_batch(limit: int) -> int:
+    # Quedan afuera los splits con órdenes de TN todavía pendientes en el outbox.
+    with get_db() as db:
+        splits = [dict(r) for r in db.execute(
+            "SELECT * FROM splits s WHERE s.status='completed' AND s.created_at < datetime('now', ?) AND NOT EXISTS "
+            "(SELECT 1 FROM outbox o WHERE o.kind='tn_order' AND o.dedupe_key > s.id || ':' AND o.dedupe_key < s.id || ';' "
+            "AND o.status IN ('pending','processing')) ORDER BY s.created_at LIMIT ?",
+            (_age(RETENTION_ARCHIVE_DAYS), limit),
+        ).fetchall()]
+        if not splits:
+            return 0
+        ids = json.dumps([s["id"] for s in splits])
+        children: Dict[str, Dict[str, List[Dict[str, Any]]]] = {s["id"]: {"groups": [], "items": [], "payments": []} for s in splits}
+        for key, sql in (
+            ("groups", "SELECT * FROM split_groups WHERE split_id IN (SELECT value FROM json_each(?)) ORDER BY split_id, max_installments DESC"),
+            ("items", "SELECT * FROM split_items WHERE split_id IN (SELECT value FROM json_each(?)) ORDER BY split_id, line"),
+            ("payments", "SELECT * FROM split_payments WHERE split_id IN (SELECT value FROM json_each(?)) ORDER BY split_id, id"),
+        ):
+            for r in db.execute(sql, (ids,)).fetchall():
+                row = dict(r)
+                children[row.pop("split_id")][key].append(row)
+
+    records = [dict(s, **children[s["id"]]) for s in splits]
+    segment, offset = _write_segment(records)
+    # Entre la lectura y este DELETE un webhook puede haber cambiado el split (refund,
+    # contracargo: sube version). Solo se borran los que siguen completed y con la misma
+    # version que se archivó; el resto queda en el segmento sin indexar y se vuelve a
+    # archivar en otro lote. Si el proceso se cae entre el write y el commit, el próximo
+    # lote vuelve a archivar esos splits en otro miembro y el índice apunta al último.
+    # El + en status evita que el planner recorra idx_splits_status_created en vez de la PK.
+    versions = json.dumps({s["id"]: s["version"] for s in splits})
+    with get_db() as db:
+        deleted = {r["id"] for r in db.execute(
+            "DELETE FROM splits WHERE id IN (SELECT key FROM json_each(?)) AND +status='completed' "
+            "AND version = json_extract(?, '$.' || json_quote(id)) RETURNING id",
+            (versions, versions),
+        ).fetchall()}
+        db.executemany(
+            "INSERT OR REPLACE INTO archived_splits (split_id, store_id, segment, member_offset, created_at) VALUES (?,?,?,?,?)",
+            [(s["id"], s["store_id"], segment, offset, s["created_at"]) for s in splits if s["id"] in deleted],
+        )
+    return len(deleted)
+
+def lookup_archived(split_id: str) -> Optional[Dict[str, Any]]:
+    # El split tal como estaba al archivarse, con groups, items y payments.
+    with get_db() as db:
+        row = db.execute("SELECT segment, member_offset FROM archived_splits WHERE split_id=?", (split_id,)).fetchone()
+    if not row:
+        return None
+    with open(os.path.join(RETENTION_ARCHIVE_DIR, row["segment"]), "rb") as f:
+        f.seek(row["member_offset"])
+        with gzip.GzipFile(fileobj=f) as gz:
+            for line in gz:
+                record = json.loads(line)
+                if record.get("id") == split_id:
+                    return record
+    return None
+
+def incremental_vacuum() -> int:
+    # Sin auto_vacuum=INCREMENTAL (bases creadas antes de habilitarlo) no hace nada.
+    with get_db() as db:
+        if db.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0
+    freed = 0
+    for _ in range(RETENTION_VACUUM_MAX_STEPS):
+        with get_db() as db:
+            before = db.execute("PRAGMA freelist_count").fetchone()[0]
+            if not before:
+                break
+            # executescript corre el pragma hasta el final (execute liberaría una sola página).
+            db.executescript(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES})")
+            freed += before - db.execute("PRAGMA freelist_count").fetchone()[0]
+        if _stop.wait(RETENTION_BATCH_PAUSE_S):
+            break
+    if freed:
+        with get_db() as db:
+            db.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+    return freed
+
+def enable_incremental_vacuum() -> None:
+    # Conversión de una base existente: un VACUUM completo, con lock exclusivo mientras
+    # dura. Correrlo a mano en una ventana tranquila.
+    with get_db() as db:
+        db.executescript("PRAGMA auto_vacuum = INCREMENTAL; VACUUM")
+
+def _batches(fn, limit: int) -> int:
+    total = 0
+    for _ in range(RETENTION_MAX_BATCHES):
+        n = fn(limit)
+        total += n
+        if n < limit or _stop.wait(RETENTION_BATCH_PAUSE_S):
+            break
+    return total
+
+def run_once() -> Dict[str, Any]:
+    if not _take_lease():
+        return {"busy": True}
+    start = time.perf_counter()
+    try:
+        result = {"abandoned_deleted": 0, "archived": 0, "outbox_deleted": 0, "events_deleted": 0, "vacuumed_pages": 0}
+        if RETENTION_ABANDONED_DAYS > 0:
+            result["abandoned_deleted"] = _batches(_delete_abandoned_batch, RETENTION_BATCH_SIZE)
+        if RETENTION_ARCHIVE_DAYS > 0:
+            result["archived"] = _batches(_archive_batch, RETENTION_BATCH_SIZE)
+        if RETENTION_OUTBOX_DAYS > 0:
+            result["outbox_deleted"] = _batches(_delete_outbox_batch, RETENTION_BATCH_SIZE)
+        if RETENTION_EVENTS_DAYS > 0:
+            result["events_deleted"] = _batches(_delete_events_batch, RETENTION_BATCH_SIZE)
+        result["vacuumed_pages"] = incremental_vacuum()
+    finally:
+        _release_lease()
+    elapsed = time.perf_counter() - start
+    with _lock:
+        _counters["runs"] += 1
+        for k, v in result.items():
+            _counters[k] += v
+        _counters["last_run_at"] = time.time()
+        _counters["last_run_s"] = elapsed
+    result["elapsed_s"] = round(elapsed, 3)
+    return result
+
+def _loop() -> None:
+    while not _stop.wait(RETENTION_INTERVAL_S):
+        try:
+            run_once()
+        except Exception:
+            # Cada lote es su propia transacción: lo que quedó a medias sigue en la próxima corrida.
+            pass
+
+def start() -> None:
+    global _thread
+    if _thread is not None or RETENTION_INTERVAL_S <= 0:
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_loop, name="retention", daemon=True)
+    _thread.start()
+
+def stop(timeout: float = 5) -> None:
+    global _thread
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout)
+        _thread = None
+
+def stats() -> Dict[str, float]:
+    with _lock:
+        return dict(_counters)
+
+def _main() -> None:
+    # python retention.py --run | --enable-incremental-vacuum | --lookup SPLIT_ID
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--run", action="store_true", help="una corrida completa ahora")
+    ap.add_argument("--enable-incremental-vacuum", action="store_true", help="convierte una base existente (VACUUM completo)")
+    ap.add_argument("--lookup", metavar="SPLIT_ID", help="imprime un split archivado")
+    args = ap.parse_args()
+    init_db()
+    if args.enable_incremental_vacuum:
+        enable_incremental_vacuum()
+    if args.run:
+        print(json.dumps(run_once()))
+    if args.lookup:
+        print(json.dumps(lookup_archived(args.lookup), ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from db import get_db
+
+DEFAULT_MAX_INSTALLMENTS = 6
+TIER_MEMO_SIZE = int(os.environ.get("TIER_MEMO_SIZE", "100000"))
+RULE_INDEX_CHECK_S = float(os.environ.get("RULE_INDEX_CHECK_S", "2"))  # 0 = verificar en cada uso
+
+class RuleIndex:
+    # Reglas activas de una tienda compiladas a dicts.
+    # Prioridad: product > category > global; ante duplicados gana la regla más vieja (menor id).
+    # Si la tienda tiene catálogo sincronizado, la categoría de un producto conocido sale del
+    # catálogo (by_catalog_product) y se ignora el category_id que manda el storefront.
+    __slots__ = ("by_product", "by_category", "by_catalog_product", "catalog_products", "global_max", "size", "_tier_memo")
+
+    def __init__(
+        self,
+        rules: List[Dict[str, Any]],
+        catalog_matches: Iterable[Tuple[str, int]] = (),
+        catalog_products: Optional[Set[str]] = None,
+    ):
+        self.by_product: Dict[str, int] = {}
+        self.by_category: Dict[str, int] = {}
+        self.by_catalog_product: Dict[str, int] = {}
+        self.catalog_products: Set[str] = catalog_products or set()
+        self.global_max: Optional[int] = None
+        self.size = len(rules)
+        self._tier_memo: Dict[Tuple[int, ...], Dict[Tuple[str, str], int]] = {}
+        for product_id, max_inst in catalog_matches:
+            self.by_catalog_product.setdefault(str(product_id), int(max_inst))
+        for r in rules:
+            scope = r["scope"]
+            ref = str(r["reference_id"] or "")
+            max_inst = int(r["max_installments"])
+            if scope == "product":
+                self.by_product.setdefault(ref, max_inst)
+            elif scope == "category":
+                self.by_category.setdefault(ref, max_inst)
+            elif scope == "global" and self.global_max is None:
+                self.global_max = max_inst
+
+    def max_installments(self, item: Dict[str, Any]) -> int:
+        product_id = str(item.get("product_id") or "")
+        if self.by_product:
+            v = self.by_product.get(product_id)
+            if v is not None:
+                return v
+        if product_id in self.catalog_products:
+            v = self.by_catalog_product.get(product_id)
+            if v is not None:
+                return v
+        elif self.by_category:
+            v = self.by_category.get(str(item.get("category_id") or ""))
+            if v is not None:
+                return v
+        if self.global_max is not None:
+            return self.global_max
+        return DEFAULT_MAX_INSTALLMENTS
+
+    def tier_for(self, item: Dict[str, Any], tiers: Tuple[int, ...]) -> int:
+        # Tramo más alto (tiers en orden descendente) que no supera el máximo del item.
+        # Memoizado por (product_id, category_id): el índice se reemplaza entero cuando
+        # cambian reglas o catálogo, así que el memo vive exactamente una versión. La
+        # clave se normaliza igual que en max_installments: 5 y "5" son el mismo producto
+        # y un id que no es escalar no rompe el dict.
+        memo = self._tier_memo.get(tiers)
+        if memo is None:
+            memo = self._tier_memo[tiers] = {}
+        key = (str(item.get("product_id") or ""), str(item.get("category_id") or ""))
+        tier = memo.get(key)
+        if tier is None:
+            max_inst = self.max_installments(item)
+            tier = next((t for t in tiers if t <= max_inst), tiers[-1])
+            if len(memo) >= TIER_MEMO_SIZE:
+                memo.clear()
+            memo[key] = tier
+        return tier
+
+# Cache en memoria por proceso (store_id -> RuleIndex). Se invalida desde el dashboard
+# cuando se agrega o activa/desactiva una regla, y al terminar una sync de catálogo.
+# La invalidación también incrementa stores.rules_version: con varios workers, cada uno
+# compara su versión con la de la base a lo sumo cada RULE_INDEX_CHECK_S (una lectura
+# por PK) y recompila si cambió.
+_lock = threading.Lock()
+_indexes: Dict[int, Tuple[RuleIndex, int, float]] = {}  # store_id -> (índice, rules_version, último chequeo)
+_generations: Dict[int, int] = {}
+
+def _rules_version(db, store_id: int) -> int:
+    row = db.execute("SELECT rules_version FROM stores WHERE id = ?", (store_id,)).fetchone()
+    return int(row["rules_version"]) if row else 0
+
+def _load_index(store_id: int) -> Tuple[RuleIndex, int]:
+    # La versión se lee en la misma transacción que las reglas, así el par es consistente.
+    # Hace falta un BEGIN explícito: sin transacción abierta sqlite3 corre cada SELECT
+    # en autocommit, con su propio snapshot. Dentro de una transacción (p.ej. un lote
+    # del writer) ya hay un snapshot único.
+    with get_db() as db:
+        if not db.in_transaction:
+            db.execute("BEGIN")
+        version = _rules_version(db, store_id)
+        rules = [dict(r) for r in db.execute(
+            "SELECT scope, reference_id, max_installments FROM rules WHERE store_id = ? AND active = 1 ORDER BY id ASC",
+            (store_id,),
+        ).fetchall()]
+        if not any(r["scope"] == "category" for r in rules):
+            return RuleIndex(rules), version
+
+        # Reglas de categoría resueltas contra el catálogo local (ver catalog.py).
+        matches = [(r["product_id"], r["max_installments"]) for r in db.execute(
+            "SELECT pc.product_id, r.max_installments FROM rules r "
+            "JOIN catalog_product_categories pc ON pc.store_id = r.store_id AND pc.category_id = r.reference_id "
+            "WHERE r.store_id = ? AND r.scope = 'category' AND r.active = 1 ORDER BY r.id ASC",
+            (store_id,),
+        ).fetchall()]
+        known = {r["product_id"] for r in db.execute(
+            "SELECT product_id FROM catalog_products WHERE store_id = ?", (store_id,)
+        ).fetchall()}
+        return RuleIndex(rules, matches, known), version
+
+def get_rule_index(store_id: int) -> RuleIndex:
+    now = time.monotonic()
+    entry = _indexes.get(store_id)
+    if entry is not None:
+        idx, version, checked = entry
+        if now - checked < RULE_INDEX_CHECK_S:
+            return idx
+        with get_db() as db:
+            current = _rules_version(db, store_id)
+        if current == version:
+            with _lock:
+                if _indexes.get(store_id) is entry:
+                    _indexes[store_id] = (idx, version, now)
+            return idx
+
+    gen = _generations.get(store_id, 0)
+    idx, version = _load_index(store_id)
+    with _lock:
+        # Si hubo una invalidación mientras leíamos, no cacheamos un índice viejo.
+        if _generations.get(store_id, 0) == gen:
+            _indexes[store_id] = (idx, version, now)
+    return idx
+
+def invalidate_rule_index(store_id: int) -> None:
+    with get_db() as db:
+        db.execute("UPDATE stores SET rules_version = rules_version + 1 WHERE id = ?", (store_id,))
+    with _lock:
+        _generations[store_id] = _generations.get(store_id, 0) + 1
+        _indexes.pop(store_id, None)
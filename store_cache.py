@@ -0,0 +1,50 @@
+import os
+from typing import Any, Dict, Optional
+
+from cache import TTLCache
+from db import get_db
+
+STORE_CACHE_TTL_S = float(os.environ.get("STORE_CACHE_TTL_S", "60"))
+STORE_CACHE_SIZE = int(os.environ.get("STORE_CACHE_SIZE", "5000"))
+
+# Cache de filas de stores por proceso, indexada por tn_store_id y por id interno.
+# Se invalida explícitamente al guardar tokens; el TTL acota la staleness entre workers.
+_by_tn = TTLCache(STORE_CACHE_TTL_S, STORE_CACHE_SIZE)
+_by_id = TTLCache(STORE_CACHE_TTL_S, STORE_CACHE_SIZE)
+
+def _put(store: Dict[str, Any]) -> None:
+    _by_tn.set(store["tn_store_id"], store)
+    _by_id.set(store["id"], store)
+
+def get_by_tn_store_id(tn_store_id: str) -> Optional[Dict[str, Any]]:
+    store = _by_tn.get(tn_store_id)
+    if store is None:
+        with get_db() as db:
+            row = db.execute("SELECT * FROM stores WHERE tn_store_id = ?", (tn_store_id,)).fetchone()
+        if not row:
+            return None
+        store = dict(row)
+        _put(store)
+    return dict(store)
+
+def get_by_id(store_id: int) -> Optional[Dict[str, Any]]:
+    store = _by_id.get(store_id)
+    if store is None:
+        with get_db() as db:
+            row = db.execute("SELECT * FROM stores WHERE id = ?", (store_id,)).fetchone()
+        if not row:
+            return None
+        store = dict(row)
+        _put(store)
+    return dict(store)
+
+def invalidate(tn_store_id: str) -> None:
+    # Llamar después del commit, si no otro request puede volver a cachear la fila vieja.
+    _by_tn.pop(tn_store_id)
+    with get_db() as db:
+        row = db.execute("SELECT id FROM stores WHERE tn_store_id = ?", (tn_store_id,)).fetchone()
+    if row:
+        _by_id.pop(row["id"])
+
+def stats() -> Dict[str, Dict[str, int]]:
+    return {"by_tn_store_id": _by_tn.stats(), "by_id": _by_id.stats()}
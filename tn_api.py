@@ -1,9 +1,149 @@
 import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
 import requests
-from typing import Any, Dict, List
 
-TN_API_BASE = "https://api.tiendanube.com/v1"
-TN_TOKEN_URL = "https://www.tiendanube.com/apps/authorize/token"  # :contentReference[oaicite:4]{index=4}
+from http_client import RETRY_STATUSES, request
+
+TN_API_BASE = os.environ.get("TN_API_BASE", "https://api.tiendanube.com/v1")
+TN_TOKEN_URL = os.environ.get("TN_TOKEN_URL", "https://www.tiendanube.com/apps/authorize/token")  # :contentReference[oaicite:4]{index=4}
+TN_RATE_LIMIT = int(os.environ.get("TN_RATE_LIMIT", "40"))  # tamaño del bucket hasta ver el header
+TN_RATE_LEAK_PER_S = float(os.environ.get("TN_RATE_LEAK_PER_S", "2"))
+TN_RATE_HEADROOM = int(os.environ.get("TN_RATE_HEADROOM", "2"))
+TN_RATE_MAX_429_RETRIES = int(os.environ.get("TN_RATE_MAX_429_RETRIES", "3"))
+TN_ORDER_MAX_WAIT_S = float(os.environ.get("TN_ORDER_MAX_WAIT_S", "10"))
+
+# ----------------- Rate limit por tienda -----------------
+# TN aplica un leaky bucket por tienda y lo informa en cada respuesta (x-rate-limit-limit,
+# x-rate-limit-remaining y x-rate-limit-reset, ms hasta vaciarse). Acá cada tienda tiene
+# su estimación del bucket: antes de cada llamada se reserva un lugar, esperando en orden
+# de llegada lo que haga falta, y cada respuesta resincroniza el nivel con los headers.
+# Un 429 frena a la tienda hasta el reset y la llamada se repite (TN no la procesó, así
+# que es seguro incluso para un POST). Tiendas distintas no se esperan entre sí.
+
+class TNRateLimited(Exception):
+    # La espera estimada supera max_wait: el caller reintenta más tarde (el outbox lo
+    # reprograma sin gastar un intento) en vez de bloquear un worker.
+    def __init__(self, tn_store_id: str, retry_after: float):
+        super().__init__(f"rate limit de TN para la tienda {tn_store_id}: reintentar en {retry_after:.1f}s")
+        self.tn_store_id = tn_store_id
+        self.retry_after = retry_after
+
+# Hook de espera: (tn_store_id, segundos esperados antes de la llamada).
+WaitHook = Callable[[str, float], None]
+_wait_hooks: List[WaitHook] = []
+
+def add_wait_hook(hook: WaitHook) -> None:
+    _wait_hooks.append(hook)
+
+def _header_int(headers: Any, name: str) -> Optional[int]:
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+class _StoreBucket:
+    def __init__(self):
+        self.limit = TN_RATE_LIMIT
+        self.level = 0.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.queued = 0
+        self.counters: Dict[str, float] = {"calls": 0, "waited": 0, "wait_s": 0.0, "throttled": 0, "deferred": 0}
+        self._state = threading.Lock()
+        # Un solo llamador de la tienda esperando su lugar a la vez; el resto hace cola detrás.
+        self._turn = threading.Lock()
+
+    def _delay(self, now: float) -> float:
+        self.level = max(0.0, self.level - (now - self.updated) * TN_RATE_LEAK_PER_S)
+        self.updated = now
+        over = self.level + 1 - max(1, self.limit - TN_RATE_HEADROOM)
+        return max(self.blocked_until - now, over / TN_RATE_LEAK_PER_S if over > 0 else 0.0, 0.0)
+
+    def acquire(self, tn_store_id: str, max_wait: Optional[float]) -> float:
+        with self._state:
+            if max_wait is not None:
+                estimate = self._delay(time.monotonic()) + self.queued / TN_RATE_LEAK_PER_S
+                if estimate > max_wait:
+                    self.counters["deferred"] += 1
+                    raise TNRateLimited(tn_store_id, estimate)
+            self.queued += 1
+        waited = 0.0
+        try:
+            with self._turn:
+                while True:
+                    with self._state:
+                        delay = self._delay(time.monotonic())
+                        if delay <= 0:
+                            self.level += 1
+                            self.counters["calls"] += 1
+                            if waited:
+                                self.counters["waited"] += 1
+                                self.counters["wait_s"] += waited
+                            break
+                    time.sleep(delay)
+                    waited += delay
+        finally:
+            with self._state:
+                self.queued -= 1
+        return waited
+
+    def update(self, status: int, headers: Any) -> None:
+        limit = _header_int(headers, "x-rate-limit-limit")
+        remaining = _header_int(headers, "x-rate-limit-remaining")
+        reset_ms = _header_int(headers, "x-rate-limit-reset")
+        with self._state:
+            now = time.monotonic()
+            if limit:
+                self.limit = limit
+            if remaining is not None:
+                # Los headers solo suben la estimación: la respuesta no cuenta las llamadas
+                # reservadas después de enviarla, pero sí las de otros procesos.
+                self._delay(now)
+                self.level = max(self.level, float(self.limit - remaining))
+            if status == 429:
+                self.counters["throttled"] += 1
+                self.level, self.updated = float(self.limit), now
+                pause = reset_ms / 1000 if reset_ms else 1 / TN_RATE_LEAK_PER_S
+                self.blocked_until = max(self.blocked_until, now + pause)
+
+_buckets_lock = threading.Lock()
+_buckets: Dict[str, _StoreBucket] = {}
+
+def _bucket(tn_store_id: str) -> _StoreBucket:
+    bucket = _buckets.get(tn_store_id)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.setdefault(tn_store_id, _StoreBucket())
+    return bucket
+
+def _store_request(tn_store_id: str, method: str, url: str, call: str, max_wait: Optional[float] = None, **kwargs: Any) -> requests.Response:
+    bucket = _bucket(str(tn_store_id))
+    for attempt in range(TN_RATE_MAX_429_RETRIES + 1):
+        waited = bucket.acquire(str(tn_store_id), max_wait)
+        for hook in list(_wait_hooks):
+            try:
+                hook(str(tn_store_id), waited)
+            except Exception:
+                pass
+        r = request("tn", method, url, call=call, retry_statuses=RETRY_STATUSES - {429}, **kwargs)
+        bucket.update(r.status_code, r.headers)
+        if r.status_code != 429 or attempt == TN_RATE_MAX_429_RETRIES:
+            return r
+        r.close()
+    raise RuntimeError("unreachable")
+
+def rate_limit_stats() -> Dict[str, Dict[str, float]]:
+    # Por tn_store_id: cola actual, nivel estimado del bucket y contadores.
+    with _buckets_lock:
+        buckets = list(_buckets.items())
+    out = {}
+    for tn_store_id, b in buckets:
+        with b._state:
+            out[tn_store_id] = dict(b.counters, queued=b.queued, level=round(b.level, 2), limit=b.limit)
+    return out
 
 def tn_headers(access_token: str) -> Dict[str, str]:
     ua = os.environ.get("TN_USER_AGENT", "SplitPay (dev@example.com)")
@@ -21,24 +161,41 @@ def exchange_code_for_token(code: str, client_id: str, client_secret: str) -> Di
         "grant_type": "authorization_code",
         "code": code,
     }
-    r = requests.post(TN_TOKEN_URL, data=data, timeout=30)
+    r = request("tn", "POST", TN_TOKEN_URL, call="tn.exchange_code_for_token", data=data)
     r.raise_for_status()
     return r.json()
 
-def get_products(store_id: str, access_token: str, page: int = 1, per_page: int = 50) -> List[Dict[str, Any]]:
-    url = f"{TN_API_BASE}/{store_id}/products?page={page}&per_page={per_page}"
-    r = requests.get(url, headers=tn_headers(access_token), timeout=30)
+def get_products(
+    store_id: str,
+    access_token: str,
+    page: int = 1,
+    per_page: int = 50,
+    updated_at_min: Optional[str] = None,
+    fields: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    url = f"{TN_API_BASE}/{store_id}/products"
+    params: Dict[str, Any] = {"page": page, "per_page": per_page}
+    if updated_at_min:
+        params["updated_at_min"] = updated_at_min
+    if fields:
+        params["fields"] = fields
+    r = _store_request(store_id, "GET", url, call="tn.get_products", headers=tn_headers(access_token), params=params)
+    # TN responde 404 cuando se pide una página posterior a la última.
+    if r.status_code == 404:
+        return []
     r.raise_for_status()
     return r.json()
 
 def get_categories(store_id: str, access_token: str) -> List[Dict[str, Any]]:
     url = f"{TN_API_BASE}/{store_id}/categories"
-    r = requests.get(url, headers=tn_headers(access_token), timeout=30)
+    r = _store_request(store_id, "GET", url, call="tn.get_categories", headers=tn_headers(access_token))
     r.raise_for_status()
     return r.json()
 
 def create_order(store_id: str, access_token: str, payload: Dict[str, Any]) -> Dict[str, Any]:
     url = f"{TN_API_BASE}/{store_id}/orders"
-    r = requests.post(url, headers=tn_headers(access_token), json=payload, timeout=30)
+    # Con la tienda saturada no se bloquea al worker del outbox más de TN_ORDER_MAX_WAIT_S.
+    r = _store_request(store_id, "POST", url, call="tn.create_order", max_wait=TN_ORDER_MAX_WAIT_S,
+                       headers=tn_headers(access_token), json=payload)
     r.raise_for_status()
     return r.json()